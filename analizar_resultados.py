@@ -15,7 +15,8 @@ print("\n--- POR STATUS ---")
 print(df['status'].value_counts())
 
 # Detalles de Claude API
-claude_df = df[df['extraction_method'] == 'CLAUDE_API']
+# CLAUDE_API (imágenes), CLAUDE_TEXT (capa de texto) y CLAUDE_REGIONS (zonas de plantilla)
+claude_df = df[df['extraction_method'].astype(str).str.startswith('CLAUDE')]
 print(f"\n--- DETALLES CLAUDE API ---")
 print(f"Total facturas con Claude: {len(claude_df)}")
 print(f"Claude OK: {len(claude_df[claude_df['status'] == 'OK'])}")
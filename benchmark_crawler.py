@@ -0,0 +1,99 @@
+"""
+Benchmark del recorrido de la carpeta de facturas.
+Compara glob("**/*.pdf") + os.stat por archivo (método anterior) con
+PdfCrawler (scandir de una pasada y caché de mtime por directorio) sobre un
+árbol sintético de PDFs vacíos.
+
+En disco local el stat es barato; sobre el recurso SMB cada os.stat es una
+ida y vuelta por red, así que la diferencia real es bastante mayor.
+
+Uso: python benchmark_crawler.py [--files 50000] [--per-dir 200] [--dir RUTA]
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+from pdf_crawler import PdfCrawler
+
+
+def build_tree(root, num_files, per_dir):
+    """Árbol año/mes/proveedor con per_dir PDFs por carpeta, con fecha de ayer (facturas ya asentadas)"""
+    yesterday = time.time() - 86400
+    created = 0
+    folder = 0
+    while created < num_files:
+        directory = Path(root, f"{2020 + folder // 120}", f"{folder // 10 % 12 + 1:02d}", f"PROV_{folder:05d}")
+        directory.mkdir(parents=True, exist_ok=True)
+        for i in range(min(per_dir, num_files - created)):
+            pdf_path = directory / f"Factura_{folder:05d}_{i:04d}.pdf"
+            pdf_path.write_bytes(b"%PDF-1.4\n")
+            os.utime(pdf_path, (yesterday, yesterday))
+            created += 1
+        folder += 1
+    return folder
+
+
+def bench_glob(root):
+    start = time.perf_counter()
+    fingerprints = {}
+    for pdf_path in sorted(Path(root).glob("**/*.pdf")):
+        stats = os.stat(pdf_path)
+        fingerprints[str(pdf_path)] = f"{stats.st_mtime}-{stats.st_size}"
+    return time.perf_counter() - start, fingerprints
+
+
+def bench_crawler(root, cache_path, full_rescan=False):
+    start = time.perf_counter()
+    crawler = PdfCrawler(cache_path)  # incluye la carga de la caché de directorios
+    fingerprints = {entry.path: entry.fingerprint
+                    for entry in sorted(crawler.scan(root, full_rescan))}
+    return time.perf_counter() - start, fingerprints, crawler.drain_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=50000)
+    parser.add_argument("--per-dir", type=int, default=200)
+    parser.add_argument("--dir", help="Árbol existente a recorrer (por defecto se genera uno temporal)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_crawler_")
+    try:
+        root = args.dir
+        if root is None:
+            root = os.path.join(workdir, "facturas")
+            folders = build_tree(root, args.files, args.per_dir)
+            print(f"Árbol sintético: {args.files} PDFs en {folders} carpetas ({root})")
+        cache_path = os.path.join(workdir, "crawl_dirs.json")
+
+        glob_time, expected = bench_glob(root)
+        cold_time, cold, cold_stats = bench_crawler(root, cache_path)
+        warm_time, warm, warm_stats = bench_crawler(root, cache_path)
+
+        # Una factura nueva: sólo se relista su carpeta
+        new_pdf = Path(sorted(Path(root).glob("*/*/*"))[0], "Factura_nueva.pdf")
+        new_pdf.write_bytes(b"%PDF-1.4\n")
+        bench_glob(root)  # mismas condiciones de caché del SO para ambos
+        one_time, one, one_stats = bench_crawler(root, cache_path)
+        new_pdf.unlink()
+
+        assert cold == expected and warm == expected, "El crawler debe producir las mismas huellas que glob + stat"
+        assert str(new_pdf) in one and len(one) == len(expected) + 1
+
+        print("=" * 70)
+        print(f"glob + os.stat (anterior):        {glob_time:8.2f} s")
+        print(f"PdfCrawler en frío (sin caché):   {cold_time:8.2f} s  ({cold_stats['dirs_scanned']} directorios listados)")
+        print(f"PdfCrawler sin cambios:           {warm_time:8.2f} s  ({warm_stats['dirs_skipped']} directorios sin listar, "
+              f"{warm_stats['dirs_relisted']} relistados)")
+        print(f"PdfCrawler con 1 factura nueva:   {one_time:8.2f} s  ({one_stats['dirs_scanned']} directorios listados)")
+        print(f"Aceleración sin cambios:          {glob_time / max(warm_time, 1e-9):8.1f}x")
+        print("=" * 70)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,521 @@
+"""
+Benchmark del procesador IDP sobre un corpus sintético (ver synthetic_corpus.py).
+Mide por separado, cada fase en su propio proceso para que el pico de memoria
+(peak RSS) sea el de esa fase:
+
+- suppliers:    carga de PROVEE.csv (en frío y desde la caché) y matching por CIF y por nombre
+- extract:      extract_idp_data (lectura del PDF, apertura y get_text)
+- parse:        parse_fields sin Claude (regex de CIF, matching, plantillas, regex de importes)
+- process_all:  ejecución completa con un cliente de Claude simulado (latencia fija, respuesta fija;
+                con --claude-server por HTTP contra claude_stub_server.py) y una segunda
+                ejecución sin cambios (coste del incremental)
+- export:       Excel de resumen desde el almacén con --export-rows facturas
+
+Todo se ejecuta en un directorio temporal: las rutas c:\\Proyectos\\Proveedores\\...
+de los módulos se redirigen allí, así que no toca el estado ni las cachés reales.
+El resultado (docs/s y peak RSS por fase, commit de git) se guarda en JSON para
+compararlo entre commits con --compare.
+
+Uso: python benchmark_idp.py [--invoices 2000] [--suppliers 50000] [--dir CORPUS]
+                             [--workers N] [--claude-concurrency N] [--claude-latency 0.8] [--claude-rpm N]
+                             [--claude-server | --claude-url http://127.0.0.1:8765]
+                             [--stages extract,parse] [--output res.json] [--compare anterior.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime
+from pathlib import Path
+
+STAGES = ["suppliers", "extract", "parse", "process_all", "export"]
+PRODUCTION_PREFIX = "c:\\proyectos\\proveedores"
+
+# Respuesta fija del Claude simulado (importes que cuadran: no provoca escaladas)
+STUB_ANSWER = {
+    "supplier_tax_id": "B00000000",
+    "supplier_name": "PROVEEDOR SIMULADO S.L.",
+    "invoice_number": "SIM-0001",
+    "invoice_date": "15/01/2026",
+    "base_imponible": "100,00",
+    "iva_importe": "21,00",
+    "total_amount": "121,00",
+    "currency": "EUR",
+    "confidence": "high"
+}
+
+
+# ==============================================================================
+# CLAUDE SIMULADO
+# ==============================================================================
+class _Block:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def _stub_response(params):
+    """Message con la herramienta rellena sólo con los campos que pide su esquema"""
+    tool = params["tools"][0]
+    properties = tool["input_schema"]["properties"]
+    answer = {field: STUB_ANSWER.get(field) for field in properties}
+    usage = _Block(input_tokens=1200, output_tokens=90, cache_read_input_tokens=0, cache_creation_input_tokens=0)
+    return _Block(model=params["model"], stop_reason="tool_use", usage=usage,
+                  content=[_Block(type="tool_use", id="toolu_stub", name=tool["name"], input=answer)])
+
+
+class StubAnthropic:
+    """Sustituto de anthropic.Anthropic: messages.create con latencia fija"""
+    latency = 0.8
+
+    def __init__(self, *args, **kwargs):
+        self.messages = self
+
+    def create(self, **params):
+        time.sleep(self.latency)
+        return _stub_response(params)
+
+
+class StubAsyncAnthropic:
+    """Sustituto de anthropic.AsyncAnthropic para el despachador concurrente"""
+    latency = 0.8
+
+    def __init__(self, *args, **kwargs):
+        self.messages = self
+
+    async def create(self, **params):
+        await asyncio.sleep(self.latency)
+        return _stub_response(params)
+
+    async def close(self):
+        pass
+
+
+# ==============================================================================
+# ENTORNO AISLADO
+# ==============================================================================
+def configure(corpus, workdir):
+    """Redirige a workdir las rutas de producción de los módulos y usa el corpus como entrada"""
+    import jofeg_idp_processor as idp
+    import claude_extractor
+
+    for module in (idp, claude_extractor):
+        for name, value in vars(module).items():
+            if name.isupper() and isinstance(value, str) and value.lower().startswith(PRODUCTION_PREFIX):
+                setattr(module, name, os.path.join(workdir, value[len(PRODUCTION_PREFIX) + 1:].replace("\\", os.sep)))
+    idp.INPUT_PDF_DIR = corpus["pdf_dir"]
+    idp.PROVEE_CSV_PATH = corpus["provee_csv"]
+    idp.TEMPLATES_PATH = corpus["templates"]
+
+    # Sólo avisos: el log INFO por factura no es lo que se mide (y no debe ir al log real)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.FileHandler):
+            root.removeHandler(handler)
+            handler.close()
+    root.setLevel(logging.WARNING)
+    return idp
+
+
+def install_claude_stub(latency, requests_per_minute=None, url=None):
+    """
+    Sustituye los clientes de Anthropic por los simulados, o apunta a un servidor de pruebas
+
+    Args:
+        requests_per_minute: presupuesto del despachador; None = sin límite (con el de la cuenta,
+            50/min, el ritmo lo marca el presupuesto y no el código)
+        url: servidor HTTP de pruebas (claude_stub_server.py); los procesos del pool lo heredan
+            por la variable de entorno en cualquier plataforma
+    """
+    import claude_extractor
+    import claude_dispatcher
+    os.environ.setdefault("ANTHROPIC_API_KEY", "sk-benchmark")
+    if url:
+        os.environ["ANTHROPIC_BASE_URL"] = url
+        claude_extractor.CLAUDE_BASE_URL = url
+    else:
+        StubAnthropic.latency = StubAsyncAnthropic.latency = latency
+        claude_extractor.anthropic.Anthropic = StubAnthropic
+        claude_extractor.anthropic.AsyncAnthropic = StubAsyncAnthropic
+
+    base = claude_dispatcher.ClaudeDispatcher
+    rpm = requests_per_minute or 10**6
+
+    class BenchmarkDispatcher(base):
+        def __init__(self, client_factory, **kwargs):
+            kwargs.setdefault("requests_per_minute", rpm)
+            kwargs.setdefault("tokens_per_minute", rpm * 1000)
+            super().__init__(client_factory, **kwargs)
+
+    # process_all importa ClaudeDispatcher al llamarse: toma esta subclase
+    claude_dispatcher.ClaudeDispatcher = BenchmarkDispatcher
+
+
+def peak_rss_mb():
+    """(pico de memoria del proceso, pico del mayor proceso hijo) en MB; el segundo None si no se conoce"""
+    try:
+        import resource
+    except ImportError:
+        # Windows: PeakWorkingSetSize de GetProcessMemoryInfo
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize / 1024 / 1024, None
+    # ru_maxrss va en KB en Linux y en bytes en macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return own, children or None
+
+
+def corpus_pdfs(corpus):
+    return sorted(Path(corpus["pdf_dir"]).rglob("*.pdf"))
+
+
+# ==============================================================================
+# FASES (cada una en su propio proceso)
+# ==============================================================================
+def stage_suppliers(corpus, workdir, args):
+    idp = configure(corpus, workdir)
+    processor = idp.JofegIDPProcessor(use_claude_api=False)
+    from pdf_document import InvoiceDocument
+
+    if os.path.exists(idp.SUPPLIER_CACHE_PATH):
+        os.remove(idp.SUPPLIER_CACHE_PATH)
+    start = time.perf_counter()
+    processor._load_suppliers()
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    index = processor._load_suppliers()
+    warm = time.perf_counter() - start
+
+    texts = []
+    for pdf_path in corpus_pdfs(corpus)[:args.sample]:
+        with InvoiceDocument(pdf_path) as document:
+            texts.append(document.text)
+
+    from normalized_text import NormalizedText
+    lookups = 0
+    start = time.perf_counter()
+    for text in texts:
+        normalized = NormalizedText(text)
+        for cif in dict.fromkeys(idp.CIF_PATTERN.findall(normalized.compact)):
+            index.lookup_cif(processor.normalize_id(cif))
+            lookups += 1
+        index.find_names(text, normalized.tokens)
+    matching = time.perf_counter() - start
+    return {
+        "suppliers": len(index),
+        "load_cold_s": round(cold, 3),
+        "load_cached_s": round(warm, 3),
+        "documents": len(texts),
+        "cif_lookups": lookups,
+        "seconds": round(matching, 3),
+        "docs_per_sec": round(len(texts) / matching, 1) if matching else None
+    }
+
+
+def stage_extract(corpus, workdir, args):
+    idp = configure(corpus, workdir)
+    processor = idp.JofegIDPProcessor(use_claude_api=False)
+    pdfs = corpus_pdfs(corpus)
+    errors = 0
+    start = time.perf_counter()
+    for pdf_path in pdfs:
+        _, _, err = processor.extract_idp_data(pdf_path)
+        errors += bool(err)
+    seconds = time.perf_counter() - start
+    return {"documents": len(pdfs), "errors": errors, "seconds": round(seconds, 3),
+            "docs_per_sec": round(len(pdfs) / seconds, 1)}
+
+
+def stage_parse(corpus, workdir, args):
+    idp = configure(corpus, workdir)
+    processor = idp.JofegIDPProcessor(use_claude_api=False)
+    from pdf_document import InvoiceDocument
+    pdfs = corpus_pdfs(corpus)
+    methods = {}
+    seconds = 0.0
+    for pdf_path in pdfs:
+        with InvoiceDocument(pdf_path) as document:
+            text = document.text
+            # Sólo se cronometra parse_fields: el PDF ya está abierto y el texto extraído
+            start = time.perf_counter()
+            fields = processor.parse_fields(text, document, pdf_path=pdf_path)
+            seconds += time.perf_counter() - start
+        method = fields.get("extraction_method")
+        methods[method] = methods.get(method, 0) + 1
+    return {"documents": len(pdfs), "methods": methods, "seconds": round(seconds, 3),
+            "docs_per_sec": round(len(pdfs) / seconds, 1)}
+
+
+def stage_process_all(corpus, workdir, args):
+    idp = configure(corpus, workdir)
+    workers = args.workers
+    use_claude = True
+    if workers and workers > 1 and not args.claude_url and multiprocessing.get_start_method() != "fork":
+        # Los procesos del pool vuelven a importar los módulos: no heredan el Claude simulado en proceso
+        print(f"Aviso: con --workers y arranque '{multiprocessing.get_start_method()}' se mide sin Claude",
+              file=sys.stderr)
+        use_claude = False
+    install_claude_stub(args.claude_latency, args.claude_rpm, args.claude_url)
+
+    processor = idp.JofegIDPProcessor(use_claude_api=use_claude)
+    start = time.perf_counter()
+    rows = processor.process_all(workers=workers, claude_concurrency=args.claude_concurrency, export_excel=False)
+    seconds = time.perf_counter() - start
+    claude_calls = sum(value for key, value in processor.run_stats.items() if key.startswith("calls_model_"))
+    stages_p95 = None
+    # p95 por fase de la propia ejecución (run_metrics)
+    if os.path.exists(idp.METRICS_JSON_PATH):
+        with open(idp.METRICS_JSON_PATH, encoding="utf-8") as f:
+            stages_p95 = {name: stage["p95_ms"] for name, stage in json.load(f)["stages"].items()}
+
+    # Segunda ejecución sin cambios: recorrido, estado y reintento de los NO_MATCH
+    start = time.perf_counter()
+    processor.process_all(workers=workers, claude_concurrency=args.claude_concurrency, export_excel=False)
+    rerun = time.perf_counter() - start
+
+    statuses = {}
+    for row in rows:
+        statuses[row["status"]] = statuses.get(row["status"], 0) + 1
+    result = {
+        "documents": len(rows),
+        "statuses": statuses,
+        "claude": (args.claude_url or f"simulado ({args.claude_latency}s)") if use_claude else "desactivado",
+        "claude_calls": claude_calls,
+        "seconds": round(seconds, 3),
+        "docs_per_sec": round(len(rows) / seconds, 1),
+        "rerun_no_changes_s": round(rerun, 3)
+    }
+    if stages_p95:
+        result["stages_p95_ms"] = stages_p95
+    return result
+
+
+def stage_export(corpus, workdir, args):
+    idp = configure(corpus, workdir)
+    processor = idp.JofegIDPProcessor(use_claude_api=False)
+    rows = []
+    for i in range(args.export_rows):
+        rows.append({
+            "file_path": f"{corpus['pdf_dir']}{os.sep}{2024 + i % 3}{os.sep}Factura_{i:07d}.pdf",
+            "file_name": f"Factura_{i:07d}.pdf",
+            "guid": f"{i:012x}",
+            "status": ("OK", "OK", "OK", "NO_MATCH", "ERROR")[i % 5],
+            "error": "",
+            "supplier_name_erp": f"PROVEEDOR SINTETICO {i % 800} S.L.",
+            "invoice_number": f"F26-{i:06d}",
+            "invoice_date": f"{i % 28 + 1:02d}/{i % 12 + 1:02d}/2026",
+            "supplier_tax_id": f"B{i % 800:08d}",
+            "base_imponible": "1.000,00",
+            "iva_importe": "210,00",
+            "total_amount": "1.210,00",
+            "supplier_account": f"400{i % 800:07d}"
+        })
+    for chunk in range(0, len(rows), 5000):
+        processor.results_store.upsert(rows[chunk:chunk + 5000])
+    del rows
+
+    start = time.perf_counter()
+    processor.export()
+    seconds = time.perf_counter() - start
+    return {"rows": args.export_rows, "seconds": round(seconds, 3),
+            "rows_per_sec": round(args.export_rows / seconds, 1),
+            "xlsx_mb": round(os.path.getsize(idp.OUTPUT_XLSX) / 1024 / 1024, 2)}
+
+
+STAGE_FUNCTIONS = {
+    "suppliers": stage_suppliers,
+    "extract": stage_extract,
+    "parse": stage_parse,
+    "process_all": stage_process_all,
+    "export": stage_export
+}
+
+
+def run_stage(args):
+    """Proceso hijo: ejecuta una fase y escribe su resultado como JSON en la última línea"""
+    with open(os.path.join(args.dir, "corpus.json"), encoding="utf-8") as f:
+        corpus = json.load(f)
+    workdir = tempfile.mkdtemp(prefix=f"bench_idp_{args.stage}_")
+    try:
+        result = STAGE_FUNCTIONS[args.stage](corpus, workdir, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    own, children = peak_rss_mb()
+    result["peak_rss_mb"] = round(own, 1)
+    if children:
+        result["peak_rss_workers_mb"] = round(children, 1)
+    print(json.dumps(result, ensure_ascii=False))
+
+
+# ==============================================================================
+# ORQUESTACIÓN
+# ==============================================================================
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def stage_command(stage, args):
+    command = [sys.executable, os.path.abspath(__file__), "--stage", stage, "--dir", args.dir,
+               "--claude-latency", str(args.claude_latency), "--export-rows", str(args.export_rows),
+               "--sample", str(args.sample)]
+    if args.workers:
+        command += ["--workers", str(args.workers)]
+    if args.claude_concurrency:
+        command += ["--claude-concurrency", str(args.claude_concurrency)]
+    if args.claude_rpm:
+        command += ["--claude-rpm", str(args.claude_rpm)]
+    if args.claude_url:
+        command += ["--claude-url", args.claude_url]
+    return command
+
+
+def print_results(results, previous=None):
+    before = (previous or {}).get("stages", {})
+    print("=" * 90)
+    print(f"{'Fase':<13}{'ritmo':>16}{'anterior':>16}{'dif.':>9}{'segundos':>11}{'peak RSS':>16}")
+    print("-" * 90)
+    for stage, result in results["stages"].items():
+        if "error" in result:
+            print(f"{stage:<13} ERROR: {result['error']}")
+            continue
+        unit, key = ("filas/s", "rows_per_sec") if "rows_per_sec" in result else ("docs/s", "docs_per_sec")
+        rate = result.get(key)
+        old = before.get(stage, {}).get(key)
+        diff = f"{(rate - old) / old * 100:+.0f}%" if rate and old else ""
+        old_text = f"{old:.1f} {unit}" if old else ""
+        rss = f"{result['peak_rss_mb']:.0f} MB"
+        if result.get("peak_rss_workers_mb"):
+            rss += f" (+{result['peak_rss_workers_mb']:.0f})"
+        print(f"{stage:<13}{rate or 0:>9.1f} {unit:<6}{old_text:>16}{diff:>9}{result['seconds']:>11.2f}{rss:>16}")
+    print("=" * 90)
+    extra = results["stages"].get("process_all", {})
+    if extra.get("stages_p95_ms"):
+        slowest = sorted(extra["stages_p95_ms"].items(), key=lambda item: -item[1])[:6]
+        print("p95 por fase en process_all: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in slowest))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--invoices", type=int, default=2000)
+    parser.add_argument("--suppliers", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--dir", help="Corpus ya generado (por defecto se genera uno temporal)")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"Fases a medir (de {', '.join(STAGES)})")
+    parser.add_argument("--workers", type=int, default=None, help="Procesos del pool en process_all")
+    parser.add_argument("--claude-concurrency", type=int, default=None,
+                        help="Llamadas a Claude en vuelo en process_all (por defecto: síncrono)")
+    parser.add_argument("--claude-latency", type=float, default=0.8, help="Segundos por llamada al Claude simulado")
+    parser.add_argument("--claude-rpm", type=int, default=None,
+                        help="Peticiones/minuto del despachador (por defecto sin límite; 50 = cuenta actual)")
+    parser.add_argument("--claude-url", help="Usar un servidor de pruebas ya arrancado (claude_stub_server.py) "
+                                             "en lugar del cliente simulado en proceso")
+    parser.add_argument("--claude-server", action="store_true",
+                        help="Arrancar claude_stub_server en este proceso (latencia --claude-latency) y usarlo")
+    parser.add_argument("--export-rows", type=int, default=20000, help="Facturas en el almacén para la fase export")
+    parser.add_argument("--sample", type=int, default=1000, help="Facturas usadas en la fase suppliers")
+    parser.add_argument("--output", help="JSON donde guardar los resultados (por defecto benchmark_<commit>_<fecha>.json)")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior con el que comparar")
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        run_stage(args)
+        return
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Fases desconocidas: {', '.join(sorted(unknown))}")
+
+    generated = args.dir is None
+    if generated:
+        args.dir = tempfile.mkdtemp(prefix="bench_idp_corpus_")
+    try:
+        corpus_file = os.path.join(args.dir, "corpus.json")
+        if os.path.exists(corpus_file):
+            with open(corpus_file, encoding="utf-8") as f:
+                corpus = json.load(f)
+            print(f"Corpus existente: {corpus['invoices']} facturas, {corpus['suppliers']} proveedores ({args.dir})")
+        else:
+            from synthetic_corpus import build_corpus
+            start = time.perf_counter()
+            corpus = build_corpus(args.dir, args.invoices, args.suppliers, args.seed)
+            with open(corpus_file, "w", encoding="utf-8") as f:
+                json.dump(corpus, f, ensure_ascii=False, indent=2)
+            kinds = ", ".join(f"{kind} {count}" for kind, count in sorted(corpus["kinds"].items()))
+            print(f"Corpus sintético: {corpus['invoices']} facturas ({kinds}), {corpus['suppliers']} proveedores "
+                  f"en {time.perf_counter() - start:.1f} s")
+
+        stub_server = None
+        if args.claude_server and not args.claude_url:
+            from claude_stub_server import StubConfig, serve_in_thread
+            stub_server, args.claude_url = serve_in_thread(StubConfig(latency=args.claude_latency, jitter=0))
+            print(f"Stub de Claude en {args.claude_url}")
+
+        results = {
+            "commit": git_revision(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+            "options": {"workers": args.workers, "claude_concurrency": args.claude_concurrency,
+                        "claude_latency": args.claude_latency, "claude_rpm": args.claude_rpm,
+                        "claude_url": args.claude_url,
+                        "export_rows": args.export_rows},
+            "corpus": {key: corpus[key] for key in ("invoices", "suppliers", "kinds")},
+            "stages": {}
+        }
+        for stage in stages:
+            print(f"Midiendo {stage}...", flush=True)
+            completed = subprocess.run(stage_command(stage, args), capture_output=True, text=True)
+            lines = completed.stdout.strip().splitlines()
+            if completed.returncode != 0 or not lines:
+                error = (completed.stderr.strip().splitlines() or ["sin salida"])[-1]
+                results["stages"][stage] = {"error": error}
+                continue
+            results["stages"][stage] = json.loads(lines[-1])
+        if stub_server is not None:
+            results["claude_server"] = stub_server.stub_state.snapshot()
+            stub_server.shutdown()
+
+        previous = None
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                previous = json.load(f)
+            print(f"Comparando con {args.compare} (commit {previous.get('commit')}, {previous.get('timestamp')})")
+        print_results(results, previous)
+
+        output = args.output or f"benchmark_{results['commit'] or 'sin_git'}_{datetime.now():%Y%m%d_%H%M%S}.json"
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Resultados guardados en {output}")
+    finally:
+        if generated:
+            shutil.rmtree(args.dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark del matching de proveedores por CIF.
+Compara el filtro booleano sobre el DataFrame (método anterior) con el
+índice por diccionario (SupplierIndex) sobre un maestro sintético grande.
+
+Uso: python benchmark_supplier_matching.py [--suppliers 50000] [--invoices 200]
+"""
+
+import argparse
+import random
+import time
+import pandas as pd
+from supplier_index import SupplierIndex
+
+# Por factura: ~18 CIFs candidatos detectados (ver log) + CIF final + matching en process_all
+CANDIDATES_PER_INVOICE = 18
+
+
+def build_master(num_suppliers, seed=42):
+    rng = random.Random(seed)
+    letters = "ABCDEFGHJNPQRSUVW"
+    rows = []
+    for i in range(num_suppliers):
+        cif = f"{rng.choice(letters)}{i:08d}"
+        rows.append({
+            'CUENTA': f"400{i:07d}",
+            'NOMBRE': f"PROVEEDOR SINTETICO {i} S.L.",
+            'CIF': cif,
+            'CIF_NORM': cif
+        })
+    return pd.DataFrame(rows)
+
+
+def build_invoices(df, num_invoices, seed=7):
+    """Lista de CIFs consultados por factura: la mayoría basura, uno o dos reales"""
+    rng = random.Random(seed)
+    known = df['CIF_NORM'].tolist()
+    invoices = []
+    for _ in range(num_invoices):
+        cifs = [f"X{rng.randrange(10**8):08d}" for _ in range(CANDIDATES_PER_INVOICE - 1)]
+        cifs.append(rng.choice(known))
+        rng.shuffle(cifs)
+        invoices.append(cifs + [cifs[-1], cifs[-1]])
+    return invoices
+
+
+def bench_dataframe(df, invoices):
+    hits = 0
+    start = time.perf_counter()
+    for cifs in invoices:
+        for norm in cifs:
+            if not df[df['CIF_NORM'] == norm].empty:
+                hits += 1
+    return time.perf_counter() - start, hits
+
+
+def bench_index(index, invoices):
+    hits = 0
+    start = time.perf_counter()
+    for cifs in invoices:
+        for norm in cifs:
+            if index.lookup_cif(norm) is not None:
+                hits += 1
+    return time.perf_counter() - start, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--suppliers", type=int, default=50000)
+    parser.add_argument("--invoices", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"Maestro sintético: {args.suppliers} proveedores | {args.invoices} facturas | "
+          f"{CANDIDATES_PER_INVOICE + 2} búsquedas por factura")
+    df = build_master(args.suppliers)
+    invoices = build_invoices(df, args.invoices)
+
+    start = time.perf_counter()
+    index = SupplierIndex.from_dataframe(df)
+    build_time = time.perf_counter() - start
+
+    df_time, df_hits = bench_dataframe(df, invoices)
+    idx_time, idx_hits = bench_index(index, invoices)
+    assert df_hits == idx_hits, "Los dos métodos deben encontrar los mismos proveedores"
+
+    print("=" * 60)
+    print(f"Construcción del índice:      {build_time * 1000:10.2f} ms (una vez por ejecución)")
+    print(f"DataFrame (filtro booleano):  {df_time / args.invoices * 1000:10.3f} ms/factura")
+    print(f"SupplierIndex (dict):         {idx_time / args.invoices * 1000:10.3f} ms/factura")
+    print(f"Aceleración:                  {df_time / max(idx_time, 1e-9):10.0f}x")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
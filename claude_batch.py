@@ -0,0 +1,131 @@
+"""
+Envío del fallback de Claude por lotes (Message Batches API).
+Pensado para backfills grandes (p.ej. repetir un trimestre tras force_reset_run.py):
+todas las facturas que necesitan Claude en una ejecución se envían en uno o
+varios lotes, a mitad de precio y sin la latencia de una petición por factura.
+Los lotes abiertos se apuntan en disco, de modo que si el proceso se corta
+mientras se espera, la siguiente ejecución recoge los resultados del lote ya
+pagado en vez de volver a enviarlo.
+"""
+
+import os
+import json
+import time
+import logging
+
+# Límites de la API: 100.000 peticiones o 256 MB por lote (se deja margen)
+BATCH_MAX_REQUESTS = 10000
+BATCH_MAX_BYTES = 200 * 1024 * 1024
+BATCH_POLL_SECONDS = 60
+BATCH_TIMEOUT_HOURS = 24
+
+
+class BatchRequestError(Exception):
+    """Una petición del lote no terminó bien (errored, canceled o expired)"""
+
+
+class ClaudeBatchRunner:
+    def __init__(self, client, state_path, poll_seconds=BATCH_POLL_SECONDS, timeout_hours=BATCH_TIMEOUT_HOURS):
+        """
+        Args:
+            client: cliente anthropic.Anthropic (o uno falso con messages.batches)
+            state_path: JSON con los lotes enviados y aún no recogidos
+            poll_seconds: intervalo entre consultas del estado del lote
+            timeout_hours: tiempo máximo de espera por lote
+        """
+        self.client = client
+        self.state_path = state_path
+        self.poll_seconds = poll_seconds
+        self.timeout_seconds = timeout_hours * 3600
+
+    def run(self, requests):
+        """
+        Envía las peticiones (ClaudeRequest) y espera sus resultados
+
+        Returns:
+            dict cache_key -> Message de la API, o excepción si esa petición falló
+        """
+        # Las facturas con el mismo contenido comparten clave: se envían una sola vez
+        unique = {}
+        for request in requests:
+            unique.setdefault(request.cache_key, request)
+
+        open_batches = self._load_state()
+        outcomes = {}
+
+        # Primero, lotes de ejecuciones anteriores que cubren alguna de estas peticiones
+        for batch_id, custom_ids in list(open_batches.items()):
+            if not unique.keys() & set(custom_ids):
+                continue
+            logging.info(f"Lote Claude {batch_id} pendiente de una ejecución anterior, recogiendo resultados")
+            outcomes.update(self._collect(batch_id))
+            del open_batches[batch_id]
+            self._save_state(open_batches)
+
+        to_send = [request for key, request in unique.items() if key not in outcomes]
+        for chunk in self._chunks(to_send):
+            batch = self.client.messages.batches.create(requests=[
+                {"custom_id": request.cache_key, "params": request.params} for request in chunk
+            ])
+            logging.info(f"Lote Claude {batch.id} enviado con {len(chunk)} peticiones")
+            open_batches[batch.id] = [request.cache_key for request in chunk]
+            self._save_state(open_batches)
+
+        for batch_id in [b for b, ids in open_batches.items() if unique.keys() & set(ids)]:
+            outcomes.update(self._collect(batch_id))
+            del open_batches[batch_id]
+            self._save_state(open_batches)
+
+        for key in unique.keys() - outcomes.keys():
+            outcomes[key] = BatchRequestError("sin resultado en el lote")
+        return outcomes
+
+    def _chunks(self, requests):
+        chunk, size = [], 0
+        for request in requests:
+            request_size = len(json.dumps(request.params))
+            if chunk and (len(chunk) >= BATCH_MAX_REQUESTS or size + request_size > BATCH_MAX_BYTES):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(request)
+            size += request_size
+        if chunk:
+            yield chunk
+
+    def _collect(self, batch_id):
+        """Espera a que el lote termine y devuelve {custom_id: Message o excepción}"""
+        started = time.monotonic()
+        while True:
+            batch = self.client.messages.batches.retrieve(batch_id)
+            if batch.processing_status == "ended":
+                break
+            if time.monotonic() - started > self.timeout_seconds:
+                raise TimeoutError(f"El lote Claude {batch_id} no terminó en {self.timeout_seconds // 3600} h")
+            counts = batch.request_counts
+            logging.info(f"Lote Claude {batch_id}: {counts.processing} en proceso, "
+                         f"{counts.succeeded} correctas, {counts.errored} con error")
+            time.sleep(self.poll_seconds)
+
+        outcomes = {}
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                outcomes[entry.custom_id] = entry.result.message
+            else:
+                error = getattr(entry.result, "error", None)
+                outcomes[entry.custom_id] = BatchRequestError(f"{entry.result.type}: {error}" if error else entry.result.type)
+        logging.info(f"Lote Claude {batch_id} terminado: {len(outcomes)} resultados")
+        return outcomes
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, open_batches):
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(open_batches, f, indent=2)
+        os.replace(tmp_path, self.state_path)
@@ -0,0 +1,102 @@
+"""
+Caché persistente de respuestas de Claude Vision.
+La clave incluye todo lo que determina la respuesta: hash del contenido del
+PDF, páginas enviadas, DPI, modelo y hash del prompt. Si cambia el prompt o
+el modelo, las entradas antiguas simplemente dejan de coincidir.
+Las entradas caducan por antigüedad (TTL) y, si el directorio supera el
+tamaño máximo, se eliminan primero las menos usadas recientemente.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+
+
+class ClaudeResponseCache:
+    EVICT_EVERY = 50  # Comprobar el tamaño total cada N escrituras
+
+    def __init__(self, cache_dir, ttl_days=90, max_mb=500):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_days * 86400
+        self.max_bytes = max_mb * 1024 * 1024
+        self._writes = 0
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry.get("created", 0) > self.ttl_seconds:
+            self._remove(path)
+            return None
+
+        # Marca de último uso para el desalojo por tamaño (LRU aproximado)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["response"]
+
+    def put(self, key, response):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"created": time.time(), "response": response}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"No se pudo guardar la respuesta de Claude en caché: {e}")
+            return
+
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 1:
+            self.evict()
+
+    def evict(self):
+        """Elimina entradas sin uso durante más del TTL y, si hace falta, las menos usadas hasta bajar del tamaño máximo"""
+        entries = []
+        now = time.time()
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if now - st.st_mtime > self.ttl_seconds:
+                    self._remove(path)
+                else:
+                    entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+        logging.info(f"Caché Claude: eliminadas {removed} respuestas antiguas (límite {self.max_bytes // (1024 * 1024)} MB)")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,80 @@
+"""
+Informe de coste real de Claude a partir de claude_usage.jsonl
+(tokens de response.usage por llamada): por proveedor, por método de
+extracción y por día, y estimación de la cola pendiente.
+
+Uso:
+    python claude_cost_report.py                  # todo el histórico
+    python claude_cost_report.py --desde 2026-01-01 --excel informe_coste.xlsx
+"""
+
+import argparse
+import pandas as pd
+from claude_usage import UsageLog, USAGE_LOG_PATH
+
+
+def summarize(calls, by):
+    summary = calls.groupby(by, dropna=False).agg(
+        llamadas=("cost_usd", "size"),
+        facturas=("pdf_path", "nunique"),
+        tokens_entrada=("input_tokens", "sum"),
+        tokens_salida=("output_tokens", "sum"),
+        imagenes=("images", "sum"),
+        mb_enviados=("bytes_sent", lambda b: round(b.sum() / 1024 / 1024, 2)),
+        latencia_media_ms=("latency_ms", "mean"),
+        coste_usd=("cost_usd", "sum")
+    )
+    summary["coste_por_factura_usd"] = summary["coste_usd"] / summary["facturas"]
+    return summary.sort_values("coste_usd", ascending=False).round(4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Informe de coste de Claude (tokens reales)")
+    parser.add_argument("--desde", help="Fecha inicial YYYY-MM-DD")
+    parser.add_argument("--excel", help="Guardar también el informe en este Excel")
+    args = parser.parse_args()
+
+    records = UsageLog(USAGE_LOG_PATH).read()
+    calls = pd.DataFrame([r for r in records if r.get("type") == "call"])
+    if calls.empty:
+        print(f"No hay llamadas registradas en {USAGE_LOG_PATH}")
+        return
+
+    calls["dia"] = calls["timestamp"].str[:10]
+    if args.desde:
+        calls = calls[calls["dia"] >= args.desde]
+    calls["proveedor"] = calls["supplier_name"].fillna("") + " (" + calls["supplier_cif"].fillna("¿?") + ")"
+    calls["metodo"] = calls["extraction_method"].fillna("") + " / " + calls["tier"]
+
+    reports = {
+        "Por proveedor": summarize(calls, "proveedor"),
+        "Por método": summarize(calls, "metodo"),
+        "Por modelo": summarize(calls, "model"),
+        "Por día": summarize(calls, "dia").sort_index()
+    }
+
+    print("=" * 80)
+    print(f"COSTE CLAUDE: {len(calls)} llamadas, {calls['pdf_path'].nunique()} facturas, "
+          f"${calls['cost_usd'].sum():.2f} USD")
+    # El prefijo fijo (herramienta + system) es más corto que el mínimo cacheable de la API,
+    # así que no se marca para caché: hoy el ahorro por caché de prompts es 0
+    cache_read = int(calls["cache_read_tokens"].sum()) if "cache_read_tokens" in calls else 0
+    if cache_read:
+        print(f"Caché de prompts: {cache_read} tokens leídos de caché")
+    else:
+        print("Caché de prompts: sin uso (el prompt fijo no alcanza el mínimo cacheable), ahorro 0")
+    print("=" * 80)
+    pd.set_option('display.width', None)
+    for title, report in reports.items():
+        print(f"\n--- {title.upper()} ---")
+        print(report.head(20).to_string())
+
+    if args.excel:
+        with pd.ExcelWriter(args.excel) as writer:
+            for title, report in reports.items():
+                report.to_excel(writer, sheet_name=title)
+        print(f"\nInforme guardado en {args.excel}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Despachador concurrente de llamadas a Claude (fallback de process_all).
+Ejecuta un bucle asyncio en un hilo propio con anthropic.AsyncAnthropic:
+  - hasta N peticiones en vuelo a la vez
+  - presupuesto de peticiones/minuto y tokens de entrada/minuto
+  - reintentos con backoff exponencial para 429, 5xx y errores de red
+El hilo principal sólo encola peticiones (submit) y sigue procesando otros
+PDFs con plantillas/regex mientras las llamadas están pendientes.
+"""
+
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+import anthropic
+from claude_extractor import record_call
+
+# Valores por defecto (ajustar al tier de la cuenta de Anthropic)
+CLAUDE_MAX_IN_FLIGHT = 4
+CLAUDE_REQUESTS_PER_MINUTE = 50
+CLAUDE_INPUT_TOKENS_PER_MINUTE = 50000
+CLAUDE_MAX_RETRIES = 5
+
+
+class DispatchCancelled(Exception):
+    """Petición descartada sin enviarse porque se canceló el procesamiento"""
+
+
+class _RateBudget:
+    """Cubo de tokens que se rellena de forma continua hasta `per_minute` unidades por minuto"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1, cancelled=None):
+        """
+        Espera a que haya presupuesto y lo consume
+
+        Args:
+            cancelled: asyncio.Event que interrumpe la espera
+        Returns:
+            False si se interrumpió por cancelled (sin consumir presupuesto)
+        """
+        # Una petición más grande que el presupuesto entero espera al cubo lleno
+        amount = min(float(amount), self.capacity)
+        while True:
+            self._refill()
+            if self.available >= amount:
+                self.available -= amount
+                return True
+            if await _sleep_unless(cancelled, (amount - self.available) / self.rate):
+                return False
+
+
+async def _sleep_unless(event, seconds):
+    """Duerme seconds o hasta que se active event. True si se despertó por el evento"""
+    if event is None:
+        await asyncio.sleep(seconds)
+        return False
+    try:
+        await asyncio.wait_for(event.wait(), seconds)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def is_retryable(error):
+    """429 (límite de la cuenta), 5xx/529 (sobrecarga) y errores de red/timeout"""
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class ClaudeDispatcher:
+    def __init__(self, client_factory, max_in_flight=CLAUDE_MAX_IN_FLIGHT,
+                 requests_per_minute=CLAUDE_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=CLAUDE_INPUT_TOKENS_PER_MINUTE,
+                 max_retries=CLAUDE_MAX_RETRIES):
+        """
+        Args:
+            client_factory: función que crea el cliente AsyncAnthropic (se llama dentro del hilo del bucle)
+            max_in_flight: peticiones simultáneas como máximo
+            requests_per_minute / tokens_per_minute: presupuesto de la cuenta
+            max_retries: reintentos para 429/5xx/errores de red
+        """
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.stats = Counter()
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="claude-dispatcher", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(
+            self._init_async(client_factory, requests_per_minute, tokens_per_minute), self._loop).result()
+
+    async def _init_async(self, client_factory, requests_per_minute, tokens_per_minute):
+        self._client = client_factory()
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._requests_budget = _RateBudget(requests_per_minute)
+        self._tokens_budget = _RateBudget(tokens_per_minute)
+        # Despierta a las peticiones que esperan presupuesto o un reintento
+        self._cancelled = asyncio.Event()
+
+    def submit(self, request):
+        """Encola una ClaudeRequest. Devuelve un concurrent.futures.Future con la respuesta de la API"""
+        return asyncio.run_coroutine_threadsafe(self._send(request), self._loop)
+
+    async def _send(self, request):
+        async with self._slots:
+            for attempt in range(self.max_retries + 1):
+                # Comprobar la cancelación antes de esperar presupuesto: una espera puede durar un minuto
+                if (self._cancelled.is_set()
+                        or not await self._requests_budget.acquire(cancelled=self._cancelled)
+                        or not await self._tokens_budget.acquire(request.estimated_tokens, self._cancelled)):
+                    raise DispatchCancelled(request.pdf_name)
+                self._track_in_flight(+1)
+                try:
+                    started = time.perf_counter()
+                    response = await self._client.messages.create(**request.params)
+                    # Llamadas que han respondido; los intentos fallidos se cuentan en retries
+                    self.stats["api_calls"] += 1
+                    # Latencia por nivel y por modelo para el resumen de la ejecución
+                    record_call(self.stats, request, time.perf_counter() - started)
+                    return response
+                except anthropic.APIError as e:
+                    if not is_retryable(e) or attempt >= self.max_retries:
+                        raise
+                    delay = self._retry_delay(e, attempt)
+                    self.stats["retries"] += 1
+                    logging.warning(f"Claude API {type(e).__name__} para {request.pdf_name}. "
+                                    f"Reintento {attempt + 1}/{self.max_retries} en {delay:.1f}s")
+                finally:
+                    self._track_in_flight(-1)
+                if await _sleep_unless(self._cancelled, delay):
+                    raise DispatchCancelled(request.pdf_name)
+
+    def cancel_pending(self):
+        """Las peticiones aún en cola fallan con DispatchCancelled; las que están en vuelo terminan"""
+        self._loop.call_soon_threadsafe(self._cancelled.set)
+
+    def _track_in_flight(self, delta):
+        with self._lock:
+            self.in_flight += delta
+
+    @staticmethod
+    def _retry_delay(error, attempt):
+        # Respetar retry-after del servidor si lo envía; si no, backoff exponencial con jitter
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            try:
+                return max(0.0, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+        return min(60.0, 2 ** attempt) + random.uniform(0, 1)
+
+    def drain_stats(self):
+        stats, self.stats = self.stats, Counter()
+        return stats
+
+    def close(self):
+        async def _shutdown():
+            await self._client.close()
+        try:
+            asyncio.run_coroutine_threadsafe(_shutdown(), self._loop).result(timeout=10)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=10)
+        # Cerrar un bucle que sigue en marcha lanza RuntimeError: si no ha parado, se deja al hilo daemon
+        if not self._thread.is_alive():
+            self._loop.close()
+        else:
+            logging.warning("El despachador de Claude no se detuvo a tiempo; se abandona su bucle")
@@ -4,199 +4,798 @@ Este módulo se usa como FALLBACK cuando no hay plantillas para un proveedor
 """
 
 import os
+import re
+import time
 import base64
 import json
+import hashlib
 import logging
+from collections import Counter
+from datetime import datetime
 from pathlib import Path
 from dotenv import load_dotenv
 import anthropic
+from claude_cache import ClaudeResponseCache
+from claude_batch import ClaudeBatchRunner
+from pdf_document import InvoiceDocument
+from run_metrics import METRICS
 
 # Cargar variables de entorno
 load_dotenv()
 
+# Servidor alternativo (p.ej. claude_stub_server.py para pruebas de carga sin red); None = API real
+CLAUDE_BASE_URL = os.getenv('ANTHROPIC_BASE_URL') or None
+
+# Caché local de respuestas (evita pagar dos veces por el mismo documento)
+CLAUDE_CACHE_DIR = r"c:\Proyectos\Proveedores\cache\claude"
+CLAUDE_CACHE_TTL_DAYS = 90
+CLAUDE_CACHE_MAX_MB = 500
+
+# Imágenes para Vision: tamaño efectivo de la API (por encima reescala) y codificación
+CLAUDE_IMAGE_MAX_EDGE = 1568        # px del lado largo
+CLAUDE_IMAGE_MAX_PIXELS = 1150000   # ~1,15 megapíxeles
+CLAUDE_IMAGE_FORMAT = "jpeg"        # "jpeg", "webp" o "png"
+CLAUDE_IMAGE_QUALITY = 85           # calidad JPEG/WebP (1-100)
+CLAUDE_IMAGE_GRAYSCALE = True       # las facturas se leen igual en gris y pesan ~1/3
+LEGACY_IMAGE_DPI = 300              # renderizado anterior (RGB a 300 DPI): referencia del ahorro en bytes
+IMAGE_MEDIA_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+# Lotes (Message Batches) enviados y aún no recogidos
+CLAUDE_BATCH_STATE_PATH = r"c:\Proyectos\Proveedores\cache\claude_batches.json"
+
+# Nivel de texto: si la capa de texto del PDF es buena se envía el texto en vez de imágenes
+CLAUDE_TEXT_TIER = True
+CLAUDE_TEXT_MIN_CHARS = 150       # menos texto que esto suele ser un escaneo sin OCR
+CLAUDE_TEXT_MIN_CLEAN_RATIO = 0.9 # proporción de caracteres "normales" (letras, dígitos, puntuación)
+CLAUDE_TEXT_MAX_CHARS = 6000      # por encima se recorta a cabecera + líneas con datos + pie
+TEXT_KEY_LINE_PATTERN = re.compile(
+    r'FACTURA|INVOICE|FECHA|C\.?I\.?F|N\.?I\.?F|TOTAL|BASE|I\.?V\.?A|IMPORTE|CUOTA|NETO', re.IGNORECASE)
+TEXT_AMOUNT_PATTERN = re.compile(r'\d[.,]\d{2}\b')
+
+# Salida estructurada: Claude rellena la herramienta en vez de escribir JSON libre
+INVOICE_TOOL_NAME = "registrar_factura"
+INVOICE_FIELDS = {
+    "supplier_tax_id": "CIF o NIF del proveedor/emisor (nunca el del cliente JOFEG)",
+    "invoice_number": "Número de factura",
+    "invoice_date": "Fecha de la factura tal como aparece",
+    "base_imponible": "Base imponible sin IVA",
+    "iva_importe": "Importe del IVA",
+    "total_amount": "Importe total con IVA",
+    "currency": "EUR u otra moneda"
+}
+JSON_OBJECT_PATTERN = re.compile(r'\{.*\}', re.DOTALL)
+
+# Enrutado de modelos: se empieza por el más rápido/barato y sólo se escala al siguiente
+# si la respuesta tiene confianza baja o los importes no cuadran (base + IVA ≈ total)
+CLAUDE_MODEL_ROUTE = ["claude-3-haiku-20240307", "claude-3-5-sonnet-20241022"]
+# USD por millón de tokens (entrada, salida); los lotes cuestan la mitad
+CLAUDE_MODEL_PRICES = {
+    "claude-3-haiku-20240307": (0.25, 1.25),
+    "claude-3-5-sonnet-20241022": (3.0, 15.0)
+}
+AMOUNT_TOLERANCE = 0.02  # céntimos de redondeo admitidos en base + IVA = total
+
+
+def parse_amount(value):
+    """
+    Convierte un importe tal como aparece en la factura a float
+    ("1.234,56", "1,234.56", "121,00 €", "-50.5") o None si no es un importe
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    cleaned = re.sub(r'[^0-9,.\-]', '', str(value))
+    if not re.search(r'\d', cleaned):
+        return None
+    # El último separador es el decimal si le siguen 1-2 dígitos; el resto son miles
+    last = max(cleaned.rfind(','), cleaned.rfind('.'))
+    if last >= 0 and 0 < len(cleaned) - last - 1 <= 2:
+        integer, decimals = cleaned[:last], cleaned[last + 1:]
+    else:
+        integer, decimals = cleaned, ""
+    integer = re.sub(r'[,.]', '', integer)
+    try:
+        return float(f"{integer}.{decimals}" if decimals else integer)
+    except ValueError:
+        return None
+
+
+def record_call(stats, request, seconds):
+    """Acumula llamadas y latencia por nivel (texto / visión / zonas) y por modelo en un Counter (y en las métricas de la ejecución)"""
+    ms = int(seconds * 1000)
+    request.latency_ms = ms
+    METRICS.add("claude_call", seconds)
+    stats[f"calls_{request.tier}"] += 1
+    stats[f"ms_{request.tier}"] += ms
+    stats[f"calls_model_{request.model}"] += 1
+    stats[f"ms_model_{request.model}"] += ms
+
+
+# Recortes de zonas de plantilla (Caso B): margen alrededor del bbox en puntos PDF.
+# Más margen horizontal porque un importe más largo que el de la plantilla crece hacia los lados
+REGION_PAD_X = 60
+REGION_PAD_Y = 6
+REGION_ZOOM = 3          # 216 DPI: los recortes son pequeños, se pueden renderizar nítidos
+REGION_LABEL_HEIGHT = 14
+REGION_FIELD_LABELS = {
+    "base_imponible": "Base imponible",
+    "iva_importe": "Importe IVA",
+    "total_amount": "Total factura"
+}
+
+class ClaudeRequest:
+    """Petición a Claude ya preparada (imágenes renderizadas) pendiente de envío"""
+    def __init__(self, pdf_name, cache_key, params, estimated_tokens, fields=None, tier="vision"):
+        self.pdf_name = pdf_name
+        self.cache_key = cache_key
+        self.params = params  # kwargs de client.messages.create
+        self.estimated_tokens = estimated_tokens
+        self.fields = fields  # Campos pedidos en una petición por zonas (None = factura completa)
+        self.tier = tier      # "text", "vision" o "regions" (para el resumen por nivel)
+        self.model = params["model"]
+        self.batch = False    # Enviada por la Message Batches API (mitad de precio)
+        self.pdf_path = None
+        self.latency_ms = None
+        # Para el registro de uso: imágenes y bytes realmente enviados
+        messages = params.get("messages") or []
+        content = messages[0]["content"] if messages else None
+        self.images = sum(1 for block in content if block.get("type") == "image") if isinstance(content, list) else 0
+        self.payload_bytes = len(json.dumps(params))
+
+
 class ClaudeIDPExtractor:
-    def __init__(self):
+    def __init__(self, base_url=None):
+        """
+        Args:
+            base_url: servidor de la API (por defecto CLAUDE_BASE_URL, es decir ANTHROPIC_BASE_URL o la API real)
+        """
+        self.base_url = base_url or CLAUDE_BASE_URL
         api_key = os.getenv('ANTHROPIC_API_KEY')
+        if not api_key and self.base_url:
+            api_key = "sk-stub"  # el servidor de pruebas no comprueba la clave
         if not api_key:
             raise ValueError("ANTHROPIC_API_KEY no encontrada en .env")
         
-        self.client = anthropic.Anthropic(api_key=api_key)
-        self.model = "claude-3-haiku-20240307"  # Modelo económico con Vision
+        self.api_key = api_key
+        self.client = anthropic.Anthropic(api_key=api_key, base_url=self.base_url)
+        self.models = list(CLAUDE_MODEL_ROUTE)
+        self.model = self.models[0]  # Modelo económico con Vision (primer paso del enrutado)
+        self.dpi = 300  # Máximo; la resolución real se adapta al tamaño de la página
+        self.image_format = CLAUDE_IMAGE_FORMAT
+        self.image_quality = CLAUDE_IMAGE_QUALITY
+        self.grayscale = CLAUDE_IMAGE_GRAYSCALE
+        self.text_tier = CLAUDE_TEXT_TIER
+        cache_dir = CLAUDE_CACHE_DIR
+        if self.base_url:
+            # Las respuestas de un servidor de pruebas no deben acabar en la caché de las reales
+            logging.warning(f"Claude API apuntando a {self.base_url} (no es la API de Anthropic)")
+            cache_dir = f"{CLAUDE_CACHE_DIR}_{hashlib.sha256(self.base_url.encode()).hexdigest()[:12]}"
+        self.response_cache = ClaudeResponseCache(cache_dir, CLAUDE_CACHE_TTL_DAYS, CLAUDE_CACHE_MAX_MB)
+        # Contadores de la ejecución (los recoge el procesador con drain_stats)
+        self.stats = Counter()
+        # Registros de uso por llamada (los recoge el procesador con drain_usage)
+        self.usage_records = []
+
+    def drain_stats(self):
+        """Devuelve los contadores acumulados y los reinicia"""
+        stats, self.stats = self.stats, Counter()
+        return stats
+
+    def drain_usage(self):
+        """Devuelve los registros de uso por llamada acumulados y los vacía"""
+        records, self.usage_records = self.usage_records, []
+        return records
         
-    def extract_from_pdf(self, pdf_path, max_pages=3):
+    def extract_from_pdf(self, pdf_path, max_pages=3, document=None, regions=None, text=None, model=None):
         """
         Extrae datos de factura usando Claude Vision
         
         Args:
             pdf_path: Ruta al PDF
             max_pages: Número máximo de páginas a analizar (para controlar costes)
+            document: Documento ya abierto por el procesador (evita reabrir el PDF)
+            regions: {campo: bbox} de la plantilla; si se indica sólo se envían esas zonas
+            text: capa de texto ya extraída; si es de calidad se envía texto en vez de imágenes
+            model: modelo a usar (por defecto el primero de CLAUDE_MODEL_ROUTE)
         
         Returns:
             dict con campos extraídos
         """
+        request = self.prepare_request(pdf_path, max_pages, document, regions, text, model)
+        if request is None or isinstance(request, dict):
+            # Error preparando la petición (None) o respuesta en caché (dict)
+            result = request
+        else:
+            try:
+                logging.info(f"Llamando a Claude API ({request.tier}, {request.model}) para {request.pdf_name}")
+                started = time.perf_counter()
+                response = self.client.messages.create(**request.params)
+                self.stats["api_calls"] += 1  # Sólo las que responden: los fallos van a api_errors
+                record_call(self.stats, request, time.perf_counter() - started)
+            except Exception as e:
+                self.stats["api_errors"] += 1
+                logging.error(f"Error en Claude API para {pdf_path}: {e}")
+                return None
+            result = self.handle_response(request, response)
+
+        return self.escalate(result, pdf_path, max_pages, document, regions, text)
+
+    def escalate(self, result, pdf_path, max_pages=3, document=None, regions=None, text=None):
+        """
+        Repite la extracción en un nivel o modelo superior si la respuesta no es fiable:
+          - nivel de texto sin CIF/total fiables -> imágenes (mismo modelo de entrada)
+          - confianza baja o base + IVA != total -> siguiente modelo de CLAUDE_MODEL_ROUTE
+        Si el modelo superior falla se conserva la respuesta anterior.
+        """
+        if not result:
+            return result
+        pdf_name = Path(pdf_path).name
+
+        if result.get("extraction_method") == "CLAUDE_TEXT" and not self._text_result_ok(result):
+            logging.info(f"Claude (texto) sin datos suficientes para {pdf_name}. Escalando a Vision")
+            self.stats["text_escalations"] += 1
+            return self.extract_from_pdf(pdf_path, max_pages, document, regions) or result
+
+        problem = self.quality_problem(result)
+        model = result.get("claude_model", self.models[0])
+        if not problem or model not in self.models or model == self.models[-1]:
+            return result
+
+        stronger = self.models[self.models.index(model) + 1]
+        logging.info(f"Claude ({model}) en {pdf_name}: {problem}. Escalando a {stronger}")
+        self.stats["model_escalations"] += 1
+        text = text if result.get("extraction_method") == "CLAUDE_TEXT" else None
+        return self.extract_from_pdf(pdf_path, max_pages, document, regions, text, stronger) or result
+
+    @staticmethod
+    def quality_problem(result):
+        """Motivo por el que una respuesta no es fiable (confianza baja o importes que no cuadran) o None"""
+        if result.get("confidence") == "low":
+            return "confianza baja"
+        base, iva, total = (parse_amount(result.get(field)) for field in ("base_imponible", "iva_importe", "total_amount"))
+        if None not in (base, iva, total) and abs(base + iva - total) > max(AMOUNT_TOLERANCE, abs(total) * 0.001):
+            return f"base + IVA ({base + iva:.2f}) no cuadra con el total ({total:.2f})"
+        return None
+
+    @staticmethod
+    def _text_result_ok(result):
+        return bool(result and result.get("supplier_tax_id") and result.get("total_amount")
+                    and result.get("confidence") != "low")
+
+    @staticmethod
+    def text_is_usable(text):
+        """
+        Heurística de calidad de la capa de texto: suficiente texto, pocos caracteres
+        basura (fuentes sin mapa Unicode, "(cid:12)") y al menos un importe legible
+        """
+        if not text:
+            return False
+        stripped = text.strip()
+        if len(stripped) < CLAUDE_TEXT_MIN_CHARS or "(cid:" in stripped:
+            return False
+        clean = sum(1 for c in stripped if c.isalnum() or c.isspace() or c in ".,:;-/()%€$ºª'\"#&*+")
+        if clean / len(stripped) < CLAUDE_TEXT_MIN_CLEAN_RATIO:
+            return False
+        return bool(TEXT_AMOUNT_PATTERN.search(stripped))
+
+    @staticmethod
+    def _trim_text(text, max_chars=CLAUDE_TEXT_MAX_CHARS):
+        """Cabecera + líneas con datos (CIF, fechas, importes) y sus vecinas + pie, en el orden original"""
+        if len(text) <= max_chars:
+            return text
+        lines = [line for line in text.splitlines() if line.strip()]
+        keep = set(range(min(40, len(lines)))) | set(range(max(0, len(lines) - 30), len(lines)))
+        for i, line in enumerate(lines):
+            if TEXT_KEY_LINE_PATTERN.search(line):
+                keep.update((i - 1, i, i + 1))
+        trimmed = "\n".join(lines[i] for i in sorted(keep) if 0 <= i < len(lines))
+        return trimmed[:max_chars]
+
+    def prepare_request(self, pdf_path, max_pages=3, document=None, regions=None, text=None, model=None):
+        """
+        Prepara la llamada a Claude sin enviarla (para el envío síncrono, concurrente o por lotes)
+
+        Args:
+            regions: {campo: bbox} de la plantilla (página 1) para pedir sólo esos campos
+            text: capa de texto; si pasa la heurística de calidad se usa el nivel de texto
+            model: modelo a usar (por defecto el primero de CLAUDE_MODEL_ROUTE)
+
+        Returns:
+            dict con los campos si la respuesta ya está en caché,
+            ClaudeRequest con los parámetros de messages.create, o None si hubo error
+        """
+        owns_document = document is None
         try:
-            # Convertir PDF a imágenes
-            images = self._pdf_to_images(pdf_path, max_pages)
-            
-            # Preparar prompt especializado
-            prompt = self._build_extraction_prompt()
-            
-            # Preparar contenido del mensaje con imágenes
-            content = []
-            for img_data in images:
-                content.append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/png",
-                        "data": img_data
-                    }
-                })
+            if owns_document:
+                document = InvoiceDocument(pdf_path)
+
+            model = model or self.model
+            if regions:
+                return self._with_path(self._prepare_region_request(pdf_path, document, regions, model), pdf_path)
+            if text and self.text_tier and self.text_is_usable(text):
+                return self._with_path(self._prepare_text_request(pdf_path, document, text, model), pdf_path)
+
+            # Instrucciones fijas (system en caché) + herramienta con el esquema de salida
+            system = self._build_extraction_prompt()
+            tool = self._invoice_tool()
+
+            # Caché: mismo contenido + mismas páginas/renderizado/modelo/prompt = misma respuesta
+            page_indices = self._select_pages(len(document), max_pages)
+            cache_key = self.response_cache.make_key(
+                document.content_hash, page_indices, self._render_settings(), model,
+                self._prompt_hash(system, tool)
+            )
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                self.stats["cache_hits"] += 1
+                logging.info(f"Claude API (caché): respuesta reutilizada para {Path(pdf_path).name}")
+                return cached
+            self.stats["cache_misses"] += 1
+
+            # Convertir PDF a imágenes (contenido del mensaje: imágenes + petición breve)
+            with METRICS.span("claude_render"):
+                content, image_tokens = self._pdf_to_images(pdf_path, max_pages, document)
             
             content.append({
                 "type": "text",
-                "text": prompt
+                "text": "Extrae los datos de esta factura."
             })
-            
-            # Llamar a Claude API
-            logging.info(f"Llamando a Claude API para {Path(pdf_path).name}")
-            
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=1024,
-                messages=[{
-                    "role": "user",
-                    "content": content
-                }]
-            )
-            
-            # Parsear respuesta JSON
-            result_text = response.content[0].text
-            result = json.loads(result_text)
-            
-            logging.info(f"Claude API extrajo: CIF={result.get('supplier_tax_id')}")
-            
-            return {
-                "supplier_tax_id": result.get('supplier_tax_id'),
-                "invoice_number": result.get('invoice_number'),
-                "invoice_date": result.get('invoice_date'),
-                "base_imponible": result.get('base_imponible'),
-                "iva_importe": result.get('iva_importe'),
-                "total_amount": result.get('total_amount'),
-                "currency": result.get('currency', 'EUR'),
-                "extraction_method": "CLAUDE_API",
-                "confidence": result.get('confidence', 'medium')
-            }
-            
+
+            params = self._message_params(model, system, tool, content, max_tokens=512)
+            # Estimación para el presupuesto de tokens/minuto: imágenes + texto
+            estimated_tokens = image_tokens + len(system) // 3
+            return self._with_path(ClaudeRequest(Path(pdf_path).name, cache_key, params, estimated_tokens), pdf_path)
+
         except Exception as e:
+            self.stats["api_errors"] += 1
             logging.error(f"Error en Claude API para {pdf_path}: {e}")
             return None
+        finally:
+            if owns_document and document is not None:
+                document.close()
+
+    @staticmethod
+    def _with_path(request, pdf_path):
+        if isinstance(request, ClaudeRequest):
+            request.pdf_path = str(pdf_path)
+        return request
+
+    def _prepare_text_request(self, pdf_path, document, text, model):
+        """Petición sólo de texto: la capa de texto (recortada) sin imágenes, mucho más barata"""
+        trimmed = self._trim_text(text)
+        system = self._build_extraction_prompt()
+        tool = self._invoice_tool()
+        cache_key = self.response_cache.make_key(
+            document.content_hash, "text", model, self._prompt_hash(system, tool),
+            hashlib.sha256(trimmed.encode()).hexdigest()
+        )
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            self.stats["cache_hits"] += 1
+            logging.info(f"Claude API (caché): respuesta de texto reutilizada para {Path(pdf_path).name}")
+            return cached
+        self.stats["cache_misses"] += 1
+
+        content = f"Texto extraído de la factura:\n<factura>\n{trimmed}\n</factura>"
+        params = self._message_params(model, system, tool, content, max_tokens=512)
+        logging.info(f"Nivel texto para {Path(pdf_path).name}: {len(trimmed)} de {len(text)} caracteres")
+        return ClaudeRequest(Path(pdf_path).name, cache_key, params, (len(system) + len(content)) // 3, tier="text")
+
+    def _prepare_region_request(self, pdf_path, document, regions, model):
+        """Petición por zonas: una imagen compuesta con los recortes de la plantilla y un prompt mínimo"""
+        fields = sorted(regions)
+        system = self._build_region_prompt()
+        tool = self._invoice_tool(fields)
+        cache_key = self.response_cache.make_key(
+            document.content_hash, "regions", [[field, list(regions[field])] for field in fields],
+            self._render_settings(), REGION_ZOOM, model, self._prompt_hash(system, tool)
+        )
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            self.stats["cache_hits"] += 1
+            logging.info(f"Claude API (caché): respuesta por zonas reutilizada para {Path(pdf_path).name}")
+            return cached
+        self.stats["cache_misses"] += 1
+
+        with METRICS.span("claude_render"):
+            image, image_tokens = self._regions_to_image(pdf_path, document, regions, fields)
+        content = [image, {"type": "text", "text": "Lee los importes de los recortes."}]
+        params = self._message_params(model, system, tool, content, max_tokens=256)
+        estimated_tokens = image_tokens + len(system) // 3
+        return ClaudeRequest(Path(pdf_path).name, cache_key, params, estimated_tokens, fields=fields, tier="regions")
+
+    def handle_response(self, request, response, duplicate=False):
+        """Parsea la respuesta de la API para una petición preparada y la guarda en caché
+
+        Args:
+            duplicate: la respuesta es de otra factura con el mismo contenido (misma cache_key) cuyo
+                uso ya se registró: cuenta como acierto de caché y no vuelve a sumar tokens ni coste
+        """
+        if duplicate:
+            self.stats["cache_hits"] += 1
+        else:
+            self._record_usage(request, response)
+        result = self._parse_response(response)
+        if result is None:
+            self.stats["api_errors"] += 1
+            logging.error(f"Error en Claude API para {request.pdf_name}: respuesta sin datos de factura")
+            return None
+
+        if request.fields:
+            # Petición por zonas: sólo los campos pedidos, el resto lo aporta la plantilla
+            extracted = {field: result.get(field) for field in request.fields}
+            logging.info(f"Claude API (zonas) extrajo: {extracted}")
+            extracted.update({"extraction_method": "CLAUDE_REGIONS", "confidence": result.get('confidence', 'medium'),
+                              "claude_model": request.model})
+            self.response_cache.put(request.cache_key, extracted)
+            return extracted
+
+        logging.info(f"Claude API extrajo: CIF={result.get('supplier_tax_id')}")
+        
+        extracted = {
+            "supplier_tax_id": result.get('supplier_tax_id'),
+            "invoice_number": result.get('invoice_number'),
+            "invoice_date": result.get('invoice_date'),
+            "base_imponible": result.get('base_imponible'),
+            "iva_importe": result.get('iva_importe'),
+            "total_amount": result.get('total_amount'),
+            "currency": result.get('currency', 'EUR'),
+            "extraction_method": "CLAUDE_TEXT" if request.tier == "text" else "CLAUDE_API",
+            "confidence": result.get('confidence', 'medium'),
+            "claude_model": request.model
+        }
+        self.response_cache.put(request.cache_key, extracted)
+        return extracted
+
+    def _record_usage(self, request, response):
+        """Tokens reales (response.usage), coste estimado (USD) y registro de la llamada"""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        input_tokens = getattr(usage, "input_tokens", 0) or 0
+        output_tokens = getattr(usage, "output_tokens", 0) or 0
+        cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        cost = self.call_cost(request.model, input_tokens, output_tokens, cache_read, cache_write, request.batch)
+
+        self.stats[f"tokens_in_model_{request.model}"] += input_tokens + cache_read + cache_write
+        self.stats[f"tokens_out_model_{request.model}"] += output_tokens
+        self.stats[f"cost_model_{request.model}"] += cost
+        self.usage_records.append({
+            "type": "call",
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "pdf_path": request.pdf_path,
+            "pdf_name": request.pdf_name,
+            "tier": request.tier,
+            "model": request.model,
+            "batch": request.batch,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cache_read_tokens": cache_read,
+            "cache_write_tokens": cache_write,
+            "images": request.images,
+            "bytes_sent": request.payload_bytes,
+            "latency_ms": request.latency_ms,
+            "cost_usd": round(cost, 6)
+        })
+
+    @staticmethod
+    def call_cost(model, input_tokens, output_tokens, cache_read=0, cache_write=0, batch=False):
+        """Coste en USD: lectura de caché al 10% y escritura al 125% del precio de entrada; lotes a mitad"""
+        price_in, price_out = CLAUDE_MODEL_PRICES.get(model, (0.0, 0.0))
+        cost = (input_tokens * price_in + cache_write * price_in * 1.25
+                + cache_read * price_in * 0.1 + output_tokens * price_out) / 1e6
+        return cost / 2 if batch else cost
+
+    @staticmethod
+    def _parse_response(response):
+        """
+        Campos de la respuesta: la entrada de la herramienta si Claude la usó; si no,
+        el primer objeto JSON del texto (tolerando ```json``` o frases alrededor)
+        """
+        texts = []
+        for block in response.content:
+            if getattr(block, "type", None) == "tool_use" and isinstance(block.input, dict):
+                return block.input
+            if getattr(block, "type", None) == "text":
+                texts.append(block.text)
+        match = JSON_OBJECT_PATTERN.search("\n".join(texts))
+        if not match:
+            return None
+        try:
+            result = json.loads(match.group())
+        except ValueError:
+            return None
+        return result if isinstance(result, dict) else None
+
+    @staticmethod
+    def _message_params(model, system, tool, content, max_tokens):
+        """kwargs de messages.create con salida forzada por la herramienta"""
+        return {
+            "model": model,
+            "max_tokens": max_tokens,
+            # Sin cache_control: herramienta + system (~300 tokens) no llegan al mínimo cacheable
+            # de la API (1024-2048 según modelo), así que el marcador nunca crearía una entrada
+            "system": system,
+            "tools": [tool],
+            "tool_choice": {"type": "tool", "name": tool["name"]},
+            "messages": [{"role": "user", "content": content}]
+        }
+
+    @staticmethod
+    def _invoice_tool(fields=None):
+        """Herramienta cuyo esquema es la salida esperada (todos los campos o sólo los pedidos)"""
+        fields = list(fields or INVOICE_FIELDS)
+        properties = {
+            field: {"type": ["string", "null"], "description": INVOICE_FIELDS.get(field, field)}
+            for field in fields
+        }
+        properties["confidence"] = {"type": "string", "enum": ["high", "medium", "low"],
+                                    "description": "Confianza en los datos extraídos"}
+        return {
+            "name": INVOICE_TOOL_NAME,
+            "description": "Registra los datos extraídos de la factura. Usa null si un campo no es visible o legible.",
+            "input_schema": {"type": "object", "properties": properties, "required": fields + ["confidence"]}
+        }
+
+    @staticmethod
+    def _prompt_hash(system, tool):
+        """Huella de instrucciones + esquema para la clave de caché de respuestas"""
+        return hashlib.sha256(json.dumps([system, tool], sort_keys=True).encode()).hexdigest()
+
+    def run_batch(self, requests):
+        """
+        Envía las peticiones preparadas por la Message Batches API y espera los resultados
+
+        Args:
+            requests: lista de ClaudeRequest
+
+        Returns:
+            dict cache_key -> Message de la API, o excepción si esa petición falló
+        """
+        for request in requests:
+            request.batch = True
+        runner = ClaudeBatchRunner(self.client, CLAUDE_BATCH_STATE_PATH)
+        outcomes = runner.run(requests)
+        self.stats["batch_requests"] += len(outcomes)
+        return outcomes
+
+    def make_async_client(self):
+        """Cliente asíncrono para el despachador concurrente (los reintentos los gestiona el despachador)"""
+        return anthropic.AsyncAnthropic(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+
+    @staticmethod
+    def _select_pages(num_pages, max_pages=3):
+        """
+        Estrategia de selección de páginas:
+        Si hay pocas páginas, procesar todas.
+        Si hay muchas, priorizar la Primera (cabecera) y las Últimas (totales).
+        """
+        if num_pages <= max_pages:
+            return list(range(num_pages))
+
+        # Siempre la primera página
+        page_indices = [0]
+        # Y las últimas (max_pages - 1) páginas
+        remaining_slots = max_pages - 1
+        if remaining_slots > 0:
+            start_from = max(1, num_pages - remaining_slots)
+            page_indices.extend(range(start_from, num_pages))
+        
+        # Asegurar orden y unicidad
+        return sorted(set(page_indices))
     
-    def _pdf_to_images(self, pdf_path, max_pages=3):
-        """Convierte páginas del PDF a imágenes base64"""
+    def _render_settings(self):
+        """Parámetros de renderizado que cambian la imagen enviada (forman parte de la clave de caché)"""
+        return [self.dpi, CLAUDE_IMAGE_MAX_EDGE, CLAUDE_IMAGE_MAX_PIXELS,
+                self.image_format, self.image_quality, self.grayscale]
+
+    def _page_dpi(self, page):
+        """
+        DPI para que la página quepa en el tamaño efectivo de imagen de la API.
+        Por encima de ~1568 px de lado largo o ~1,15 MP Claude reescala la imagen,
+        así que renderizar más sólo añade bytes y tiempo de codificación.
+        """
+        width, height = page.rect.width / 72, page.rect.height / 72  # pulgadas
+        dpi_edge = CLAUDE_IMAGE_MAX_EDGE / max(width, height)
+        dpi_pixels = (CLAUDE_IMAGE_MAX_PIXELS / (width * height)) ** 0.5
+        return min(self.dpi, dpi_edge, dpi_pixels)
+
+    @staticmethod
+    def _image_tokens(width, height):
+        """Tokens de imagen según la API (~ancho*alto/750 tras su reescalado)"""
+        scale = min(1.0, CLAUDE_IMAGE_MAX_EDGE / max(width, height),
+                    (CLAUDE_IMAGE_MAX_PIXELS / (width * height)) ** 0.5)
+        return int(width * scale * height * scale / 750)
+
+    def _encode_pixmap(self, pix):
+        """Codifica directamente desde el Pixmap de PyMuPDF (PIL sólo hace falta para WebP)"""
+        if self.image_format == "jpeg":
+            return pix.tobytes("jpeg", jpg_quality=self.image_quality)
+        if self.image_format == "webp":
+            from PIL import Image
+            import io
+            mode = "L" if pix.n == 1 else "RGB"
+            buffer = io.BytesIO()
+            Image.frombytes(mode, [pix.width, pix.height], pix.samples).save(
+                buffer, format="WEBP", quality=self.image_quality)
+            return buffer.getvalue()
+        return pix.tobytes("png")
+
+    def _pdf_to_images(self, pdf_path, max_pages=3, document=None):
+        """
+        Convierte páginas del PDF a imágenes base64 con resolución adaptativa
+
+        Returns:
+            (lista de bloques de imagen para la API, tokens de imagen estimados)
+        """
         import fitz  # PyMuPDF
-        from PIL import Image
-        import io
-        
+
         images = []
-        doc = fitz.open(pdf_path)
+        # Reutilizar el documento abierto por el procesador si lo hay
+        doc = document if document is not None else fitz.open(pdf_path)
         
         num_pages = len(doc)
-        
-        # Estrategia de selección de páginas:
-        # Si hay pocas páginas, procesar todas.
-        # Si hay muchas, priorizar la Primera (cabecera) y las Últimas (totales).
-        if num_pages <= max_pages:
-            page_indices = range(num_pages)
-        else:
-            # Siempre la primera página
-            page_indices = [0]
-            # Y las últimas (max_pages - 1) páginas
-            remaining_slots = max_pages - 1
-            if remaining_slots > 0:
-                start_from = max(1, num_pages - remaining_slots)
-                page_indices.extend(range(start_from, num_pages))
-            
-            # Asegurar orden y unicidad
-            page_indices = sorted(list(set(page_indices)))
+        page_indices = self._select_pages(num_pages, max_pages)
             
         logging.info(f"Procesando páginas {page_indices} de {num_pages} totales para {Path(pdf_path).name}")
         
+        colorspace = fitz.csGRAY if self.grayscale else fitz.csRGB
+        total_bytes = total_tokens = legacy_bytes = 0
         for page_num in page_indices:
             page = doc[page_num]
             
-            # Renderizar página a imagen (300 DPI para buena calidad)
-            pix = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72))
-            
-            # Convertir a PIL Image
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            
-            # Convertir a base64
-            buffer = io.BytesIO()
-            img.save(buffer, format='PNG')
-            img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-            
-            images.append(img_base64)
-        
-        doc.close()
-        return images
-    
+            # Renderizar a la resolución que la API va a usar de verdad (en gris si se configura)
+            zoom = self._page_dpi(page) / 72
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=False)
+            data = self._encode_pixmap(pix)
+
+            images.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": IMAGE_MEDIA_TYPES[self.image_format],
+                    "data": base64.b64encode(data).decode('utf-8')
+                }
+            })
+            total_bytes += len(data)
+            total_tokens += self._image_tokens(pix.width, pix.height)
+            # Estimación sin segundo renderizado: píxeles RGB sin comprimir a 300 DPI. Los tokens no se
+            # comparan: la API reescala igual una página a 300 DPI, el ahorro está en bytes y codificación
+            legacy_bytes += int(page.rect.width * LEGACY_IMAGE_DPI / 72) * int(page.rect.height * LEGACY_IMAGE_DPI / 72) * 3
+
+        if document is None:
+            doc.close()
+
+        self.stats["image_documents"] += 1
+        self.stats["image_bytes"] += total_bytes
+        self.stats["image_tokens"] += total_tokens
+        self.stats["image_bytes_legacy"] += legacy_bytes
+        logging.info(f"Imágenes para {Path(pdf_path).name}: {len(images)} x {self.image_format.upper()}"
+                     f"{' gris' if self.grayscale else ''}, {total_bytes / 1024:.0f} KB, ~{total_tokens} tokens "
+                     f"({(legacy_bytes - total_bytes) / 1024:.0f} KB menos que RGB sin comprimir a {LEGACY_IMAGE_DPI} DPI)")
+        return images, total_tokens
+
+    def _regions_to_image(self, pdf_path, document, regions, fields):
+        """
+        Compone en una sola página los recortes (con margen) de las zonas de la plantilla,
+        cada uno bajo su etiqueta, y la renderiza una vez
+
+        Returns:
+            (bloque de imagen para la API, tokens de imagen estimados)
+        """
+        import fitz  # PyMuPDF
+
+        source = document.doc
+        page_rect = source[0].rect
+        clips = []
+        for field in fields:
+            x0, y0, x1, y1 = regions[field]
+            clip = fitz.Rect(x0 - REGION_PAD_X, y0 - REGION_PAD_Y, x1 + REGION_PAD_X, y1 + REGION_PAD_Y) & page_rect
+            if not clip.is_empty:
+                clips.append((field, clip))
+        if not clips:
+            raise ValueError("las zonas de la plantilla quedan fuera de la página")
+
+        width = max(clip.width for _, clip in clips) + 8
+        height = sum(REGION_LABEL_HEIGHT + clip.height + 6 for _, clip in clips) + 4
+        composite = fitz.open()
+        try:
+            page = composite.new_page(width=width, height=height)
+            y = 4
+            for number, (field, clip) in enumerate(clips, 1):
+                page.insert_text((4, y + 10), f"[{number}] {REGION_FIELD_LABELS.get(field, field)}", fontsize=9)
+                y += REGION_LABEL_HEIGHT
+                page.show_pdf_page(fitz.Rect(4, y, 4 + clip.width, y + clip.height), source, 0, clip=clip)
+                y += clip.height + 6
+
+            zoom = min(REGION_ZOOM,
+                       CLAUDE_IMAGE_MAX_EDGE / max(width, height),
+                       (CLAUDE_IMAGE_MAX_PIXELS / (width * height)) ** 0.5)
+            colorspace = fitz.csGRAY if self.grayscale else fitz.csRGB
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=False)
+        finally:
+            composite.close()
+
+        data = self._encode_pixmap(pix)
+        tokens = self._image_tokens(pix.width, pix.height)
+        self.stats["image_bytes"] += len(data)
+        self.stats["image_tokens"] += tokens
+        self.stats["region_image_bytes"] += len(data)
+        self.stats["region_image_tokens"] += tokens
+        self.stats["region_requests"] += 1
+        logging.info(f"Zonas para {Path(pdf_path).name}: {[field for field, _ in clips]} en "
+                     f"{pix.width}x{pix.height} px, {len(data) / 1024:.0f} KB, ~{tokens} tokens")
+        image = {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": IMAGE_MEDIA_TYPES[self.image_format],
+                "data": base64.b64encode(data).decode('utf-8')
+            }
+        }
+        return image, tokens
+
     def _build_extraction_prompt(self):
-        """Construye el prompt optimizado para extracción de facturas españolas"""
-        return """Analiza esta factura y extrae los siguientes datos en formato JSON:
+        """Construye el prompt optimizado para extracción de facturas españolas (bloque system fijo)"""
+        return f"""Eres un sistema de extracción de datos de facturas de proveedores españoles.
+Recibirás una factura (imágenes de sus páginas o su capa de texto) y debes registrar sus datos
+con la herramienta {INVOICE_TOOL_NAME}.
 
 IMPORTANTE:
 - Busca el CIF/NIF del PROVEEDOR/EMISOR de la factura (NO del cliente)
 - IGNORA explícitamente el CIF de cliente: A28346245 o ESA28346245 (JOFEG)
 - El CIF/NIF español tiene formato: letra + 8 dígitos + letra/dígito (ej: A12345678) o 8 dígitos + letra (ej: 12345678A)
-- Los importes pueden usar punto o coma como separador decimal
+- Los importes pueden usar punto o coma como separador decimal; cópialos tal como aparecen
 - La fecha puede estar en varios formatos (DD/MM/YYYY, DD-MM-YYYY, etc.)
+- confidence: high|medium|low según tu confianza en los datos
 
-Devuelve SOLO un JSON válido con esta estructura exacta:
-{
-    "supplier_tax_id": "CIF o NIF del proveedor/emisor",
-    "invoice_number": "Número de factura",
-    "invoice_date": "Fecha de la factura",
-    "base_imponible": "Base imponible sin IVA",
-    "iva_importe": "Importe del IVA",
-    "total_amount": "Importe total con IVA",
-    "currency": "EUR u otra moneda",
-    "confidence": "high|medium|low según tu confianza en los datos"
-}
+Si algún campo no está visible o no estás seguro, usa null en ese campo."""
 
-Si algún campo no está visible o no estás seguro, usa null en ese campo.
-NO añadas explicaciones, SOLO el JSON."""
+    def _build_region_prompt(self):
+        """Prompt (system fijo) para la petición por zonas: sólo los importes que faltan"""
+        return f"""Eres un sistema de extracción de datos de facturas de proveedores españoles.
+La imagen contiene recortes numerados de una factura. Cada recorte está bajo una
+etiqueta con el campo que contiene (Base imponible, Importe IVA, Total factura).
+Registra los importes con la herramienta {INVOICE_TOOL_NAME}, tal como aparecen
+(pueden usar punto o coma como separador decimal).
+Si un recorte no contiene el importe o no es legible, usa null en ese campo."""
 
-    def estimate_cost(self, num_invoices, pages_per_invoice=3):
+    def estimate_cost(self, num_invoices, pages_per_invoice=3, history=None):
         """
         Estima el coste aproximado de procesar facturas
         
         Args:
             num_invoices: Número de facturas a procesar
             pages_per_invoice: Páginas promedio por factura
+            history: registros de uso (claude_usage.UsageLog.read()); si los hay, se usan
+                los tokens medios reales por llamada del modelo en vez de la estimación
         
         Returns:
             dict con estimación de costes
         """
-        # Costes aproximados Claude 3.5 Sonnet (Febrero 2024)
-        INPUT_COST_PER_1K = 0.003   # $3 por millón de tokens
-        OUTPUT_COST_PER_1K = 0.015  # $15 por millón de tokens
-        
-        # Estimaciones conservadoras
-        TOKENS_PER_IMAGE = 1500  # Una imagen a 300 DPI ~1500 tokens
-        TOKENS_PER_RESPONSE = 500  # Respuesta JSON ~500 tokens
-        
-        total_input_tokens = num_invoices * pages_per_invoice * TOKENS_PER_IMAGE
-        total_output_tokens = num_invoices * TOKENS_PER_RESPONSE
-        
-        input_cost = (total_input_tokens / 1000) * INPUT_COST_PER_1K
-        output_cost = (total_output_tokens / 1000) * OUTPUT_COST_PER_1K
-        total_cost = input_cost + output_cost
+        calls = [r for r in (history or []) if r.get("type") == "call" and r.get("model") == self.model]
+        if calls:
+            tokens_in = sum(r["input_tokens"] + r.get("cache_read_tokens", 0) + r.get("cache_write_tokens", 0)
+                            for r in calls) / len(calls)
+            tokens_out = sum(r["output_tokens"] for r in calls) / len(calls)
+            source = f"media real de {len(calls)} llamadas"
+        else:
+            # Sin histórico: A4 al tamaño efectivo de la API (~1.500 tokens) + instrucciones; respuesta por herramienta
+            tokens_in = pages_per_invoice * self._image_tokens(595 * self.dpi / 72, 842 * self.dpi / 72) + 600
+            tokens_out = 150
+            source = "estimación"
+
+        total_input_tokens = int(num_invoices * tokens_in)
+        total_output_tokens = int(num_invoices * tokens_out)
+        total_cost = self.call_cost(self.model, total_input_tokens, total_output_tokens)
         
         return {
             "num_invoices": num_invoices,
+            "model": self.model,
+            "source": source,
             "total_cost_usd": round(total_cost, 2),
-            "cost_per_invoice_usd": round(total_cost / num_invoices, 3),
+            "cost_per_invoice_usd": round(total_cost / num_invoices, 4),
             "input_tokens": total_input_tokens,
             "output_tokens": total_output_tokens
         }
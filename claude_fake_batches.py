@@ -0,0 +1,141 @@
+"""
+Cliente falso de Claude en proceso (messages.create y messages.batches) para
+probar el modo por lotes sin clave de API ni coste.
+
+Uso:
+    from claude_fake_batches import FakeBatchClient
+    processor.claude_extractor.client = FakeBatchClient(processing_seconds=2)
+    processor.process_all(claude_batch=True)
+
+Ejecutado directamente hace una comprobación rápida de ClaudeBatchRunner.
+"""
+
+import json
+import time
+import itertools
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+DEFAULT_ANSWER = {
+    "supplier_tax_id": "B12345678",
+    "invoice_number": "FAKE-1",
+    "invoice_date": "01/01/2025",
+    "base_imponible": "100,00",
+    "iva_importe": "21,00",
+    "total_amount": "121,00",
+    "currency": "EUR",
+    "confidence": "high"
+}
+
+
+def default_handler(params):
+    """Respuesta fija; sustituir por una función params -> dict para simular otros casos"""
+    return dict(DEFAULT_ANSWER)
+
+
+def _message(params, answer):
+    # Con herramienta forzada la API responde con un bloque tool_use; sin ella, con texto JSON
+    tools = params.get("tools")
+    if tools:
+        fields = tools[0]["input_schema"]["properties"]
+        content = [SimpleNamespace(type="tool_use", id="toolu_fake", name=tools[0]["name"],
+                                   input={k: v for k, v in answer.items() if k in fields})]
+        stop_reason = "tool_use"
+    else:
+        content = [SimpleNamespace(type="text", text=json.dumps(answer))]
+        stop_reason = "end_turn"
+    return SimpleNamespace(
+        id=f"msg_fake_{id(answer)}",
+        type="message",
+        role="assistant",
+        model=params.get("model"),
+        stop_reason=stop_reason,
+        content=content,
+        usage=SimpleNamespace(input_tokens=1500, output_tokens=80)
+    )
+
+
+class _FakeBatches:
+    def __init__(self, handler, processing_seconds, fail_ids):
+        self.handler = handler
+        self.processing_seconds = processing_seconds
+        self.fail_ids = set(fail_ids)
+        self.batches = {}
+        self._ids = itertools.count(1)
+
+    def create(self, requests):
+        batch_id = f"msgbatch_fake_{next(self._ids):04d}"
+        self.batches[batch_id] = {"created": time.monotonic(), "requests": list(requests)}
+        return self.retrieve(batch_id)
+
+    def retrieve(self, batch_id):
+        batch = self.batches[batch_id]
+        total = len(batch["requests"])
+        ended = time.monotonic() - batch["created"] >= self.processing_seconds
+        errored = sum(1 for r in batch["requests"] if r["custom_id"] in self.fail_ids)
+        return SimpleNamespace(
+            id=batch_id,
+            type="message_batch",
+            processing_status="ended" if ended else "in_progress",
+            request_counts=SimpleNamespace(
+                processing=0 if ended else total,
+                succeeded=total - errored if ended else 0,
+                errored=errored if ended else 0,
+                canceled=0,
+                expired=0
+            )
+        )
+
+    def results(self, batch_id):
+        if self.retrieve(batch_id).processing_status != "ended":
+            raise RuntimeError(f"El lote {batch_id} aún no ha terminado")
+        for request in self.batches[batch_id]["requests"]:
+            if request["custom_id"] in self.fail_ids:
+                result = SimpleNamespace(type="errored", error=SimpleNamespace(type="api_error", message="fallo simulado"))
+            else:
+                message = _message(request["params"], self.handler(request["params"]))
+                result = SimpleNamespace(type="succeeded", message=message)
+            yield SimpleNamespace(custom_id=request["custom_id"], result=result)
+
+
+class _FakeMessages:
+    def __init__(self, handler, processing_seconds, fail_ids):
+        self.handler = handler
+        self.calls = 0
+        self.batches = _FakeBatches(handler, processing_seconds, fail_ids)
+
+    def create(self, **params):
+        self.calls += 1
+        return _message(params, self.handler(params))
+
+
+class FakeBatchClient:
+    def __init__(self, handler=default_handler, processing_seconds=0.0, fail_ids=()):
+        """
+        Args:
+            handler: función params -> dict con la respuesta JSON de la factura
+            processing_seconds: tiempo que tarda cada lote en pasar a "ended"
+            fail_ids: custom_id (cache_key) de las peticiones que deben fallar
+        """
+        self.messages = _FakeMessages(handler, processing_seconds, fail_ids)
+
+
+if __name__ == "__main__":
+    from claude_batch import ClaudeBatchRunner, BatchRequestError
+    from claude_extractor import ClaudeRequest
+
+    requests = [ClaudeRequest(f"factura_{i}.pdf", f"key{i}", {"model": "fake", "messages": []}, 1600) for i in range(5)]
+    # Una factura duplicada (mismo contenido) no se envía dos veces
+    requests.append(ClaudeRequest("copia.pdf", "key0", {"model": "fake", "messages": []}, 1600))
+
+    client = FakeBatchClient(processing_seconds=0.5, fail_ids={"key3"})
+    with tempfile.TemporaryDirectory() as tmp:
+        runner = ClaudeBatchRunner(client, str(Path(tmp) / "batches.json"), poll_seconds=0.1)
+        outcomes = runner.run(requests)
+
+    assert len(client.messages.batches.batches) == 1
+    assert len(outcomes) == 5
+    assert isinstance(outcomes["key3"], BatchRequestError)
+    assert json.loads(outcomes["key0"].content[0].text)["supplier_tax_id"] == DEFAULT_ANSWER["supplier_tax_id"]
+    print("OK: lote falso procesado (4 correctas, 1 con error)")
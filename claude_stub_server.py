@@ -0,0 +1,396 @@
+"""
+Servidor HTTP local que imita la API de Anthropic para pruebas de carga sin red.
+Implementa los endpoints que usa el procesador:
+
+    POST /v1/messages                          respuesta con la herramienta rellena
+    POST /v1/messages/batches                  crea un lote
+    GET  /v1/messages/batches/{id}             estado del lote (termina a los --batch-seconds)
+    GET  /v1/messages/batches/{id}/results     resultados en JSONL
+
+y dos de control para las pruebas:
+
+    GET  /stub/stats                           peticiones, errores, pico de concurrencia
+    POST /stub/reset                           pone los contadores a cero
+
+Latencia (media + variación), errores 5xx/529, 429 aleatorios y un límite de
+peticiones por minuto con retry-after son configurables. Las decisiones de cada
+petición (latencia, si falla) salen de un hash de la semilla, el cuerpo de la
+petición y el nº de intento, no del orden de llegada: con la misma semilla la
+misma factura falla en el mismo intento aunque cambie la concurrencia.
+
+Las respuestas son fijas (DEFAULT_ANSWER) o se eligen de un JSON con
+[{"match": "texto", "answer": {...}}, ...]: la primera cuyo "match" aparezca en
+el texto de la petición (nivel texto); sólo se devuelven los campos que pide la
+herramienta.
+
+Para apuntar el procesador al servidor basta con la variable de entorno (o .env)
+ANTHROPIC_BASE_URL=http://127.0.0.1:8765 (ver CLAUDE_BASE_URL en claude_extractor.py);
+los scripts que crean anthropic.Anthropic directamente también la respetan.
+
+Uso: python claude_stub_server.py [--port 8765] [--latency 0.8] [--jitter 0.3]
+                                  [--error-rate 0.01] [--overload-rate 0.01] [--rate-limit-rate 0.02]
+                                  [--rpm 50] [--retry-after 1] [--batch-seconds 5] [--answers respuestas.json]
+"""
+
+import re
+import json
+import time
+import uuid
+import hashlib
+import logging
+import argparse
+import threading
+from collections import Counter, deque
+from datetime import datetime, timezone, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from claude_fake_batches import DEFAULT_ANSWER
+
+STUB_HOST = "127.0.0.1"
+STUB_PORT = 8765
+
+BATCH_PATH_RE = re.compile(r'^/v1/messages/batches/([\w-]+)(/results)?$')
+
+
+class StubConfig:
+    def __init__(self, latency=0.8, jitter=0.3, error_rate=0.0, overload_rate=0.0, rate_limit_rate=0.0,
+                 requests_per_minute=None, retry_after=1.0, batch_seconds=5.0, answers=None, seed=42):
+        """
+        Args:
+            latency: segundos de respuesta medios de /v1/messages
+            jitter: variación relativa de la latencia (0.3 = ±30%)
+            error_rate / overload_rate / rate_limit_rate: probabilidad de 500 / 529 / 429 por intento
+            requests_per_minute: límite de la "cuenta"; por encima se responde 429 con retry-after
+            retry_after: segundos de la cabecera retry-after de los 429 aleatorios
+            batch_seconds: tiempo que tarda un lote en pasar a "ended"
+            answers: lista de {"match": texto, "answer": dict}; la primera que encaje gana
+            seed: semilla de las decisiones por petición
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.overload_rate = overload_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.requests_per_minute = requests_per_minute
+        self.retry_after = retry_after
+        self.batch_seconds = batch_seconds
+        self.answers = answers or []
+        self.seed = seed
+
+
+class StubState:
+    """Estado compartido por los hilos del servidor: intentos, ventana de rpm, lotes y contadores"""
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.attempts = Counter()  # hash del cuerpo -> nº de intentos
+        self.window = deque()      # instantes de las peticiones del último minuto
+        self.batches = {}
+        self.stats = Counter()
+        self.in_flight = 0
+
+    def draw(self, body_hash, attempt, purpose):
+        """Número en [0, 1) determinista para (semilla, petición, intento, propósito)"""
+        digest = hashlib.sha256(f"{self.config.seed}:{body_hash}:{attempt}:{purpose}".encode()).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+    def rpm_exceeded(self, now):
+        """True (y segundos hasta que haya hueco) si la petición supera el límite por minuto"""
+        limit = self.config.requests_per_minute
+        if not limit:
+            return False, 0
+        while self.window and now - self.window[0] >= 60:
+            self.window.popleft()
+        if len(self.window) >= limit:
+            return True, 60 - (now - self.window[0])
+        self.window.append(now)
+        return False, 0
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, in_flight=self.in_flight, batches=len(self.batches))
+
+
+def _timestamp(seconds=0):
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat().replace("+00:00", "Z")
+
+
+def request_text(params):
+    """Texto de los bloques de la petición (para elegir respuesta por contenido)"""
+    parts = []
+    for message in params.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            parts.extend(block.get("text", "") for block in content if isinstance(block, dict))
+    return "\n".join(parts)
+
+
+def build_message(params, config):
+    """Cuerpo JSON de un Message con la herramienta forzada rellena (o texto JSON si no hay herramienta)"""
+    text = request_text(params)
+    answer = DEFAULT_ANSWER
+    for candidate in config.answers:
+        if candidate.get("match") and candidate["match"] in text:
+            answer = candidate["answer"]
+            break
+
+    tools = params.get("tools")
+    if tools:
+        properties = tools[0].get("input_schema", {}).get("properties", {})
+        content = [{"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:24]}", "name": tools[0]["name"],
+                    "input": {field: answer.get(field) for field in properties}}]
+        stop_reason = "tool_use"
+    else:
+        content = [{"type": "text", "text": json.dumps(answer, ensure_ascii=False)}]
+        stop_reason = "end_turn"
+
+    # Tokens aproximados: ~4 caracteres por token de texto, imágenes a tanto alzado
+    images = sum(1 for message in params.get("messages", []) if isinstance(message.get("content"), list)
+                 for block in message["content"] if isinstance(block, dict) and block.get("type") == "image")
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": params.get("model"),
+        "content": content,
+        "stop_reason": stop_reason,
+        "stop_sequence": None,
+        "usage": {
+            "input_tokens": len(text) // 4 + 1500 * images + 300,
+            "output_tokens": 80,
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0
+        }
+    }
+
+
+def _error_body(error_type, message):
+    return {"type": "error", "error": {"type": error_type, "message": message}}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, como espera httpx
+    server_version = "ClaudeStub/1.0"
+
+    @property
+    def state(self):
+        return self.server.stub_state
+
+    def log_message(self, format, *args):
+        logging.debug(f"Stub: {self.address_string()} {format % args}")
+
+    def _send_json(self, status, body, headers=None, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("request-id", f"req_stub_{uuid.uuid4().hex[:16]}")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+        return raw, json.loads(raw or b"{}")
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/stub/stats":
+            return self._send_json(200, self.state.snapshot())
+        found = BATCH_PATH_RE.match(path)
+        if found:
+            return self._batch_results(found.group(1)) if found.group(2) else self._batch_retrieve(found.group(1))
+        self._send_json(404, _error_body("not_found_error", f"Ruta no implementada en el stub: {path}"))
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        try:
+            raw, params = self._read_json()
+        except ValueError:
+            return self._send_json(400, _error_body("invalid_request_error", "JSON no válido"))
+        if path == "/v1/messages":
+            return self._messages(raw, params)
+        if path == "/v1/messages/batches":
+            return self._batch_create(params)
+        if path == "/stub/reset":
+            with self.state.lock:
+                self.state.stats.clear()
+                self.state.attempts.clear()
+                self.state.window.clear()
+            return self._send_json(200, {"reset": True})
+        self._send_json(404, _error_body("not_found_error", f"Ruta no implementada en el stub: {path}"))
+
+    # ------------------------------------------------------------------
+    # /v1/messages
+    # ------------------------------------------------------------------
+    def _messages(self, raw, params):
+        state, config = self.state, self.state.config
+        body_hash = hashlib.sha256(raw).hexdigest()
+        with state.lock:
+            state.stats["requests"] += 1
+            state.attempts[body_hash] += 1
+            attempt = state.attempts[body_hash]
+            limited, wait = state.rpm_exceeded(time.monotonic())
+            if limited:
+                state.stats["rate_limited"] += 1
+            else:
+                state.in_flight += 1
+                state.stats["peak_in_flight"] = max(state.stats["peak_in_flight"], state.in_flight)
+
+        if limited:
+            return self._send_json(429, _error_body("rate_limit_error", "Límite de peticiones por minuto (stub)"),
+                                   headers={"retry-after": f"{max(wait, 0.1):.1f}"})
+        try:
+            spread = (state.draw(body_hash, attempt, "latency") * 2 - 1) * config.jitter
+            time.sleep(max(0.0, config.latency * (1 + spread)))
+
+            outcome = state.draw(body_hash, attempt, "outcome")
+            if outcome < config.rate_limit_rate:
+                self._count("rate_limited")
+                return self._send_json(429, _error_body("rate_limit_error", "Límite de tokens por minuto (stub)"),
+                                       headers={"retry-after": f"{config.retry_after:g}"})
+            outcome -= config.rate_limit_rate
+            if outcome < config.overload_rate:
+                self._count("overloaded")
+                return self._send_json(529, _error_body("overloaded_error", "Sobrecarga simulada (stub)"))
+            outcome -= config.overload_rate
+            if outcome < config.error_rate:
+                self._count("server_errors")
+                return self._send_json(500, _error_body("api_error", "Error interno simulado (stub)"))
+
+            self._count("ok")
+            self._send_json(200, build_message(params, config))
+        finally:
+            with state.lock:
+                state.in_flight -= 1
+
+    def _count(self, key):
+        with self.state.lock:
+            self.state.stats[key] += 1
+
+    # ------------------------------------------------------------------
+    # /v1/messages/batches
+    # ------------------------------------------------------------------
+    def _batch_create(self, params):
+        batch_id = f"msgbatch_stub_{uuid.uuid4().hex[:20]}"
+        requests = params.get("requests", [])
+        with self.state.lock:
+            self.state.batches[batch_id] = {"created": time.monotonic(), "created_at": _timestamp(),
+                                            "requests": requests}
+            self.state.stats["batch_requests"] += len(requests)
+        self._send_json(200, self._batch_body(batch_id))
+
+    def _batch_outcomes(self, batch_id):
+        """Resultados del lote ya terminado (se generan una vez y se reutilizan en recuentos y /results)"""
+        config = self.state.config
+        with self.state.lock:
+            batch = self.state.batches[batch_id]
+            if "results" not in batch:
+                results = []
+                for request in batch["requests"]:
+                    params = request.get("params", {})
+                    body_hash = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+                    if self.state.draw(body_hash, 1, "outcome") < config.error_rate:
+                        result = {"type": "errored", "error": _error_body("api_error", "Error interno simulado (stub)")}
+                    else:
+                        result = {"type": "succeeded", "message": build_message(params, config)}
+                    results.append({"custom_id": request.get("custom_id"), "result": result})
+                batch["results"] = results
+            return batch["results"]
+
+    def _batch_body(self, batch_id):
+        batch = self.state.batches[batch_id]
+        ended = time.monotonic() - batch["created"] >= self.state.config.batch_seconds
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        if ended:
+            # Los recuentos salen de los resultados reales: los errores inyectados se ven también aquí
+            for outcome in self._batch_outcomes(batch_id):
+                counts[outcome["result"]["type"]] += 1
+        else:
+            counts["processing"] = len(batch["requests"])
+        host = self.headers.get("Host") or f"{STUB_HOST}:{self.server.server_address[1]}"
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": counts,
+            "created_at": batch["created_at"],
+            "expires_at": _timestamp(86400),
+            "ended_at": _timestamp() if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"http://{host}/v1/messages/batches/{batch_id}/results" if ended else None
+        }
+
+    def _batch_retrieve(self, batch_id):
+        if batch_id not in self.state.batches:
+            return self._send_json(404, _error_body("not_found_error", f"Lote desconocido: {batch_id}"))
+        self._send_json(200, self._batch_body(batch_id))
+
+    def _batch_results(self, batch_id):
+        if batch_id not in self.state.batches:
+            return self._send_json(404, _error_body("not_found_error", f"Lote desconocido: {batch_id}"))
+        if self._batch_body(batch_id)["processing_status"] != "ended":
+            return self._send_json(400, _error_body("invalid_request_error", "El lote aún no ha terminado"))
+
+        lines = [json.dumps(outcome, ensure_ascii=False) for outcome in self._batch_outcomes(batch_id)]
+        self._send_json(200, ("\n".join(lines) + "\n").encode("utf-8"), content_type="application/binary")
+
+
+def make_server(config=None, host=STUB_HOST, port=STUB_PORT):
+    """Servidor listo para serve_forever() (port=0 elige un puerto libre: ver server.server_address)"""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.stub_state = StubState(config or StubConfig())
+    return server
+
+
+def serve_in_thread(config=None, host=STUB_HOST, port=0):
+    """Arranca el servidor en un hilo; devuelve (server, base_url). Parar con server.shutdown()"""
+    server = make_server(config, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default=STUB_HOST)
+    parser.add_argument("--port", type=int, default=STUB_PORT)
+    parser.add_argument("--latency", type=float, default=0.8, help="Segundos medios por llamada")
+    parser.add_argument("--jitter", type=float, default=0.3, help="Variación relativa de la latencia")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de 500 por intento")
+    parser.add_argument("--overload-rate", type=float, default=0.0, help="Probabilidad de 529 por intento")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Probabilidad de 429 por intento")
+    parser.add_argument("--rpm", type=int, default=None, help="Límite de peticiones por minuto (429 al superarlo)")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Cabecera retry-after de los 429 aleatorios")
+    parser.add_argument("--batch-seconds", type=float, default=5.0, help="Segundos hasta que un lote termina")
+    parser.add_argument("--answers", help="JSON con [{\"match\": texto, \"answer\": {...}}, ...]")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    answers = None
+    if args.answers:
+        with open(args.answers, encoding="utf-8") as f:
+            answers = json.load(f)
+    config = StubConfig(args.latency, args.jitter, args.error_rate, args.overload_rate, args.rate_limit_rate,
+                        args.rpm, args.retry_after, args.batch_seconds, answers, args.seed)
+    server = make_server(config, args.host, args.port)
+    logging.info(f"Stub de Claude en http://{args.host}:{args.port} (latencia {args.latency}s ±{args.jitter:.0%}, "
+                 f"500 {args.error_rate:.1%}, 529 {args.overload_rate:.1%}, 429 {args.rate_limit_rate:.1%}, "
+                 f"rpm {args.rpm or 'sin límite'})")
+    logging.info(f"Apuntar el procesador con ANTHROPIC_BASE_URL=http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info(f"Stub detenido: {server.stub_state.snapshot()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Registro del uso real de Claude.
+Cada llamada deja una línea JSON con tokens (de response.usage), imágenes,
+bytes enviados, latencia, modelo y coste estimado; cada ejecución deja además
+una línea de resumen (documentos, documentos con Claude y duración). Con ese
+histórico se generan los informes de coste (claude_cost_report.py) y se
+estima el coste y la duración de la cola pendiente antes de procesarla.
+"""
+
+import os
+import json
+import logging
+
+USAGE_LOG_PATH = r"c:\Proyectos\Proveedores\claude_usage.jsonl"  # Tokens/coste/latencia reales por llamada a Claude
+
+# Nº de ejecuciones recientes que se usan para las medias del planificador
+PLAN_HISTORY_RUNS = 20
+
+
+class UsageLog:
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, records):
+        """Añade registros (dicts) al final del fichero JSONL"""
+        if not records:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            logging.warning(f"No se pudo escribir el registro de uso de Claude {self.path}: {e}")
+
+    def read(self):
+        """Todos los registros; las líneas corruptas (p.ej. un corte a mitad de escritura) se ignoran"""
+        records = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+        return records
+
+
+def plan_queue(records, pending_count, history_runs=PLAN_HISTORY_RUNS):
+    """
+    Estima llamadas, coste y duración de una cola de `pending_count` documentos a
+    partir de las medias reales de las últimas ejecuciones
+
+    Returns:
+        dict con la estimación, o None si todavía no hay histórico
+    """
+    runs = [r for r in records if r.get("type") == "run" and r.get("documents")][-history_runs:]
+    if not runs:
+        return None
+    run_ids = {r["run_id"] for r in runs}
+    calls = [r for r in records if r.get("type") == "call" and r.get("run_id") in run_ids]
+
+    documents = sum(r["documents"] for r in runs)
+    claude_documents = sum(r.get("claude_documents", 0) for r in runs)
+    seconds = sum(r.get("seconds", 0) for r in runs)
+    cost = sum(r.get("cost_usd", 0) for r in calls)
+    latencies = [r["latency_ms"] for r in calls if r.get("latency_ms") is not None]
+
+    return {
+        "pending": pending_count,
+        "history_runs": len(runs),
+        "history_documents": documents,
+        "claude_rate": claude_documents / documents,
+        "claude_documents": round(pending_count * claude_documents / documents),
+        "claude_calls": round(pending_count * len(calls) / documents),
+        "cost_usd": pending_count * cost / documents,
+        "seconds": pending_count * seconds / documents,
+        "avg_latency_ms": sum(latencies) / len(latencies) if latencies else None
+    }
@@ -0,0 +1,120 @@
+"""
+Export del Excel de resumen en streaming.
+Las filas llegan como iterador (p.ej. ResultStore.rows()) y se escriben con
+openpyxl en modo write_only, así que la memoria no crece con el número de
+facturas. El resaltado de NO_MATCH / ERROR se hace con reglas de formato
+condicional (una regla por status y hoja) en lugar de dar estilo celda a celda.
+Opcionalmente se genera un libro por mes de factura.
+"""
+
+import os
+import re
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.formatting.rule import FormulaRule
+from openpyxl.styles import Font, PatternFill
+from openpyxl.utils import get_column_letter
+
+# Caracteres de control que openpyxl no admite en una celda
+ILLEGAL_CHARACTERS_RE = re.compile(r'[\x00-\x08\x0b-\x0c\x0e-\x1f\x7f-\x9f]')
+DATE_MONTH_RE = re.compile(r'\d{1,2}[/-](\d{1,2})[/-](\d{2,4})')
+
+# Resaltado por status (fila completa)
+STATUS_FILLS = {
+    "ERROR": "FFC7CE",     # rojo claro
+    "NO_MATCH": "FFEB9C"   # amarillo
+}
+COLUMN_WIDTHS = {
+    'Proveedor': 35, 'Nº Factura': 20, 'Fecha': 12, 'CIF': 14, 'Base Imponible': 15,
+    'Iva': 12, 'Total factura': 15, 'Conta': 12, 'file_name': 35, 'file_path': 60, 'status': 12
+}
+
+
+def solid_fill(color):
+    return PatternFill(start_color=color, end_color=color, fill_type="solid")
+
+
+def invoice_month(row):
+    """'AAAA-MM' de la fecha de factura (dd/mm/aaaa), o de la modificación del PDF si no hay fecha"""
+    found = DATE_MONTH_RE.search(str(row.get("invoice_date") or ""))
+    if found and 1 <= int(found.group(1)) <= 12:
+        year = found.group(2)
+        if len(year) == 2:
+            year = f"20{year}"
+        return f"{year}-{int(found.group(1)):02d}"
+    modified = row.get("modified_datetime") or ""
+    return modified[:7] if len(modified) >= 7 else "sin_fecha"
+
+
+class _SheetWriter:
+    """Libro write_only de una sola hoja que cuenta las filas escritas"""
+    def __init__(self, path, columns, column_map, sheet_name):
+        self.path = path
+        self.columns = columns
+        # Visual -> interno, en el orden de las columnas del Excel
+        internal = {visual: name for name, visual in column_map.items()}
+        self.keys = [internal.get(col, col) for col in columns]
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet(sheet_name)
+        for idx, col in enumerate(columns, start=1):
+            self.sheet.column_dimensions[get_column_letter(idx)].width = COLUMN_WIDTHS.get(col, 15)
+        self.sheet.append([self._header_cell(col) for col in columns])
+        self.rows = 0
+
+    def _header_cell(self, value):
+        cell = WriteOnlyCell(self.sheet, value=value)
+        cell.font = Font(bold=True)
+        return cell
+
+    def append(self, row):
+        values = []
+        for key in self.keys:
+            value = row.get(key)
+            if isinstance(value, str):
+                value = ILLEGAL_CHARACTERS_RE.sub('', value)
+            values.append(value)
+        self.sheet.append(values)
+        self.rows += 1
+
+    def close(self):
+        if self.rows and "status" in self.columns:
+            # Una regla por status sobre todo el rango: Excel la evalúa al abrir el libro
+            status_col = get_column_letter(self.columns.index("status") + 1)
+            cell_range = f"A2:{get_column_letter(len(self.columns))}{self.rows + 1}"
+            for status, color in STATUS_FILLS.items():
+                self.sheet.conditional_formatting.add(
+                    cell_range, FormulaRule(formula=[f'${status_col}2="{status}"'], fill=solid_fill(color)))
+        self.sheet.auto_filter.ref = f"A1:{get_column_letter(len(self.columns))}{self.rows + 1}"
+        self.workbook.save(self.path)
+
+
+def export_rows(rows, output_path, column_map, columns, by_month=False, sheet_name="Facturas"):
+    """
+    Escribe las filas en el Excel de resumen sin cargarlas en memoria
+
+    Args:
+        rows: iterador de dicts con los nombres internos de campo
+        column_map: mapa nombre interno -> columna visual
+        columns: columnas visuales, en orden
+        by_month: Si True, un libro por mes de factura (<nombre>_AAAA-MM.xlsx) en vez de uno solo
+    Returns:
+        dict {ruta del libro: nº de filas}
+    """
+    writers = {}
+    base, ext = os.path.splitext(output_path)
+    for row in rows:
+        path = f"{base}_{invoice_month(row)}{ext}" if by_month else output_path
+        writer = writers.get(path)
+        if writer is None:
+            writer = writers[path] = _SheetWriter(path, columns, column_map, sheet_name)
+        writer.append(row)
+
+    if not writers:
+        # Sin facturas: libro vacío con cabecera, como hacía el export con pandas
+        writers[output_path] = _SheetWriter(output_path, columns, column_map, sheet_name)
+
+    written = {}
+    for path, writer in writers.items():
+        writer.close()
+        written[path] = writer.rows
+    return written
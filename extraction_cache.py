@@ -0,0 +1,55 @@
+"""
+Caché local de extracción direccionada por contenido.
+La clave es el hash SHA-256 de los bytes del PDF, así que un mismo documento
+renombrado, movido o copiado no se vuelve a extraer. Cada entrada guarda:
+  - el texto y los metadatos extraídos (no dependen de plantillas ni maestro)
+  - los campos parseados (incluida la respuesta de Claude) por versión de
+    entradas (plantillas + maestro + Claude), de modo que un NO_MATCH sólo se
+    recalcula cuando cambia algo que puede cambiar el resultado
+"""
+
+import os
+import json
+import logging
+
+
+class ExtractionCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _path(self, content_hash):
+        # Subdirectorios por prefijo para no acumular miles de ficheros en una carpeta
+        return os.path.join(self.cache_dir, content_hash[:2], f"{content_hash}.json")
+
+    def get(self, content_hash):
+        """Entrada {'text', 'metadata', 'fields': {version: campos}} o None"""
+        try:
+            with open(self._path(content_hash), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put_text(self, content_hash, text, metadata):
+        entry = self.get(content_hash) or {"fields": {}}
+        entry.update({"text": text, "metadata": metadata})
+        self._write(content_hash, entry)
+
+    def put_fields(self, content_hash, version, fields):
+        entry = self.get(content_hash)
+        if entry is None:
+            return
+        # Sólo interesa el resultado de la versión vigente de plantillas/maestro
+        entry["fields"] = {version: fields}
+        self._write(content_hash, entry)
+
+    def _write(self, content_hash, entry):
+        path = self._path(content_hash)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Escritura atómica: varios procesos del pool pueden ver el mismo documento
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"No se pudo escribir la caché de extracción {path}: {e}")
@@ -1,9 +1,10 @@
 
 import os
 import time
+import shutil
 from pathlib import Path
 import logging
-from jofeg_idp_processor import JofegIDPProcessor
+from jofeg_idp_processor import JofegIDPProcessor, EXTRACTION_CACHE_DIR
 
 # Config setup
 logging.basicConfig(level=logging.INFO)
@@ -15,13 +16,14 @@ EXCEL_FILE = BASE_DIR / "Resumen_Facturas_IDP.xlsx"
 
 print("=== FORCING FULL REPROCESSING TO FIX EXCEL ===")
 
-# 1. Delete State File (Forces re-reading all PDFs)
-if STATE_FILE.exists():
-    print(f"Deleting state file: {STATE_FILE}")
-    try:
-        os.remove(STATE_FILE)
-    except Exception as e:
-        print(f"Error checking state file: {e}")
+# 1. Delete State File and its journal (Forces re-reading all PDFs)
+for state_path in (STATE_FILE, Path(f"{STATE_FILE}.journal")):
+    if state_path.exists():
+        print(f"Deleting state file: {state_path}")
+        try:
+            os.remove(state_path)
+        except Exception as e:
+            print(f"Error checking state file: {e}")
 
 # 2. Delete Excel File (Forces fresh write of columns)
 if EXCEL_FILE.exists():
@@ -38,7 +40,15 @@ if EXCEL_FILE.exists():
         except:
             print("Could not delete or rename Excel. Close it if open!")
 
-# 3. Run Processor
+# 3. Delete the extraction cache (otherwise every PDF already seen replays its cached fields)
+if os.path.isdir(EXTRACTION_CACHE_DIR):
+    print(f"Deleting extraction cache: {EXTRACTION_CACHE_DIR}")
+    try:
+        shutil.rmtree(EXTRACTION_CACHE_DIR)
+    except Exception as e:
+        print(f"Error deleting extraction cache: {e}")
+
+# 4. Run Processor
 print("Starting Processor...")
 processor = JofegIDPProcessor()
 processor.process_all()
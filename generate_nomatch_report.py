@@ -2,6 +2,15 @@ import pandas as pd
 import re
 from datetime import datetime
 from pathlib import Path
+from openpyxl.formatting.rule import FormulaRule
+from openpyxl.styles import Font, PatternFill
+from result_store import ResultStore
+from jofeg_idp_processor import RESULTS_DB_PATH
+
+# Campos del almacén que usa el reporte. Las filas importadas del Excel antiguo pueden no
+# traer match_debug ni all_detected_ids: se crean vacíos en lugar de fallar con KeyError
+SOURCE_COLUMNS = ['file_name', 'file_path', 'supplier_tax_id', 'invoice_number', 'invoice_date',
+                  'base_imponible', 'iva_importe', 'total_amount', 'match_debug', 'all_detected_ids']
 
 def is_suspicious_cif(cif):
     """Detecta CIFs que parecen mal formados o sospechosos"""
@@ -28,11 +37,9 @@ def is_suspicious_cif(cif):
 def analyze_nomatch_errors():
     """Genera reporte mejorado con priorización inteligente"""
     
-    # Leer el Excel principal
-    df = pd.read_excel('Resumen_Facturas_IDP.xlsx')
-    
-    # Filtrar solo los NO_MATCH
-    no_match = df[df['status'] == 'NO_MATCH'].copy()
+    # Leer solo los NO_MATCH del almacén de resultados (índice por status).
+    # El almacén guarda la fila completa, con el contexto del CIF y los CIFs detectados
+    no_match = pd.DataFrame(list(ResultStore(RESULTS_DB_PATH).rows(status='NO_MATCH')), columns=SOURCE_COLUMNS)
     
     if len(no_match) == 0:
         print("✅ No hay facturas sin match. Todos los CIFs fueron encontrados.")
@@ -114,14 +121,13 @@ def analyze_nomatch_errors():
         worksheet.column_dimensions['L'].width = 60  # Contexto
         worksheet.column_dimensions['M'].width = 30  # Todos los CIFs
         
-        # Aplicar formato condicional para CIFs sospechosos
-        from openpyxl.styles import PatternFill
+        # Formato condicional para CIFs sospechosos (una regla para todo el rango)
         yellow_fill = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
-        
-        for idx, row in report.iterrows():
-            if row['CIF Sospechoso']:  # CIF Sospechoso = True
-                worksheet[f'C{idx+2}'].fill = yellow_fill
-                worksheet[f'J{idx+2}'].fill = yellow_fill
+        last_row = len(report) + 1
+        worksheet.conditional_formatting.add(
+            f'C2:C{last_row} J2:J{last_row}',
+            FormulaRule(formula=['$J2=TRUE'], fill=yellow_fill)
+        )
         
         # Crear resumen por CIF con recomendaciones
         summary = no_match.groupby('supplier_tax_id').agg({
@@ -153,21 +159,17 @@ def analyze_nomatch_errors():
         worksheet2.column_dimensions['D'].width = 12
         worksheet2.column_dimensions['E'].width = 40
         
-        # Colorear recomendaciones
-        from openpyxl.styles import Font
+        # Colorear recomendaciones con formato condicional por prefijo
         red_font = Font(color="FF0000", bold=True)
         orange_font = Font(color="FF8C00", bold=True)
         green_font = Font(color="008000")
         
-        for idx, row in summary.iterrows():
-            if 'REVISAR' in str(row['Recomendación']):
-                worksheet2[f'E{idx+2}'].font = red_font
-            elif 'ALTA' in str(row['Recomendación']):
-                worksheet2[f'E{idx+2}'].font = red_font
-            elif 'MEDIA' in str(row['Recomendación']):
-                worksheet2[f'E{idx+2}'].font = orange_font
-            else:
-                worksheet2[f'E{idx+2}'].font = green_font
+        summary_range = f'E2:E{len(summary) + 1}'
+        for prefix, font in (('REVISAR', red_font), ('ALTA', red_font), ('MEDIA', orange_font), ('BAJA', green_font)):
+            worksheet2.conditional_formatting.add(
+                summary_range,
+                FormulaRule(formula=[f'LEFT($E2,{len(prefix)})="{prefix}"'], font=font, stopIfTrue=True)
+            )
     
     # Generar estadísticas
     print(f"📊 REPORTE GENERADO: {output_file}")
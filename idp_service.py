@@ -0,0 +1,334 @@
+"""
+Modo servicio del procesador IDP.
+Un único JofegIDPProcessor vive durante todo el servicio: maestro de
+proveedores, plantillas, cliente de Claude, cachés y recorrido de directorios
+quedan cargados en memoria. Cada POLL_SECONDS se recorre INPUT_PDF_DIR (con la
+caché de directorios del crawler, un stat por carpeta sin cambios) y se
+procesan los PDFs nuevos o modificados.
+
+- Antirrebote: un PDF sólo se procesa cuando su huella (mtime + tamaño) lleva
+  DEBOUNCE_SECONDS sin cambiar, para no leer ficheros que aún se están copiando.
+- Recarga en caliente: si cambian templates.json o PROVEE.csv se recargan y se
+  reintentan los NO_MATCH/ERROR previos (sólo entonces pueden cambiar).
+- Un PDF que falla al leerse no se reintenta en cada ciclo, sólo cuando cambia.
+- El Excel de resumen se regenera como mucho cada EXPORT_EVERY_SECONDS, o al
+  pedirlo un cliente.
+
+La GUI y main_menu.py se conectan como clientes (multiprocessing.connection)
+en lugar de crear su propio procesador. multiprocessing.connection deserializa
+(pickle) lo que recibe, así que la clave de autenticación no puede ser fija:
+se genera una aleatoria la primera vez que arranca el servicio y se guarda en
+SERVICE_AUTHKEY_PATH, dentro del perfil del usuario y legible sólo por él.
+
+Uso:
+    python idp_service.py                 # o: python jofeg_idp_processor.py --watch
+    python idp_service.py --status
+    python idp_service.py --stop
+    python idp_service.py --authkey-file RUTA   # clave en otra ubicación (servicio y clientes)
+"""
+
+import os
+import time
+import secrets
+import logging
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import jofeg_idp_processor as idp
+
+SERVICE_ADDRESS = ("127.0.0.1", 6150)
+# En el perfil del usuario (no en c:\Proyectos, compartido): sólo él puede leer la clave
+SERVICE_AUTHKEY_PATH = os.path.join(os.path.expanduser("~"), ".jofeg_idp", "service.key")
+POLL_SECONDS = 5
+DEBOUNCE_SECONDS = 10
+EXPORT_EVERY_SECONDS = 300
+
+
+def load_authkey(path=None, create=False):
+    """
+    Clave de autenticación del servicio
+
+    Args:
+        path: fichero de la clave (por defecto SERVICE_AUTHKEY_PATH)
+        create: si no existe, generar una aleatoria (sólo el servicio)
+
+    Raises:
+        ConnectionError: si no existe y create es False (el servicio nunca ha arrancado)
+    """
+    path = path or SERVICE_AUTHKEY_PATH
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        if not create:
+            raise ConnectionError(f"No existe la clave del servicio IDP ({path}): ¿se ha arrancado alguna vez?")
+    os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+    key = secrets.token_bytes(32)
+    # O_EXCL: si otro proceso la crea a la vez, se usa la suya
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o600)
+    except FileExistsError:
+        return load_authkey(path)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    logging.info(f"Servicio: generada una clave de autenticación nueva en {path}")
+    return key
+
+
+class IDPService:
+    def __init__(self, processor=None, poll_seconds=POLL_SECONDS, debounce_seconds=DEBOUNCE_SECONDS,
+                 address=SERVICE_ADDRESS, authkey_path=None, **run_options):
+        """
+        Args:
+            processor: JofegIDPProcessor ya creado (por defecto se crea uno)
+            poll_seconds: Intervalo entre recorridos de INPUT_PDF_DIR
+            debounce_seconds: Tiempo que la huella de un PDF debe estar estable antes de procesarlo
+            authkey_path: fichero de la clave de autenticación (por defecto SERVICE_AUTHKEY_PATH)
+            run_options: Opciones para process_all (workers, claude_concurrency, ...)
+        """
+        self.authkey = load_authkey(authkey_path, create=True)
+        self.processor = processor or idp.JofegIDPProcessor()
+        self.poll_seconds = poll_seconds
+        self.debounce_seconds = debounce_seconds
+        self.address = address
+        self.run_options = run_options
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._seen = None  # {ruta: (huella, instante desde el que es estable)}
+        self._failed = {}  # {ruta: huella} de los PDFs que no se pudieron leer
+        self._input_mtimes = self._inputs_mtimes()
+        self._outcome_version = self.processor.outcome_version
+        self._last_export = time.monotonic()
+        self._dirty = False
+        self.status = {"started": time.strftime("%Y-%m-%d %H:%M:%S"), "cycles": 0, "processed": 0,
+                       "last_run": None, "waiting": 0}
+
+    # ------------------------------------------------------------------
+    # Ciclo de sondeo
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _inputs_mtimes():
+        return {path: os.path.getmtime(path) if os.path.exists(path) else None
+                for path in (idp.TEMPLATES_PATH, idp.PROVEE_CSV_PATH)}
+
+    def _reload_if_changed(self):
+        """Recarga plantillas y maestro si han cambiado. True si puede cambiar el resultado de facturas ya procesadas"""
+        mtimes = self._inputs_mtimes()
+        if mtimes == self._input_mtimes:
+            return False
+        self._input_mtimes = mtimes
+        logging.info("Servicio: cambios en plantillas o maestro de proveedores, recargando")
+        self.processor.templates = self.processor._load_templates()
+        self.processor.suppliers = self.processor._load_suppliers()
+        version = self.processor.outcome_version = self.processor._outcome_version()
+        changed, self._outcome_version = version != self._outcome_version, version
+        return changed
+
+    def _unstable(self, entries, now):
+        """Rutas cuya huella ha cambiado hace menos de debounce_seconds"""
+        initial = self._seen is None
+        previous = self._seen or {}
+        seen, unstable = {}, set()
+        for entry in entries:
+            prev = previous.get(entry.path)
+            if prev and prev[0] == entry.fingerprint:
+                since = prev[1]
+            elif initial and time.time() - entry.mtime >= self.debounce_seconds:
+                # Al arrancar, lo que no se ha tocado recientemente ya está completo
+                since = now - self.debounce_seconds
+            else:
+                since = now
+            seen[entry.path] = (entry.fingerprint, since)
+            if now - since < self.debounce_seconds:
+                unstable.add(entry.path)
+        self._seen = seen
+        return unstable
+
+    def poll_once(self, force=False):
+        """
+        Un ciclo: recarga en caliente, recorrido, antirrebote y procesamiento de lo pendiente
+
+        Args:
+            force: Petición manual: reintenta NO_MATCH/ERROR y regenera el Excel
+        Returns:
+            dict con el resumen del ciclo
+        """
+        with self._lock:
+            self.status["cycles"] += 1
+            retry_failed = self._reload_if_changed() or force
+            if not os.path.exists(idp.INPUT_PDF_DIR):
+                logging.warning(f"Servicio: directorio de entrada no accesible: {idp.INPUT_PDF_DIR}")
+                return {"processed": 0, "error": f"No accesible: {idp.INPUT_PDF_DIR}"}
+
+            entries = self.processor._scan_inputs(verbose=False)
+            fingerprints = {entry.path: entry.fingerprint for entry in entries}
+            exclude = self._unstable(entries, time.monotonic())
+            self.status["waiting"] = len(exclude)
+            if not retry_failed:
+                exclude |= {path for path, fp in self._failed.items() if fingerprints.get(path) == fp}
+
+            pending = [p for p, _ in self.processor._find_pending(entries, retry_failed) if str(p) not in exclude]
+            rows = []
+            if pending:
+                # Mismo recorrido: process_all no vuelve a listar el recurso de red
+                rows = self.processor.process_all(exclude=exclude, retry_failed=retry_failed, entries=entries,
+                                                  export_excel=False, **self.run_options)
+                self._dirty = self._dirty or bool(rows)
+                for row in rows:
+                    if row["status"] == "ERROR":
+                        self._failed[row["file_path"]] = fingerprints.get(row["file_path"])
+                    else:
+                        self._failed.pop(row["file_path"], None)
+
+            if self._dirty and (force or time.monotonic() - self._last_export >= EXPORT_EVERY_SECONDS):
+                self.processor.export()
+                self._dirty = False
+                self._last_export = time.monotonic()
+
+            summary = {
+                "processed": len(rows),
+                "ok": sum(1 for row in rows if row["status"].startswith("OK")),
+                "no_match": sum(1 for row in rows if row["status"] == "NO_MATCH"),
+                "errors": sum(1 for row in rows if row["status"] == "ERROR"),
+                "waiting": self.status["waiting"],
+                "finished": time.strftime("%Y-%m-%d %H:%M:%S")
+            }
+            if rows or force:
+                self.status["processed"] += len(rows)
+                self.status["last_run"] = summary
+            return summary
+
+    # ------------------------------------------------------------------
+    # Servicio y clientes
+    # ------------------------------------------------------------------
+    def _handle(self, request):
+        command = request.get("cmd")
+        if command == "run":
+            return self.poll_once(force=True)
+        if command == "status":
+            return dict(self.status, running=True)
+        if command == "export":
+            with self._lock:
+                self.processor.export()
+                self._dirty = False
+                self._last_export = time.monotonic()
+            return {"exported": idp.OUTPUT_XLSX}
+        if command == "stop":
+            self._stop.set()
+            return {"stopping": True}
+        return {"error": f"Comando desconocido: {command}"}
+
+    def _serve_clients(self, listener):
+        while not self._stop.is_set():
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                # Un cliente sin la clave no debe tumbar el hilo que atiende a los demás
+                logging.warning("Servicio: conexión rechazada (clave de autenticación incorrecta)")
+                continue
+            except OSError:
+                break
+            if self._stop.is_set():
+                conn.close()
+                break
+            threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def _serve_connection(self, conn):
+        with conn:
+            try:
+                request = conn.recv()
+                conn.send(self._handle(request))
+            except Exception as e:
+                logging.error(f"Servicio: error atendiendo a un cliente: {e}")
+                try:
+                    conn.send({"error": str(e)})
+                except OSError:
+                    pass
+
+    def serve_forever(self):
+        listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._serve_clients, args=(listener,), daemon=True).start()
+        logging.info(f"Servicio IDP escuchando en {self.address[0]}:{self.address[1]} | vigilando {idp.INPUT_PDF_DIR} "
+                     f"cada {self.poll_seconds}s (antirrebote {self.debounce_seconds}s)")
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.poll_once()
+                except Exception as e:
+                    logging.error(f"Servicio: error en el ciclo de procesamiento: {e}")
+                self._stop.wait(self.poll_seconds)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # accept() no se interrumpe al cerrar el socket: una conexión vacía lo despierta
+            self._stop.set()
+            try:
+                Client(self.address, authkey=self.authkey).close()
+            except OSError:
+                pass
+            listener.close()
+            with self._lock:
+                if self._dirty:
+                    self.processor.export()
+                self.processor._save_state()
+            logging.info("Servicio IDP detenido")
+
+
+def request(command, timeout=None, address=SERVICE_ADDRESS, authkey_path=None):
+    """
+    Envía un comando al servicio ('run', 'status', 'export', 'stop') y devuelve su respuesta
+
+    Raises:
+        ConnectionError: si el servicio no está en marcha (o la clave no es la suya)
+        TimeoutError: si no responde en timeout segundos
+    """
+    authkey = load_authkey(authkey_path)
+    try:
+        conn = Client(address, authkey=authkey)
+    except OSError as e:
+        raise ConnectionError(f"Servicio IDP no disponible en {address[0]}:{address[1]}") from e
+    except AuthenticationError as e:
+        raise ConnectionError(f"El servicio en {address[0]}:{address[1]} rechazó la clave de {authkey_path or SERVICE_AUTHKEY_PATH}") from e
+    with conn:
+        conn.send({"cmd": command})
+        if timeout is not None and not conn.poll(timeout):
+            raise TimeoutError(f"El servicio IDP no respondió a '{command}' en {timeout}s")
+        return conn.recv()
+
+
+def is_running(address=SERVICE_ADDRESS, authkey_path=None):
+    try:
+        request("status", timeout=5, address=address, authkey_path=authkey_path)
+        return True
+    except (ConnectionError, TimeoutError, EOFError):
+        return False
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Servicio IDP: vigila la carpeta de facturas y procesa lo nuevo")
+    parser.add_argument("--poll", type=float, default=POLL_SECONDS, help="Segundos entre recorridos")
+    parser.add_argument("--debounce", type=float, default=DEBOUNCE_SECONDS,
+                        help="Segundos que un PDF debe estar sin cambios antes de procesarlo")
+    parser.add_argument("--workers", type=int, default=None, help="Procesos en paralelo (por defecto: secuencial)")
+    parser.add_argument("--claude-concurrency", type=int, default=None,
+                        help="Llamadas a Claude en vuelo a la vez (por defecto: síncrono)")
+    parser.add_argument("--authkey-file", default=None,
+                        help=f"Fichero con la clave de autenticación (por defecto {SERVICE_AUTHKEY_PATH})")
+    parser.add_argument("--status", action="store_true", help="Mostrar el estado del servicio en marcha")
+    parser.add_argument("--stop", action="store_true", help="Detener el servicio en marcha")
+    args = parser.parse_args()
+
+    if args.status or args.stop:
+        try:
+            print(request("stop" if args.stop else "status", timeout=30, authkey_path=args.authkey_file))
+        except (ConnectionError, TimeoutError) as e:
+            print(e)
+        return
+
+    IDPService(poll_seconds=args.poll, debounce_seconds=args.debounce, authkey_path=args.authkey_file,
+               workers=args.workers, claude_concurrency=args.claude_concurrency).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,28 @@
 
+import io
 import os
 import re
 import json
 import hashlib
 import logging
+import time
 import pandas as pd
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
 from datetime import datetime
 from pathlib import Path
 import fitz  # PyMuPDF
+from pdf_document import InvoiceDocument
+from supplier_index import SupplierIndex
+from normalized_text import NormalizedText
+from extraction_cache import ExtractionCache
+from result_store import ResultStore
+from state_journal import StateJournal
+from pdf_crawler import PdfCrawler
+from excel_export import export_rows
+from run_metrics import METRICS
+from claude_usage import UsageLog, plan_queue, USAGE_LOG_PATH
 
 # ==============================================================================
 # CONFIGURACIÓN (Ajustar según entorno Jofeg)
@@ -16,8 +31,17 @@ INPUT_PDF_DIR = r"X:\Facts_Proveedor"  # <--- Cambiar a la ruta real de SharePoi
 PROVEE_CSV_PATH = r"X:\DatosCsv\PROVEE.csv"
 OUTPUT_XLSX = r"c:\Proyectos\Proveedores\Resumen_Facturas_IDP.xlsx"
 STATE_PATH = r"c:\Proyectos\Proveedores\processing_state.json"
+RESULTS_DB_PATH = r"c:\Proyectos\Proveedores\resultados_idp.sqlite"  # Sistema de registro; el Excel se deriva de aquí
 LOG_FILE = r"c:\Proyectos\Proveedores\idp_processor.log"
 TEMPLATES_PATH = r"c:\Proyectos\Proveedores\templates.json"
+SUPPLIER_CACHE_PATH = r"c:\Proyectos\Proveedores\cache\supplier_index.bin"  # Índice compilado de PROVEE.csv (local)
+EXTRACTION_CACHE_DIR = r"c:\Proyectos\Proveedores\cache\extraction"  # Resultados por hash de contenido del PDF
+CRAWL_CACHE_PATH = r"c:\Proyectos\Proveedores\cache\crawl_dirs.json"  # mtime y listado por directorio de INPUT_PDF_DIR
+CRAWL_FULL_RESCAN_HOURS = 24        # Relistado completo de INPUT_PDF_DIR como mínimo cada tantas horas
+CRAWL_RECENT_SECONDS = 600          # Sin relistar, PDFs modificados hace menos de esto se vuelven a consultar
+CRAWL_RELIST_UNCHANGED = os.name == "nt"  # Listar también carpetas sin cambios (detecta PDFs sobrescritos)
+METRICS_JSON_PATH = r"c:\Proyectos\Proveedores\metricas_idp.json"  # Tiempos por fase/proveedor/factura de la última ejecución
+METRICS_PROM_PATH = r"c:\Proyectos\Proveedores\metricas\jofeg_idp.prom"  # Lo mismo para el textfile collector de Prometheus
 
 # Expresiones Regulares alineadas con estándares de Facturación e IDP
 REGEX_CIF = r'[ABCDEFGHJNPQRSUVW][0-9]{7}[A-Z0-9]|[0-9]{8}[TRWAGMYFPDXBNJZSQVHLCKE]'
@@ -25,10 +49,49 @@ REGEX_DATE = r'(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})'
 REGEX_AMOUNT = r'(\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{2,}))'
 REGEX_IVA_LABEL = r'(?i)(?:IVA|CUOTA|I\.V\.A\.|IMPUESTO)[\s:º=]*(\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{2,}))'
 REGEX_BASE_LABEL = r'(?i)(?:BASE|B\.I\.|BI|NETO|SUBTOTAL)[\s:º=]*(\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{2,}))'
+REGEX_INVOICE_NUMBER = r'(?:FACTURA|INVOICE|RECIBO|Nº|FACT[\.\s])[\s:º]*([A-Z0-9\-/]+)'
+REGEX_TEMPLATE_CIF = r'[A-Z]?[0-9]{8}[A-Z]?'  # CIF dentro de la zona de plantilla (ya normalizada)
+
+# Compiladas una vez al importar: nada se compila por factura
+CIF_PATTERN = re.compile(REGEX_CIF)
+DATE_PATTERN = re.compile(REGEX_DATE)
+AMOUNT_PATTERN = re.compile(REGEX_AMOUNT)
+IVA_LABEL_PATTERN = re.compile(REGEX_IVA_LABEL)
+BASE_LABEL_PATTERN = re.compile(REGEX_BASE_LABEL)
+INVOICE_NUMBER_PATTERN = re.compile(REGEX_INVOICE_NUMBER, re.IGNORECASE)
+TEMPLATE_CIF_PATTERN = re.compile(REGEX_TEMPLATE_CIF)
+NON_ALNUM_PATTERN = re.compile(r'[^A-Z0-9]')
+
+# Palabras clave (en mayúsculas) que identifican el documento como factura
+INVOICE_KEYWORDS = ["FACTURA", "INVOICE", "ALBARAN", "CREDIT NOTE"]
+
+# Versión de la lógica de parse_fields (regex, detección de CIF, plantillas, matching).
+# Subirla al cambiar cómo se extraen los campos: invalida los resultados ya cacheados
+PARSER_VERSION = 1
 
 # CIF de JOFEG (cliente) - EXCLUIR de la detección de proveedor
 JOFEG_CIF = "A28346245"
 
+# Importes que, si la plantilla los deja vacíos, se piden a Claude sólo por su zona
+AMOUNT_FIELDS = ["base_imponible", "iva_importe", "total_amount"]
+
+# Columnas del Excel de resumen (Interno -> Visual)
+# Proveedor (nombre), Nº Factura, Fecha, CIF, Base Imponible, Iva, Total factura, Conta
+EXCEL_COLUMN_MAP = {
+    'supplier_name_erp': 'Proveedor',
+    'invoice_number': 'Nº Factura',
+    'invoice_date': 'Fecha',
+    'supplier_tax_id': 'CIF',
+    'base_imponible': 'Base Imponible',
+    'iva_importe': 'Iva',
+    'total_amount': 'Total factura',
+    'supplier_account': 'Conta',
+    'file_path': 'file_path',
+    'status': 'status',
+    'file_name': 'file_name'
+}
+EXCEL_COLUMNS = ['Proveedor', 'Nº Factura', 'Fecha', 'CIF', 'Base Imponible', 'Iva', 'Total factura', 'Conta', 'file_name', 'file_path', 'status']
+
 # ==============================================================================
 # LOGGING (Trazabilidad e-EMGDE)
 # ==============================================================================
@@ -41,6 +104,21 @@ logging.basicConfig(
     ]
 )
 
+class PendingClaude:
+    """Factura procesada en local a la espera de la respuesta de Claude (fallback asíncrono)"""
+    def __init__(self, row, text, meta, results, request, content_hash, outcome_version, regions=None,
+                 normalized=None):
+        self.row = row
+        self.text = text
+        self.normalized = normalized
+        self.meta = meta
+        self.results = results
+        self.request = request
+        self.content_hash = content_hash
+        self.outcome_version = outcome_version
+        self.regions = regions
+        self.future = None
+
 class JofegIDPProcessor:
     def __init__(self, use_claude_api=True, claude_as_fallback_only=True):
         """
@@ -48,14 +126,25 @@ class JofegIDPProcessor:
             use_claude_api: Si True, usa Claude API cuando sea necesario
             claude_as_fallback_only: Si True, solo usa Claude API cuando no hay plantilla
         """
+        self.state_journal = StateJournal(STATE_PATH)
         self.state = self._load_state()
         self.suppliers = self._load_suppliers()
         self.templates = self._load_templates()
+        self.extraction_cache = ExtractionCache(EXTRACTION_CACHE_DIR)
         self._ensure_output_dir()
+        self.results_store = ResultStore(RESULTS_DB_PATH)
+        # Primera ejecución con almacén: se parte del histórico del Excel existente
+        self.results_store.import_excel(OUTPUT_XLSX, EXCEL_COLUMN_MAP)
         
         # Configuración de Claude API
         self.use_claude_api = use_claude_api
         self.claude_as_fallback_only = claude_as_fallback_only
+        self._init_claude_extractor()
+        # Se calcula una vez (hashea todas las plantillas); quien recargue plantillas o maestro la actualiza
+        self.outcome_version = self._outcome_version()
+        self.run_stats = Counter()
+
+    def _init_claude_extractor(self):
         self.claude_extractor = None
         
         if self.use_claude_api:
@@ -66,6 +155,67 @@ class JofegIDPProcessor:
             except Exception as e:
                 logging.warning(f"Claude API no disponible: {e}")
 
+    def _drain_stats(self):
+        """Contadores acumulados desde la última llamada (Claude: caché, llamadas, errores)"""
+        stats = Counter()
+        if self.claude_extractor:
+            stats.update(self.claude_extractor.drain_stats())
+        return stats
+
+    def _drain_usage(self):
+        """Registros de uso de Claude (uno por llamada) acumulados desde la última llamada"""
+        return self.claude_extractor.drain_usage() if self.claude_extractor else []
+
+    def _log_run_summary(self):
+        stats = self.run_stats
+        if not stats:
+            return
+        lookups = stats["cache_hits"] + stats["cache_misses"]
+        hit_rate = stats["cache_hits"] / lookups * 100 if lookups else 0
+        logging.info(f"Resumen Claude: {stats['api_calls']} llamadas API, {stats['api_errors']} errores, "
+                     f"{stats['retries']} reintentos, {stats['batch_requests']} en lote, {stats['region_requests']} por zonas | "
+                     f"Caché respuestas: {stats['cache_hits']} aciertos / {stats['cache_misses']} fallos ({hit_rate:.0f}%)")
+        tiers = [f"{name} {stats[f'calls_{tier}']} llamadas / {stats[f'ms_{tier}'] // stats[f'calls_{tier}']} ms media"
+                 for tier, name in (("text", "texto"), ("vision", "visión"), ("regions", "zonas"))
+                 if stats[f"calls_{tier}"]]
+        if tiers:
+            logging.info(f"Claude por nivel: {', '.join(tiers)} | "
+                         f"{stats['text_escalations']} escaladas de texto a visión")
+        # Las respuestas por lotes tienen coste pero no latencia por llamada
+        models = sorted({key.split("_model_", 1)[1] for key in stats if key.startswith(("calls_model_", "cost_model_"))})
+        if models:
+            per_model = []
+            for model in models:
+                calls = stats[f"calls_model_{model}"]
+                latency = f"{stats[f'ms_model_{model}'] // calls} ms media / " if calls else ""
+                per_model.append(f"{model} {calls} llamadas / {latency}${stats[f'cost_model_{model}']:.4f}")
+            logging.info(f"Claude por modelo: {', '.join(per_model)} | "
+                         f"{stats['model_escalations']} escaladas a un modelo superior")
+        if stats["image_bytes"]:
+            logging.info(f"Imágenes enviadas: {stats['image_bytes'] / 1024 / 1024:.1f} MB, ~{stats['image_tokens']} tokens de imagen")
+        if stats["image_documents"]:
+            # Por factura con páginas renderizadas (las peticiones por zonas no cuentan: no hay página de referencia)
+            documents = stats["image_documents"]
+            sent = stats["image_bytes"] - stats["region_image_bytes"]
+            tokens = stats["image_tokens"] - stats["region_image_tokens"]
+            saved = stats["image_bytes_legacy"] - sent
+            logging.info(f"Imágenes por factura: {sent / documents / 1024:.0f} KB y ~{tokens // documents} tokens de media; "
+                         f"{saved / documents / 1024:.0f} KB menos que RGB sin comprimir a 300 DPI ({documents} facturas)")
+
+    def __getstate__(self):
+        """Copia enviada a los procesos del pool: sin estado incremental ni cliente de Claude"""
+        state = self.__dict__.copy()
+        state['state'] = {}
+        state.pop('state_journal', None)
+        state.pop('crawler', None)
+        state.pop('claude_extractor', None)
+        return state
+
+    def __setstate__(self, state):
+        # Cada proceso del pool crea su propio cliente de Claude (no es serializable)
+        self.__dict__.update(state)
+        self._init_claude_extractor()
+
     def _load_templates(self):
         if os.path.exists(TEMPLATES_PATH):
             try:
@@ -80,68 +230,95 @@ class JofegIDPProcessor:
         logging.warning(f"No se encontró archivo de plantillas en {TEMPLATES_PATH}")
         return {}
 
+    def _outcome_version(self):
+        """Versión de las entradas que pueden cambiar el resultado de una factura ya extraída"""
+        templates_hash = hashlib.sha256(json.dumps(self.templates, sort_keys=True).encode()).hexdigest()[:16]
+        claude_mode = "claude" if self.claude_extractor else "local"
+        return f"p{PARSER_VERSION}-{templates_hash}-{self.suppliers.version}-{claude_mode}"
+
     def _ensure_output_dir(self):
         os.makedirs(os.path.dirname(OUTPUT_XLSX), exist_ok=True)
 
     def _load_state(self):
-        if os.path.exists(STATE_PATH):
-            try:
-                with open(STATE_PATH, 'r') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
+        return self.state_journal.load()
 
     def _save_state(self):
-        with open(STATE_PATH, 'w') as f:
-            json.dump(self.state, f, indent=4)
+        """Compacta el estado en processing_state.json (el diario guarda cada factura al procesarla)"""
+        self.state_journal.compact(self.state)
 
     def _load_suppliers(self):
-        """Carga y normaliza el maestro de proveedores (PROVEE.csv)"""
+        """Carga y normaliza el maestro de proveedores (PROVEE.csv) en un índice por CIF y cuenta
+
+        El índice compilado se guarda en una caché local (SUPPLIER_CACHE_PATH). Si el CSV
+        no ha cambiado (mtime + tamaño) se usa directamente sin leer la unidad de red; si
+        sólo ha cambiado el mtime pero el contenido es idéntico (hash) también se reutiliza.
+        """
         try:
             if not os.path.exists(PROVEE_CSV_PATH):
                 logging.warning(f"No se encontró el archivo maestro en {PROVEE_CSV_PATH}")
-                return pd.DataFrame(columns=['CUENTA', 'NOMBRE', 'CIF', 'CIF_NORM'])
-            
-            # Carga de columnas específicas: 0:CUENTA, 1:NOMBRE, 9:CIF
-            df = pd.read_csv(PROVEE_CSV_PATH, header=None, encoding='latin1', dtype=str)
-            df = df[[0, 1, 9]]
-            df.columns = ['CUENTA', 'NOMBRE', 'CIF']
-            df['CIF_NORM'] = df['CIF'].apply(self.normalize_id)
-            logging.info(f"Maestro cargado: {len(df)} proveedores.")
-            return df
+                return SupplierIndex()
+
+            stats = os.stat(PROVEE_CSV_PATH)
+            source_stat = [stats.st_mtime_ns, stats.st_size]
+            cached = SupplierIndex.load_cache(SUPPLIER_CACHE_PATH)
+            if cached and cached["source_stat"] == source_stat:
+                index = cached["index"]
+                logging.info(f"Maestro cargado desde caché: {len(index)} proveedores (versión {index.version}).")
+                return index
+
+            with open(PROVEE_CSV_PATH, 'rb') as f:
+                data = f.read()
+            version = hashlib.sha256(data).hexdigest()[:16]
+
+            if cached and cached["index"].version == version:
+                index = cached["index"]
+                logging.info(f"PROVEE.csv modificado sin cambios de contenido. Reutilizando índice {version}.")
+            else:
+                # Carga de columnas específicas: 0:CUENTA, 1:NOMBRE, 9:CIF
+                df = pd.read_csv(io.BytesIO(data), header=None, encoding='latin1', dtype=str)
+                df = df[[0, 1, 9]]
+                df.columns = ['CUENTA', 'NOMBRE', 'CIF']
+                df['CIF_NORM'] = df['CIF'].apply(self.normalize_id)
+                index = SupplierIndex.from_dataframe(df, version)
+                logging.info(f"Maestro cargado: {len(index)} proveedores ({len(index.by_cif)} CIFs distintos).")
+
+            try:
+                index.save(SUPPLIER_CACHE_PATH, source_stat)
+            except OSError as e:
+                logging.warning(f"No se pudo guardar la caché del maestro: {e}")
+            return index
         except Exception as e:
             logging.error(f"Error cargando maestro de proveedores: {e}")
-            return pd.DataFrame(columns=['CUENTA', 'NOMBRE', 'CIF', 'CIF_NORM'])
+            return SupplierIndex()
 
     @staticmethod
     def normalize_id(text):
         """Limpia CIF/NIF de caracteres especiales para matching exacto"""
         if not text or pd.isna(text): return ""
-        norm = re.sub(r'[^A-Z0-9]', '', str(text).upper())
+        norm = NON_ALNUM_PATTERN.sub('', str(text).upper())
         # Eliminar prefijo ES si está presente (común en facturas pero no en ERP)
         if norm.startswith("ES") and len(norm) > 7:
             return norm[2:]
         return norm
 
-    def get_file_fingerprint(self, filepath):
-        """Genera una huella digital única (mtime + size) para procesamiento incremental"""
-        stats = os.stat(filepath)
-        return f"{stats.st_mtime}-{stats.st_size}"
+    def extract_idp_data(self, pdf_path, document=None):
+        """Extrae texto, metadatos y valida cumplimiento PDF/A
 
-    def extract_idp_data(self, pdf_path):
-        """Extrae texto, metadatos y valida cumplimiento PDF/A"""
-        text = ""
+        Args:
+            document: InvoiceDocument ya abierto (evita volver a leer el PDF de la red)
+        """
         metadata = {}
         try:
-            doc = fitz.open(pdf_path)
-            metadata['pages'] = len(doc)
-            metadata['format'] = doc.metadata.get('format', 'Desconocido')
-            metadata['is_pdfa'] = 'pdfa' in str(doc.metadata).lower()
-            
-            for page in doc:
-                text += page.get_text()
-            doc.close()
+            if document is None:
+                with InvoiceDocument(pdf_path) as document:
+                    return self.extract_idp_data(pdf_path, document)
+
+            with METRICS.span("pdf_open"):
+                metadata['pages'] = len(document)
+                metadata['format'] = document.metadata.get('format', 'Desconocido')
+                metadata['is_pdfa'] = 'pdfa' in str(document.metadata).lower()
+            with METRICS.span("get_text"):
+                text = document.text
         except Exception as e:
             logging.error(f"Error procesando {pdf_path.name}: {e}")
             return None, None, str(e)
@@ -149,117 +326,120 @@ class JofegIDPProcessor:
         return text, metadata, None
 
     def get_cif_context(self, text, cif):
-        """Busca el CIF en el texto original (no normalizado) y devuelve su contexto"""
+        """Busca el CIF en el texto original (no normalizado) y devuelve su contexto
+
+        Args:
+            text: texto de la factura o su NormalizedText (evita volver a normalizarlo)
+        """
         if not cif: return ""
-        # Regex flexible para encontrar el CIF con posibles separadores
-        pattern = "".join([f"{re.escape(c)}[\\s\\.-]*" for c in cif]).rstrip("[\\s\\.-]*")
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            start = max(0, match.start() - 30)
-            end = min(len(text), match.end() + 30)
-            context = text[start:end].replace('\n', ' ')
-            return f"...{context}..."
-        return ""
-
-    def parse_fields(self, text, doc=None, pdf_path=None):
-        """Extrae campos mediante plantillas (si existen), Claude API o regex"""
+        # El CIF se busca en la vista compacta y se traduce a posiciones del texto original,
+        # admitiendo separadores (espacios, puntos, guiones) entre sus caracteres
+        normalized = text if isinstance(text, NormalizedText) else NormalizedText(text)
+        return normalized.context(cif)
+
+    def parse_fields(self, text, doc=None, pdf_path=None, normalized=None):
+        """Extrae campos mediante plantillas (si existen), Claude API o regex
+
+        Args:
+            normalized: NormalizedText de text si ya se ha calculado
+        """
+        results, should_use_claude, claude_regions = self._parse_local(text, doc, pdf_path, normalized)
+        if results["extraction_method"] == "FAILED":
+            return results
+
+        if should_use_claude:
+            claude_results = None
+            try:
+                logging.info(f"Usando Claude API para {Path(pdf_path).name}")
+                claude_results = self.claude_extractor.extract_from_pdf(
+                    pdf_path, document=doc, regions=claude_regions, text=text)
+            except Exception as e:
+                logging.error(f"Error en Claude API para {Path(pdf_path).name}: {e}")
+            self._apply_claude_results(results, claude_results, pdf_path)
+
+        return self._complete_with_regex(results, text)
+
+    def _parse_local(self, text, doc=None, pdf_path=None, normalized=None):
+        """
+        Parte local de parse_fields: CIF, plantilla y matching ERP (sin llamar a Claude)
+
+        Args:
+            normalized: NormalizedText de text (mayúsculas, tokens y vista compacta en una pasada)
+
+        Returns:
+            (results, should_use_claude, claude_regions) donde claude_regions es {campo: bbox}
+            de la plantilla cuando basta con enviar esas zonas a Claude (Caso B), o None
+        """
         # --- NUEVO: Verificación de si es FACTURA ---
-        keywords = ["FACTURA", "INVOICE", "ALBARAN", "CREDIT NOTE"]
-        if not any(k in text.upper() for k in keywords):
-            logging.warning(f"No se detectaron palabras clave de factura en {pdf_path.name if pdf_path else 'documento'}")
-            return {"status": "ERROR: No es factura", "extraction_method": "FAILED"}
-
-        # 1. Identificar CIF para ver si hay plantilla
-        # Limpieza básica para regex pero sin normalizar el 'ES' aquí todavía
-        clean_text = re.sub(r'[^A-Z0-9]', '', text.upper())
-        cifs = re.findall(REGEX_CIF, clean_text)
+        with METRICS.span("cif_regex"):
+            if normalized is None:
+                normalized = NormalizedText(text)
+            if not normalized.contains_any(INVOICE_KEYWORDS):
+                logging.warning(f"No se detectaron palabras clave de factura en {pdf_path.name if pdf_path else 'documento'}")
+                return {"status": "ERROR: No es factura", "extraction_method": "FAILED"}, False, None
+
+            # 1. Identificar CIF para ver si hay plantilla
+            # Limpieza básica para regex pero sin normalizar el 'ES' aquí todavía
+            cifs = CIF_PATTERN.findall(normalized.compact)
         
-        # Filtrar duplicados y el CIF de JOFEG
-        unique_cifs = [c for c in dict.fromkeys(cifs) if c != JOFEG_CIF and c != "ES" + JOFEG_CIF]
+            # Filtrar duplicados y el CIF de JOFEG
+            unique_cifs = [c for c in dict.fromkeys(cifs) if c != JOFEG_CIF and c != "ES" + JOFEG_CIF]
 
         # --- NUEVO: Fallback por NOMBRE DE PROVEEDOR (Tu idea de la División 2) ---
         # Si no encontramos CIF, buscamos si aparece el NOMBRE de algún proveedor conocido
-        if not unique_cifs:
-            logging.info("CIF no encontrado. Buscando por Nombre de Proveedor en el texto...")
-            # Optimizacion: Ordenar proveedores por longitud de nombre (primero los largos para evitar "SOL" dentro de "SOLUCIONES")
-            # Filtrar nombres muy cortos (< 4) para evitar falsos positivos
-            
-            # Crear lista temporal si no existe
-            if not hasattr(self, 'cached_names'):
-                self.cached_names = []
-                # Sufijos legales a ignorar para matching parcial robusto
-                legal_suffixes = [
-                    r'\bS\.?L\.?U?\.?\b', r'\bS\.?A\.?U?\.?\b', r'\bS\.?C\.?\b', 
-                    r'\bS\.?R\.?L\.?\b', r'\bLIMITADA\b', r'\bSOCIEDAD\b', r'\bANONIMA\b'
-                ]
-                suffix_pattern = re.compile('|'.join(legal_suffixes), re.IGNORECASE)
-
-                for idx, row in self.suppliers.iterrows():
-                    raw_name = str(row['NOMBRE']).strip().upper()
-                    if len(raw_name) < 3: continue
-
-                    # 1. Limpiar caracteres raros dejando letras y números
-                    clean_name = re.sub(r'[^A-Z0-9\s]', ' ', raw_name)
-                    
-                    # 2. Quitar sufijos legales (ej. "EMPRESA S.L." -> "EMPRESA")
-                    core_name = suffix_pattern.sub('', clean_name).strip()
-                    
-                    # 3. Compactar espacios
-                    core_name = re.sub(r'\s+', ' ', core_name).strip()
-
-                    # Solo usar si queda un nombre significativo (> 3 chars y no es solo números)
-                    if len(core_name) > 3 and not core_name.isdigit():
-                        self.cached_names.append((core_name, row['CIF_NORM'], row['CIF']))
-                
-                # Ordenar por longitud descendente (priorizar nombres largos para evitar falsos positivos)
-                self.cached_names.sort(key=lambda x: len(x[0]), reverse=True)
-
-            normalized_text = re.sub(r'[^A-Z0-9\s]', '', text.upper())
-            
-            for name, cif_norm, raw_cif_erp in self.cached_names:
-                if name in normalized_text:
-                    unique_cifs = [raw_cif_erp]
-                    logging.info(f"Fallback ÉXITO: Proveedor identificado por nombre '{name}' -> CIF {raw_cif_erp}")
-                    break
+        with METRICS.span("supplier_match"):
+            if not unique_cifs:
+                logging.info("CIF no encontrado. Buscando por Nombre de Proveedor en el texto...")
+                # Una sola pasada del autómata (construido al cargar el maestro) devuelve todos
+                # los proveedores nombrados; los nombres largos y repetidos van primero
+                candidates = self.suppliers.find_names(text, normalized.tokens)
+                if candidates:
+                    unique_cifs = [cif for cif, _ in candidates]
+                    best_cif, best_hits = candidates[0]
+                    best_name = max(best_hits, key=lambda hit: len(hit.name)).name
+                    logging.info(f"Fallback ÉXITO: Proveedor identificado por nombre '{best_name}' "
+                                 f"(x{len(best_hits)}, pos {best_hits[0].start}) -> CIF {best_cif}")
+                    if len(candidates) > 1:
+                        logging.info(f"Otros proveedores nombrados en el texto: {unique_cifs[1:]}")
 
-        # --- NUEVO: Fallback agresivo para PDFs con texto basura (OCR malo) ---
-        # Si sigue sin haber CIFs, mirar si el NOMBRE DEL ARCHIVO contiene un CIF conocido
-        if not unique_cifs and pdf_path:
-            filename = Path(pdf_path).name.upper()
-            for known_cif in self.templates.keys():
-                if known_cif in filename:
-                    unique_cifs = [known_cif]
-                    logging.info(f"Fallback: CIF {known_cif} encontrado en el nombre del archivo (Texto basura détectado)")
-                    break
+            # --- NUEVO: Fallback agresivo para PDFs con texto basura (OCR malo) ---
+            # Si sigue sin haber CIFs, mirar si el NOMBRE DEL ARCHIVO contiene un CIF conocido
+            if not unique_cifs and pdf_path:
+                filename = Path(pdf_path).name.upper()
+                for known_cif in self.templates.keys():
+                    if known_cif in filename:
+                        unique_cifs = [known_cif]
+                        logging.info(f"Fallback: CIF {known_cif} encontrado en el nombre del archivo (Texto basura détectado)")
+                        break
 
-        # BUSCAR PLANTILLA O ERP: Probar todos los CIFs detectados para elegir el mejor
-        primary_cif = None
-        raw_cif = None
+            # BUSCAR PLANTILLA O ERP: Probar todos los CIFs detectados para elegir el mejor
+            primary_cif = None
+            raw_cif = None
         
-        # Prioridad 1: CIF con Plantilla
-        for cif in unique_cifs:
-            norm = self.normalize_id(cif)
-            if norm in self.templates:
-                primary_cif = norm
-                raw_cif = cif
-                logging.info(f"Prioridad 1: Coincidencia por PLANTILLA para {cif}")
-                break
-        
-        # Prioridad 2: CIF con ERP (si no hay plantilla arriba)
-        if not primary_cif:
+            # Prioridad 1: CIF con Plantilla
             for cif in unique_cifs:
                 norm = self.normalize_id(cif)
-                if not self.suppliers[self.suppliers['CIF_NORM'] == norm].empty:
+                if norm in self.templates:
                     primary_cif = norm
                     raw_cif = cif
-                    logging.info(f"Prioridad 2: Coincidencia por ERP para {cif}")
+                    logging.info(f"Prioridad 1: Coincidencia por PLANTILLA para {cif}")
                     break
+        
+            # Prioridad 2: CIF con ERP (si no hay plantilla arriba)
+            if not primary_cif:
+                for cif in unique_cifs:
+                    norm = self.normalize_id(cif)
+                    if norm in self.suppliers:
+                        primary_cif = norm
+                        raw_cif = cif
+                        logging.info(f"Prioridad 2: Coincidencia por ERP para {cif}")
+                        break
             
-        # Prioridad 3: Primer CIF encontrado (si nada más sirve)
-        if not raw_cif and unique_cifs:
-            raw_cif = unique_cifs[0]
-            primary_cif = self.normalize_id(raw_cif)
-            logging.info(f"Prioridad 3: Usando primer CIF detectado: {raw_cif}")
+            # Prioridad 3: Primer CIF encontrado (si nada más sirve)
+            if not raw_cif and unique_cifs:
+                raw_cif = unique_cifs[0]
+                primary_cif = self.normalize_id(raw_cif)
+                logging.info(f"Prioridad 3: Usando primer CIF detectado: {raw_cif}")
 
         logging.info(f"Elegido: {raw_cif} (Normalizado: {primary_cif}) de entre {unique_cifs}")
 
@@ -272,7 +452,7 @@ class JofegIDPProcessor:
             "base_imponible": None,
             "iva_importe": None,
             "total_amount": None,
-            "currency": "EUR" if "€" in text or "EUR" in text.upper() else "N/A",
+            "currency": "EUR" if "€" in text or "EUR" in normalized.upper else "N/A",
             "extraction_method": "REGEX",
             "status": "OK"
         }
@@ -283,42 +463,43 @@ class JofegIDPProcessor:
             template = self.templates[primary_cif]
             results["extraction_method"] = "TEMPLATE"
             page = doc[0]
-            for field, info in template.get("fields", {}).items():
-                rect = fitz.Rect(info["bbox"])
-                field_text = page.get_text("text", clip=rect).strip()
+            with METRICS.span("template_zones"):
+                for field, info in template.get("fields", {}).items():
+                    rect = fitz.Rect(info["bbox"])
+                    field_text = page.get_text("text", clip=rect).strip()
                 
-                # REGLA DE CONFIANZA (Template Trust):
-                # Si el campo es el CIF y está vacío (p.e. imagen sombreada), heredar de la plantilla
-                if field == "supplier_tax_id" and not field_text:
-                    logging.info(f"CIF vacío en zona de plantilla. Usando CIF de plantilla: {primary_cif}")
-                    results[field] = primary_cif
-                elif field == "supplier_tax_id" and field_text:
-                    # Búsqueda inteligente dentro del cuadro
-                    cif_pattern = r'[A-Z]?[0-9]{8}[A-Z]?'
-                    matches = re.findall(cif_pattern, self.normalize_id(field_text))
-                    results[field] = matches[0] if matches else field_text
-                else:
-                    results[field] = field_text
+                    # REGLA DE CONFIANZA (Template Trust):
+                    # Si el campo es el CIF y está vacío (p.e. imagen sombreada), heredar de la plantilla
+                    if field == "supplier_tax_id" and not field_text:
+                        logging.info(f"CIF vacío en zona de plantilla. Usando CIF de plantilla: {primary_cif}")
+                        results[field] = primary_cif
+                    elif field == "supplier_tax_id" and field_text:
+                        # Búsqueda inteligente dentro del cuadro
+                        matches = TEMPLATE_CIF_PATTERN.findall(self.normalize_id(field_text))
+                        results[field] = matches[0] if matches else field_text
+                    else:
+                        results[field] = field_text
 
         # 3. MATCHING CON MAESTRO ERP (Prioridad 1: CIF de resultados, Prioridad 2: CIFs detectados)
-        final_cif = self.normalize_id(results["supplier_tax_id"])
+        with METRICS.span("supplier_match"):
+            final_cif = self.normalize_id(results["supplier_tax_id"])
         
-        # Intentar buscar el proveedor en el ERP
-        match_data = self.suppliers[self.suppliers['CIF_NORM'] == final_cif]
+            # Intentar buscar el proveedor en el ERP
+            match_data = self.suppliers.lookup_cif(final_cif)
         
-        if match_data.empty and unique_cifs:
-            # Si el CIF de la plantilla/extracción no está en ERP, probar otros detectados
-            for c in unique_cifs:
-                norm_c = self.normalize_id(c)
-                match_data = self.suppliers[self.suppliers['CIF_NORM'] == norm_c]
-                if not match_data.empty:
-                    final_cif = norm_c
-                    results["supplier_tax_id"] = c
-                    logging.info(f"Cambiando a CIF detectado con match ERP: {final_cif}")
-                    break
+            if match_data is None and unique_cifs:
+                # Si el CIF de la plantilla/extracción no está en ERP, probar otros detectados
+                for c in unique_cifs:
+                    norm_c = self.normalize_id(c)
+                    match_data = self.suppliers.lookup_cif(norm_c)
+                    if match_data is not None:
+                        final_cif = norm_c
+                        results["supplier_tax_id"] = c
+                        logging.info(f"Cambiando a CIF detectado con match ERP: {final_cif}")
+                        break
         
         # Si sigue sin match ERP pero tenemos plantilla, permitir procesar con aviso
-        if match_data.empty:
+        if match_data is None:
              if results["extraction_method"] == "TEMPLATE":
                  results["status"] = "OK (Proveedor no en ERP)"
                  logging.warning(f"Proveedor {results['supplier_tax_id']} detectado por plantilla pero no está en PROVEE.csv")
@@ -340,6 +521,7 @@ class JofegIDPProcessor:
         # A) No tenemos plantilla y está habilitado como fallback
         # B) Tenemos plantilla pero faltan datos críticos (y Claude está disponible)
         should_use_claude = False
+        claude_regions = None
         
         if self.use_claude_api and self.claude_extractor and pdf_path:
              if primary_cif not in self.templates:
@@ -351,256 +533,583 @@ class JofegIDPProcessor:
                  # Caso B: Hay plantilla pero faltan datos (Imagen, fondo oscuro, texto ilegible)
                  logging.info(f"Plantilla detectada pero faltan importes críticos en {Path(pdf_path).name}. Activando Claude fallback.")
                  should_use_claude = True
+                 # La plantilla ya sabe dónde están los importes: enviar sólo esas zonas
+                 template_fields = self.templates[primary_cif].get("fields", {})
+                 claude_regions = {
+                     field: template_fields[field]["bbox"]
+                     for field in AMOUNT_FIELDS
+                     if is_empty_amount(results.get(field)) and template_fields.get(field, {}).get("bbox")
+                 } or None
 
-        if should_use_claude:
-            
-            try:
-                logging.info(f"Usando Claude API para {Path(pdf_path).name}")
-                claude_results = self.claude_extractor.extract_from_pdf(pdf_path)
-                
-                if claude_results:
-                    # Usar resultados de Claude
-                    for key, value in claude_results.items():
-                        if value:
-                            results[key] = value
-                    
-                    logging.info(f"Claude API extrajo correctamente de {Path(pdf_path).name}")
-                else:
-                    logging.warning(f"Claude API no pudo extraer datos de {Path(pdf_path).name}")
+        return results, should_use_claude, claude_regions
+
+    def _apply_claude_results(self, results, claude_results, pdf_path):
+        """Fusiona la respuesta de Claude (o su ausencia) en los resultados locales"""
+        results["claude_fallback"] = "OK" if claude_results else "ERROR"
+        
+        if claude_results:
+            # Usar resultados de Claude
+            for key, value in claude_results.items():
+                if value:
+                    results[key] = value
             
-            except Exception as e:
-                logging.error(f"Error en Claude API para {Path(pdf_path).name}: {e}")
+            logging.info(f"Claude API extrajo correctamente de {Path(pdf_path).name}")
+        else:
+            logging.warning(f"Claude API no pudo extraer datos de {Path(pdf_path).name}")
 
+    def _complete_with_regex(self, results, text):
         # 4. Completar con REGEX los campos vacíos (último recurso)
-        if not results["invoice_number"]:
-            m = re.search(r'(?:FACTURA|INVOICE|RECIBO|Nº|FACT[\.\s])[\s:º]*([A-Z0-9\-/]+)', text, re.IGNORECASE)
-            results["invoice_number"] = m.group(1) if m else None
+        with METRICS.span("regex_complete"):
+            if not results["invoice_number"]:
+                m = INVOICE_NUMBER_PATTERN.search(text)
+                results["invoice_number"] = m.group(1) if m else None
         
-        if not results["invoice_date"]:
-            dates = re.findall(REGEX_DATE, text)
-            results["invoice_date"] = dates[0] if dates else None
+            if not results["invoice_date"]:
+                dates = DATE_PATTERN.findall(text)
+                results["invoice_date"] = dates[0] if dates else None
             
-        if not results["total_amount"]:
-            amounts = re.findall(REGEX_AMOUNT, text)
-            results["total_amount"] = amounts[-1] if amounts else None
+            if not results["total_amount"]:
+                amounts = AMOUNT_PATTERN.findall(text)
+                results["total_amount"] = amounts[-1] if amounts else None
 
-        if not results["base_imponible"]:
-            m = re.search(REGEX_BASE_LABEL, text)
-            results["base_imponible"] = m.group(1) if m else None
+            if not results["base_imponible"]:
+                m = BASE_LABEL_PATTERN.search(text)
+                results["base_imponible"] = m.group(1) if m else None
 
-        if not results["iva_importe"]:
-            m = re.search(REGEX_IVA_LABEL, text)
-            results["iva_importe"] = m.group(1) if m else None
+            if not results["iva_importe"]:
+                m = IVA_LABEL_PATTERN.search(text)
+                results["iva_importe"] = m.group(1) if m else None
 
         return results
 
     def _cleanup_stale_data(self, current_pdf_files):
-        """Elimina del Estado y del Excel los archivos que ya no existen en disco"""
-        current_paths = {str(p) for p in current_pdf_files}
+        """Elimina del Estado y del almacén de resultados los archivos que ya no existen en disco"""
+        current_paths = {entry.path for entry in current_pdf_files}
         
-        # 1. Limpiar State (JSON)
-        initial_state_count = len(self.state)
-        # Identificar claves que no están en los paths actuales
+        # 1. Limpiar State: cada borrado va al diario, sin reescribir el snapshot completo
         # Nota: las claves en state son str(absolute_path)
         keys_to_remove = [k for k in self.state if k not in current_paths]
         
         for k in keys_to_remove:
             del self.state[k]
+            self.state_journal.remove(k)
         
-        if len(self.state) < initial_state_count:
-            self._save_state()
-            logging.info(f"Limpieza de Estado: Se eliminaron {initial_state_count - len(self.state)} entradas obsoletas.")
+        if keys_to_remove:
+            self.state_journal.sync()
+            if self.state_journal.needs_compaction:
+                self._save_state()
+            logging.info(f"Limpieza de Estado: Se eliminaron {len(keys_to_remove)} entradas obsoletas.")
             
-        # 2. Limpiar Excel
-        if os.path.exists(OUTPUT_XLSX):
+        # 2. Limpiar almacén de resultados (el Excel se regenera a partir de él)
+        deleted = self.results_store.delete_missing(current_paths)
+        if deleted:
+            logging.info(f"Limpieza de resultados: Se eliminaron {deleted} facturas obsoletas.")
+
+    def _process_file(self, pdf_path, defer_claude=False, mtime=None):
+        """
+        Extrae, parsea y cruza con el ERP una factura. Devuelve la fila del Excel
+
+        Args:
+            mtime: fecha de modificación ya obtenida en el recorrido (evita un stat por red por PDF)
+            defer_claude: Si True y la factura necesita Claude, no se llama a la API aquí:
+                se devuelve un PendingClaude con la petición ya preparada para el despachador
+        """
+        if mtime is None:
+            mtime = os.path.getmtime(pdf_path)
+        row = {
+            "file_name": pdf_path.name,
+            "file_path": str(pdf_path),
+            "modified_datetime": datetime.fromtimestamp(mtime).isoformat(),
+            "guid": hashlib.sha256(str(pdf_path).encode()).hexdigest()[:12],
+            "status": "OK",
+            "error": ""
+        }
+
+        # Una única apertura/lectura del PDF para texto, plantilla y Claude
+        try:
+            with METRICS.span("pdf_read"):
+                document = InvoiceDocument(pdf_path)
+        except Exception as e:
+            logging.error(f"Error procesando {pdf_path.name}: {e}")
+            row.update({"status": "ERROR", "error": str(e)})
+            return row
+
+        with document:
+            # Caché por contenido: un PDF idéntico (aunque esté renombrado o copiado) no se
+            # vuelve a extraer, y sus campos sólo se recalculan si cambian plantillas/maestro
+            content_hash = document.content_hash
+            outcome_version = self.outcome_version
+            cached = self.extraction_cache.get(content_hash)
+
+            if cached and "text" in cached:
+                text, meta = cached["text"], cached["metadata"]
+            else:
+                text, meta, err = self.extract_idp_data(pdf_path, document)
+                if err:
+                    row.update({"status": "ERROR", "error": err})
+                    return row
+                self.extraction_cache.put_text(content_hash, text, meta)
+            # Una sola normalización del texto para CIF, nombres y contexto de depuración
+            normalized = NormalizedText(text)
+
+            if cached and outcome_version in cached.get("fields", {}):
+                fields = cached["fields"][outcome_version]
+                logging.info(f"Caché: {pdf_path.name} ya extraído ({content_hash[:12]}), reutilizando resultado")
+                return self._finish_row(row, text, meta, fields, normalized)
+
+            if not defer_claude:
+                fields = self.parse_fields(text, document, pdf_path=pdf_path, normalized=normalized)
+                self._store_fields(content_hash, outcome_version, fields)
+                return self._finish_row(row, text, meta, fields, normalized)
+
+            results, should_use_claude, claude_regions = self._parse_local(text, document, pdf_path, normalized)
+            if should_use_claude:
+                # Las imágenes se renderizan ahora, con el documento abierto; la llamada queda en cola
+                prepared = self.claude_extractor.prepare_request(
+                    pdf_path, document=document, regions=claude_regions, text=text)
+                pending = PendingClaude(row, text, meta, results, prepared, content_hash, outcome_version,
+                                        claude_regions, normalized)
+                if prepared is not None and not isinstance(prepared, dict):
+                    return pending
+                # Respuesta en caché (o error al preparar): se completa sin esperar
+                return self._complete_pending(pending, prepared)
+
+        fields = results if results["extraction_method"] == "FAILED" else self._complete_with_regex(results, text)
+        self._store_fields(content_hash, outcome_version, fields)
+        return self._finish_row(row, text, meta, fields, normalized)
+
+    def _store_fields(self, content_hash, outcome_version, fields):
+        # Un fallo transitorio de Claude no se cachea: se reintentará en la próxima ejecución
+        if fields.get("claude_fallback") != "ERROR":
+            self.extraction_cache.put_fields(content_hash, outcome_version, fields)
+
+    def _complete_pending(self, pending, claude_results):
+        """Termina una factura que esperaba a Claude: fusiona la respuesta, regex, caché y ERP"""
+        pdf_path = Path(pending.row["file_path"])
+        # Respuesta poco fiable (texto insuficiente, confianza baja, importes que no cuadran):
+        # se repite con imágenes o con un modelo superior (síncrono, poco frecuente)
+        claude_results = self.claude_extractor.escalate(claude_results, pdf_path, regions=pending.regions, text=pending.text)
+        self._apply_claude_results(pending.results, claude_results, pdf_path)
+        fields = self._complete_with_regex(pending.results, pending.text)
+        self._store_fields(pending.content_hash, pending.outcome_version, fields)
+        return self._finish_row(pending.row, pending.text, pending.meta, fields, pending.normalized)
+
+    def _resolve_pending(self, pending, recorded_keys=None):
+        """Espera la respuesta del despachador para una factura pendiente
+
+        Args:
+            recorded_keys: cache_key cuyo uso ya se ha registrado en esta ejecución. Las facturas
+                duplicadas comparten una única llamada: su uso y coste se apuntan sólo una vez
+        """
+        try:
+            # Lo que queda de la llamada cuando se llega a esta factura (cola del despachador incluida)
+            with METRICS.span("claude_wait"):
+                response = pending.future.result()
+            key = pending.request.cache_key
+            duplicate = recorded_keys is not None and key in recorded_keys
+            claude_results = self.claude_extractor.handle_response(pending.request, response, duplicate)
+            if recorded_keys is not None:
+                recorded_keys.add(key)
+        except Exception as e:
+            self.claude_extractor.stats["api_errors"] += 1
+            logging.error(f"Error en Claude API para {pending.row['file_name']}: {e}")
+            claude_results = None
+        return self._complete_pending(pending, claude_results)
+
+    def _run_claude_batch(self, pendings):
+        """Envía las facturas pendientes de Claude en lote y deja en cada una su Future resuelto"""
+        if not pendings:
+            return
+        logging.info(f"Enviando {len(pendings)} facturas a Claude por lotes (Message Batches)")
+        try:
+            with METRICS.span("claude_batch"):
+                outcomes = self.claude_extractor.run_batch([pending.request for pending in pendings])
+        except Exception as e:
+            # Los lotes ya enviados quedan apuntados y se recogen en la próxima ejecución
+            logging.error(f"Error en el lote de Claude: {e}")
+            outcomes = {}
+
+        for pending in pendings:
+            pending.future = Future()
+            outcome = outcomes.get(pending.request.cache_key)
+            if outcome is None:
+                pending.future.set_exception(RuntimeError("lote de Claude no completado"))
+            elif isinstance(outcome, Exception):
+                pending.future.set_exception(outcome)
+            else:
+                pending.future.set_result(outcome)
+
+    def _finish_row(self, row, text, meta, fields, normalized=None):
+        """Completa la fila del Excel con los campos extraídos y el matching ERP por CIF"""
+        pdf_name = row["file_name"]
+        row.update(fields)
+        row.update({
+            "pages": meta['pages'],
+            "is_pdfa_compliant": meta['is_pdfa'],
+            "text_preview": text[:2000].replace("\n", " "),
+            "text_len": len(text)
+        })
+
+        # Matching ERP por CIF
+        cif_norm = self.normalize_id(fields.get("supplier_tax_id", ""))
+        match = self.suppliers.lookup_cif(cif_norm)
+        
+        # Contexto para depuración
+        row["match_debug"] = self.get_cif_context(normalized or text, fields.get("supplier_tax_id", ""))
+
+        if match is not None:
+            row.update({
+                "supplier_name_erp": match['NOMBRE'],
+                "supplier_account": match['CUENTA'],
+                "match_method": "CIF",
+                "match_score": 100
+                # El status ya viene como "OK" de parse_fields
+            })
+        else:
+            row.update({
+                "supplier_name_erp": "",
+                "supplier_account": "",
+                "match_method": "NONE",
+                "match_score": 0
+            })
+            
+            # REGLA ORO: Si parse_fields ya decidió que es un éxito (por plantilla), NO degradar a NO_MATCH
+            if fields.get("status", "").startswith("OK"):
+                logging.info(f"Manteniendo status {fields['status']} (Template detected) para {pdf_name}")
+            else:
+                row["status"] = "NO_MATCH"
+                logging.warning(f"NO_MATCH: No se encontró proveedor para CIF {fields.get('supplier_tax_id')} en {pdf_name}")
+
+        return row
+
+    def _iter_processed(self, files, workers=None, defer_claude=False):
+        """
+        Procesa los PDFs (en secuencia o en el pool) y produce (fila o PendingClaude, contadores, uso, tiempos) en orden
+
+        Args:
+            files: lista de (ruta, mtime) del recorrido
+        """
+        if workers and workers > 1 and len(files) > 1:
+            logging.info(f"Procesando {len(files)} archivos con {workers} procesos en paralelo")
+            # El orden de map() es el de entrada: Excel y estado salen igual que en secuencial
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,))
             try:
-                df = pd.read_excel(OUTPUT_XLSX)
-                initial_rows = len(df)
-                
-                # Filtrar solo las que existen
-                # Aseguramos que file_path sea string para comparar
-                df_clean = df[df['file_path'].astype(str).isin(current_paths)]
-                
-                if len(df_clean) < initial_rows:
-                    df_clean.to_excel(OUTPUT_XLSX, index=False, engine='openpyxl')
-                    logging.info(f"Limpieza de Excel: Se eliminaron {initial_rows - len(df_clean)} filas obsoletas.")
-            except Exception as e:
-                logging.error(f"Error limpiando Excel: {e}")
+                worker_fn = partial(_process_file_in_worker, defer_claude=defer_claude)
+                yield from pool.map(worker_fn, files, chunksize=4)
+            finally:
+                # Si se cancela a mitad, los archivos aún no empezados no se procesan
+                pool.shutdown(wait=True, cancel_futures=True)
+        else:
+            for pdf_path, mtime in files:
+                with METRICS.document(pdf_path):
+                    row = self._process_file(pdf_path, defer_claude, mtime)
+                yield row, self._drain_stats(), self._drain_usage(), METRICS.drain()
 
-    def process_all(self):
+    def process_all(self, workers=None, claude_concurrency=None, claude_batch=False, export_excel=True,
+                    excel_by_month=False, full_rescan=False, exclude=(), retry_failed=True,
+                    progress=None, cancel=None, entries=None):
+        """
+        Args:
+            workers: Nº de procesos para extraer/parsear en paralelo (None o 1 = secuencial)
+            claude_concurrency: Nº de llamadas a Claude en vuelo a la vez. Si se indica, el
+                fallback se despacha de forma asíncrona y el resto de PDFs sigue procesándose
+            claude_batch: Si True, todas las facturas que necesitan Claude se envían al final
+                por la Message Batches API (backfills grandes: mitad de coste, sin latencia por factura)
+            export_excel: Si True, regenera el Excel de resumen desde el almacén al terminar
+            excel_by_month: Si True, el Excel se parte en un libro por mes de factura
+            full_rescan: Si True, relista todos los directorios aunque su mtime no haya cambiado
+            exclude: Rutas (str) que se dejan para otra ejecución (p.ej. aún copiándose)
+            retry_failed: Si True, se reprocesan siempre los NO_MATCH/ERROR previos
+            progress: función que recibe un dict por archivo (done/total, docs/s, ETA, fase,
+                llamadas a Claude en vuelo o None sin claude_concurrency); se llama desde el hilo
+                que ejecuta process_all
+            cancel: threading.Event; si se activa, se deja de procesar tras la factura en curso,
+                se guarda lo terminado y se compacta el estado
+            entries: CrawlEntry de un recorrido ya hecho por quien llama (modo servicio); si se
+                indica no se vuelve a recorrer INPUT_PDF_DIR (full_rescan no se aplica)
+        Returns:
+            Lista de filas procesadas en esta ejecución
+        """
         results = []
+        self.run_stats = Counter()
+        METRICS.reset()
         if not os.path.exists(INPUT_PDF_DIR):
             logging.error(f"Directorio de entrada no existe: {INPUT_PDF_DIR}")
-            return
+            return results
 
-        pdf_files = list(Path(INPUT_PDF_DIR).glob("**/*.pdf"))
+        if entries is not None:
+            pdf_files = entries
+        else:
+            with METRICS.span("scan"):
+                pdf_files = self._scan_inputs(full_rescan)
         logging.info(f"Analizando {len(pdf_files)} archivos en {INPUT_PDF_DIR}")
 
         # LIMPIEZA: Eliminar registros de archivos que ya no existen
         self._cleanup_stale_data(pdf_files)
 
-        # Cargar estados previos del Excel para forzar reprocesamiento de errores
-        previous_statuses = {}
-        if os.path.exists(OUTPUT_XLSX):
-            try:
-                df_prev = pd.read_excel(OUTPUT_XLSX)
-                # Crear diccionario {file_path: status}
-                previous_statuses = dict(zip(df_prev['file_path'].astype(str), df_prev['status']))
-            except:
-                pass
-
-        for pdf_path in pdf_files:
-            fingerprint = self.get_file_fingerprint(pdf_path)
-            file_key = str(pdf_path)
-
-            # Incremental: Saltamos si ya está procesado y no ha cambiado
-            # EXCEPCIÓN: Si el estado previo fue NO_MATCH o ERROR, reprocesamos SIEMPRE
-            prev_status = previous_statuses.get(file_key, "UNKNOWN")
-            force_reprocess = (prev_status in ["NO_MATCH", "ERROR"])
-            
-            if not force_reprocess and file_key in self.state and self.state[file_key] == fingerprint:
-                continue
+        pending = [(pdf_path, fingerprint) for pdf_path, fingerprint in self._find_pending(pdf_files, retry_failed)
+                   if str(pdf_path) not in exclude]
+        self.plan(len(pending))
 
-            row = {
-                "file_name": pdf_path.name,
-                "file_path": str(pdf_path),
-                "modified_datetime": datetime.fromtimestamp(os.path.getmtime(pdf_path)).isoformat(),
-                "guid": hashlib.sha256(str(pdf_path).encode()).hexdigest()[:12],
-                "status": "OK",
-                "error": ""
-            }
-
-            text, meta, err = self.extract_idp_data(pdf_path)
-            if err:
-                row.update({"status": "ERROR", "error": err})
-                results.append(row)
-                continue
+        run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+        started = time.monotonic()
+        usage = []
+        # El mtime también viene del recorrido: sin os.stat por archivo al construir la fila
+        mtimes = {entry.path: entry.mtime for entry in pdf_files}
+        pending_files = [(pdf_path, mtimes.get(str(pdf_path))) for pdf_path, _ in pending]
+        dispatcher = None
 
-            # Necesitamos el documento abierto para el parseo por coordenadas
-            doc = fitz.open(pdf_path)
-            fields = self.parse_fields(text, doc, pdf_path=pdf_path)
-            doc.close()
-            
-            row.update(fields)
-            row.update({
-                "pages": meta['pages'],
-                "is_pdfa_compliant": meta['is_pdfa'],
-                "text_preview": text[:2000].replace("\n", " "),
-                "text_len": len(text)
-            })
+        if claude_concurrency and self.claude_extractor:
+            from claude_dispatcher import ClaudeDispatcher, DispatchCancelled
+            dispatcher = ClaudeDispatcher(self.claude_extractor.make_async_client, max_in_flight=claude_concurrency)
+            logging.info(f"Fallback Claude asíncrono: hasta {claude_concurrency} llamadas en vuelo")
 
-            # Matching ERP por CIF
-            cif_norm = self.normalize_id(fields.get("supplier_tax_id", ""))
-            match = self.suppliers[self.suppliers['CIF_NORM'] == cif_norm]
-            
-            # Contexto para depuración
-            row["match_debug"] = self.get_cif_context(text, fields.get("supplier_tax_id", ""))
-
-            if not match.empty:
-                row.update({
-                    "supplier_name_erp": match.iloc[0]['NOMBRE'],
-                    "supplier_account": match.iloc[0]['CUENTA'],
-                    "match_method": "CIF",
-                    "match_score": 100
-                    # El status ya viene como "OK" de parse_fields
-                })
-            else:
-                row.update({
-                    "supplier_name_erp": "",
-                    "supplier_account": "",
-                    "match_method": "NONE",
-                    "match_score": 0
-                })
-                
-                # REGLA ORO: Si parse_fields ya decidió que es un éxito (por plantilla), NO degradar a NO_MATCH
-                if fields.get("status", "").startswith("OK"):
-                    logging.info(f"Manteniendo status {fields['status']} (Template detected) para {pdf_path.name}")
+        if claude_batch and not self.claude_extractor:
+            claude_batch = False
+
+        rows = []
+        submitted = {}         # cache_key -> Future del despachador
+        recorded_keys = set()  # cache_key cuyo uso de Claude ya se ha registrado
+        cancelled = False
+        report = partial(self._report_progress, progress, len(pending), started)
+        try:
+            defer_claude = dispatcher is not None or claude_batch
+            processed = self._iter_processed(pending_files, workers, defer_claude=defer_claude)
+            for (pdf_path, fingerprint), (row, stats, row_usage, timings) in zip(pending, processed):
+                self.run_stats.update(stats)
+                usage.extend(row_usage)
+                METRICS.merge(timings)
+                if isinstance(row, PendingClaude):
+                    if dispatcher:
+                        # Un PDF duplicado (mismo contenido) espera la misma llamada en lugar de repetirla
+                        row.future = submitted.get(row.request.cache_key) or dispatcher.submit(row.request)
+                        submitted[row.request.cache_key] = row.future
                 else:
-                    row["status"] = "NO_MATCH"
-                    logging.warning(f"NO_MATCH: No se encontró proveedor para CIF {fields.get('supplier_tax_id')} en {pdf_path.name}")
+                    # Cada factura terminada queda guardada: un corte no obliga a repetirla
+                    self._persist_row(pdf_path, fingerprint, row)
+                rows.append(row)
+                report("procesando", len(rows), pdf_path.name, dispatcher)
+                if cancel is not None and cancel.is_set():
+                    cancelled = True
+                    processed.close()
+                    break
+
+            if claude_batch and not cancelled:
+                report("lote Claude", len(rows))
+                self._run_claude_batch([row for row in rows if isinstance(row, PendingClaude)])
 
-            results.append(row)
-            self.state[file_key] = fingerprint
+            # Recoger las respuestas de Claude pendientes (en el orden original de los archivos).
+            # Fase con su propio avance: facturas resueltas de las que esperaban a Claude
+            waiting = sum(1 for row in rows if isinstance(row, PendingClaude))
+            report_waiting = partial(self._report_progress, progress, waiting, time.monotonic())
+            resolved = 0
+            for i, ((pdf_path, fingerprint), row) in enumerate(zip(pending, rows)):
+                if not isinstance(row, PendingClaude):
+                    continue
+                if cancel is not None and cancel.is_set():
+                    cancelled = True
+                    if dispatcher:
+                        dispatcher.cancel_pending()
+                    # Las llamadas ya enviadas (pagadas) se esperan y se guardan; las encoladas quedan pendientes
+                    if row.future is None or isinstance(row.future.exception(), DispatchCancelled):
+                        continue
+                rows[i] = self._resolve_pending(row, recorded_keys)
+                self._persist_row(pdf_path, fingerprint, rows[i])
+                resolved += 1
+                report_waiting("esperando Claude", resolved, pdf_path.name, dispatcher)
+        finally:
+            if dispatcher:
+                self.run_stats.update(dispatcher.drain_stats())
+                dispatcher.close()
+            self.state_journal.close()
+        if cancelled:
+            rows = [row for row in rows if not isinstance(row, PendingClaude)]
+            logging.warning(f"Procesamiento cancelado: {len(rows)} de {len(pending)} archivos terminados y guardados.")
+        self.run_stats.update(self._drain_stats())
+        usage.extend(self._drain_usage())
+        if rows:
+            self._save_usage(run_id, rows, usage, time.monotonic() - started)
+        results.extend(rows)
 
         if results:
-            self.export(results)
             self._save_state()
+            if export_excel:
+                with METRICS.span("export"):
+                    self.export(by_month=excel_by_month)
             logging.info(f"Procesado finalizado. {len(results)} registros nuevos/actualizados.")
+            self._log_run_summary()
+            self._save_metrics(run_id, rows, usage, time.monotonic() - started)
         else:
             logging.info("No hay cambios detectados desde la última ejecución.")
+        return results
 
-    def export(self, data):
-        # Mapeo de columnas solicitado
-        # Proveedor (nombre), Nº Factura, Fecha, CIF, Base Imponible, Iva, Total factura, Conta
-        
-        # Sanitizar datos
-        import string
-        ILLEGAL_CHARACTERS_RE = re.compile(r'[\x00-\x08\x0b-\x0c\x0e-\x1f\x7f-\x9f]')
-        
-        for row in data:
-            for key, value in row.items():
-                if isinstance(value, str):
-                    row[key] = ILLEGAL_CHARACTERS_RE.sub('', value)
-        
-        df_new = pd.DataFrame(data)
-        
-        # Mapa de renombramiento (Interno -> Visual)
-        column_map = {
-            'supplier_name_erp': 'Proveedor',
-            'invoice_number': 'Nº Factura',
-            'invoice_date': 'Fecha',
-            'supplier_tax_id': 'CIF',
-            'base_imponible': 'Base Imponible',
-            'iva_importe': 'Iva',
-            'total_amount': 'Total factura',
-            'supplier_account': 'Conta',
-            'file_path': 'file_path',
-            'status': 'status',
-            'file_name': 'file_name'
-        }
-        
-        # Asegurar que df_new tenga todas las columnas internas antes de renombrar
-        for col in column_map.keys():
-            if col not in df_new.columns:
-                df_new[col] = ""
-        
-        # Renombrar df_new
-        df_new = df_new.rename(columns=column_map)
-        
-        # Columnas finales deseadas
-        final_cols = ['Proveedor', 'Nº Factura', 'Fecha', 'CIF', 'Base Imponible', 'Iva', 'Total factura', 'Conta', 'file_name', 'file_path', 'status']
-        
-        # Asegurar columnas en df_new
-        for col in final_cols:
-             if col not in df_new.columns:
-                 df_new[col] = ""
-        df_new = df_new[final_cols]
+    @staticmethod
+    def _report_progress(progress, total, started, stage, done, file_name=None, dispatcher=None):
+        """Envía a progress un evento con el avance, el ritmo (docs/s) y el tiempo restante estimado"""
+        if progress is None:
+            return
+        elapsed = time.monotonic() - started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        progress({
+            "stage": stage,
+            "done": done,
+            "total": total,
+            "file": file_name,
+            "docs_per_sec": rate,
+            "eta_seconds": (total - done) / rate if rate else None,
+            # None sin despachador: las llamadas síncronas bloquean este hilo y nunca se verían en vuelo
+            "claude_in_flight": dispatcher.in_flight if dispatcher else None
+        })
 
-        if os.path.exists(OUTPUT_XLSX):
-            try:
-                df_old = pd.read_excel(OUTPUT_XLSX)
-                
-                # MIGRACIÓN: Renombrar columnas antiguas en df_old si existen
-                # Esto recupera los datos de ejecuciones anteriores
-                df_old = df_old.rename(columns=column_map)
-                
-                # Asegurar columnas en df_old
-                for col in final_cols:
-                    if col not in df_old.columns:
-                        df_old[col] = ""
-                
-                df_old = df_old[final_cols]
-                
-                df_final = pd.concat([df_old, df_new], ignore_index=True).drop_duplicates(subset=['file_path'], keep='last')
-            except Exception as e:
-                logging.warning(f"No se pudo leer Excel anterior o migrar datos: {e}. Creando nuevo.")
-                df_final = df_new
-        else:
-            df_final = df_new
+    def _persist_row(self, pdf_path, fingerprint, row):
+        """Guarda la factura en el almacén y después su huella en el diario de estado"""
+        self.results_store.upsert([row])
+        # Los errores de lectura no se marcan como procesados (se reintentan)
+        if not row["error"]:
+            self.state[str(pdf_path)] = fingerprint
+            self.state_journal.record(str(pdf_path), fingerprint)
+        if self.state_journal.needs_compaction:
+            self._save_state()
+
+    def _scan_inputs(self, full_rescan=False, verbose=True):
+        """PDFs de INPUT_PDF_DIR (CrawlEntry: ruta, mtime y tamaño de un único scandir) ordenados por ruta"""
+        # El crawler se conserva entre ejecuciones (modo servicio: caché de directorios en memoria)
+        if getattr(self, 'crawler', None) is None:
+            self.crawler = PdfCrawler(CRAWL_CACHE_PATH, CRAWL_FULL_RESCAN_HOURS, CRAWL_RECENT_SECONDS,
+                                      CRAWL_RELIST_UNCHANGED)
+        entries = sorted(self.crawler.scan(INPUT_PDF_DIR, full_rescan))
+        stats = self.crawler.drain_stats()
+        if verbose:
+            logging.info(f"Recorrido de {INPUT_PDF_DIR}: {stats['dirs_scanned']} directorios listados, "
+                         f"{stats['dirs_skipped'] + stats['dirs_relisted']} sin cambios "
+                         f"({stats['dirs_relisted']} comprobados), {stats['files_restated']} PDFs modificados en el sitio")
+        return entries
+
+    def _find_pending(self, pdf_files, retry_failed=True):
+        """Archivos nuevos o modificados (o con NO_MATCH/ERROR previo si retry_failed) con su huella"""
+        # Estados previos {file_path: status} para forzar reprocesamiento de errores
+        previous_statuses = self.results_store.statuses()
+
+        # Incremental: Saltamos si ya está procesado y no ha cambiado
+        # EXCEPCIÓN: Si el estado previo fue NO_MATCH o ERROR, reprocesamos SIEMPRE
+        pending = []
+        for entry in pdf_files:
+            # La huella viene del recorrido: sin os.stat extra por archivo
+            file_key, fingerprint = entry.path, entry.fingerprint
+
+            prev_status = previous_statuses.get(file_key, "UNKNOWN")
+            force_reprocess = retry_failed and (prev_status in ["NO_MATCH", "ERROR"])
             
-        df_final.to_excel(OUTPUT_XLSX, index=False, engine='openpyxl')
-        logging.info(f"Excel actualizado en: {OUTPUT_XLSX}")
+            if not force_reprocess and file_key in self.state and self.state[file_key] == fingerprint:
+                continue
+            pending.append((Path(file_key), fingerprint))
+        return pending
+
+    def plan(self, pending_count=None):
+        """
+        Estima llamadas a Claude, coste y duración de la cola pendiente con las medias
+        reales de las últimas ejecuciones (claude_usage.jsonl). Devuelve el dict o None
+        """
+        if pending_count is None:
+            pending_count = len(self._find_pending(self._scan_inputs()))
+        if not pending_count:
+            return None
+        estimate = plan_queue(UsageLog(USAGE_LOG_PATH).read(), pending_count)
+        if estimate is None:
+            logging.info(f"Plan: {pending_count} documentos pendientes (sin histórico de uso para estimar coste)")
+            return None
+        logging.info(f"Plan: {pending_count} documentos pendientes -> ~{estimate['claude_documents']} con Claude "
+                     f"({estimate['claude_rate']:.0%}), ~{estimate['claude_calls']} llamadas, "
+                     f"~${estimate['cost_usd']:.2f}, ~{estimate['seconds'] / 60:.1f} min "
+                     f"(medias de {estimate['history_runs']} ejecuciones / {estimate['history_documents']} documentos)")
+        return estimate
+
+    def _save_usage(self, run_id, rows, usage, seconds):
+        """Completa los registros de uso con proveedor y método final de cada factura y los guarda"""
+        rows_by_path = {row["file_path"]: row for row in rows}
+        for record in usage:
+            row = rows_by_path.get(record.get("pdf_path"), {})
+            record.update({
+                "run_id": run_id,
+                "supplier_cif": row.get("supplier_tax_id"),
+                "supplier_name": row.get("supplier_name_erp"),
+                "extraction_method": row.get("extraction_method")
+            })
+        usage.append({
+            "type": "run",
+            "run_id": run_id,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "documents": len(rows),
+            "claude_documents": len({record.get("pdf_path") for record in usage if record.get("type") == "call"}),
+            "seconds": round(seconds, 1)
+        })
+        UsageLog(USAGE_LOG_PATH).append(usage)
+
+    def _save_metrics(self, run_id, rows, usage, seconds):
+        """Histogramas por fase, por proveedor y detalle por factura (JSON + textfile de Prometheus)"""
+        report = METRICS.report(run_id, seconds, rows, usage)
+        METRICS.write(report, METRICS_JSON_PATH, METRICS_PROM_PATH)
+
+    def export(self, by_month=False):
+        """
+        Genera el Excel de resumen (export derivado) con todas las facturas del almacén,
+        en streaming desde SQLite
+
+        Args:
+            by_month: Si True, un libro por mes de factura junto a OUTPUT_XLSX
+        """
+        written = export_rows(self.results_store.rows(), OUTPUT_XLSX, EXCEL_COLUMN_MAP, EXCEL_COLUMNS, by_month=by_month)
+        for path, count in written.items():
+            logging.info(f"Excel actualizado en: {path} ({count} facturas)")
+
+# ==============================================================================
+# POOL DE PROCESOS (process_all con workers > 1)
+# ==============================================================================
+_WORKER_PROCESSOR = None
+
+def _init_worker(processor):
+    """Se ejecuta una vez por proceso del pool con una copia del procesador del padre"""
+    global _WORKER_PROCESSOR
+    _WORKER_PROCESSOR = processor
+
+def _process_file_in_worker(file, defer_claude=False):
+    pdf_path, mtime = file
+    with METRICS.document(pdf_path):
+        row = _WORKER_PROCESSOR._process_file(pdf_path, defer_claude, mtime)
+    return row, _WORKER_PROCESSOR._drain_stats(), _WORKER_PROCESSOR._drain_usage(), METRICS.drain()
+
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Procesador IDP de facturas de proveedor (JOFEG)")
+    parser.add_argument("--workers", type=int, default=None, help="Procesos en paralelo (por defecto: secuencial)")
+    parser.add_argument("--claude-concurrency", type=int, default=None,
+                        help="Llamadas a Claude en vuelo a la vez (por defecto: síncrono)")
+    parser.add_argument("--claude-batch", action="store_true",
+                        help="Enviar el fallback de Claude por lotes (Message Batches) al final de la ejecución")
+    parser.add_argument("--plan", action="store_true",
+                        help="Sólo estimar coste y duración de los documentos pendientes, sin procesarlos")
+    parser.add_argument("--watch", action="store_true",
+                        help="Modo servicio: vigilar INPUT_PDF_DIR y procesar los PDFs nuevos según llegan (ver idp_service.py)")
+    parser.add_argument("--full-rescan", action="store_true",
+                        help="Relistar todos los directorios de entrada aunque no hayan cambiado")
+    parser.add_argument("--no-excel", action="store_true",
+                        help="No regenerar el Excel de resumen al terminar (los resultados quedan en el almacén SQLite)")
+    parser.add_argument("--export-excel", action="store_true",
+                        help="Sólo regenerar el Excel de resumen desde el almacén, sin procesar")
+    parser.add_argument("--excel-by-month", action="store_true",
+                        help="Generar un Excel de resumen por mes de factura en lugar de uno solo")
+    args = parser.parse_args()
+
     processor = JofegIDPProcessor()
-    processor.process_all()
+    if args.plan:
+        processor.plan()
+    elif args.watch:
+        from idp_service import IDPService
+        IDPService(processor, workers=args.workers, claude_concurrency=args.claude_concurrency).serve_forever()
+    elif args.export_excel:
+        processor.export(by_month=args.excel_by_month)
+    else:
+        processor.process_all(workers=args.workers, claude_concurrency=args.claude_concurrency,
+                              claude_batch=args.claude_batch, export_excel=not args.no_excel,
+                              excel_by_month=args.excel_by_month, full_rescan=args.full_rescan)
@@ -19,6 +19,17 @@ def print_header():
 
 def run_processor():
     print("\n[1] Iniciando Procesamiento Completo de Facturas...")
+    from idp_service import request, is_running
+    if is_running():
+        # El servicio IDP ya tiene todo cargado: se le pide la ejecución
+        try:
+            summary = request("run")
+            print(f"\n[OK] Servicio IDP: {summary}")
+        except Exception as e:
+            print(f"\n[ERROR] Error en el servicio IDP: {e}")
+        input("\nPresiona Enter para volver al menú...")
+        return
+
     from jofeg_idp_processor import JofegIDPProcessor
     try:
         processor = JofegIDPProcessor()
@@ -7,6 +7,8 @@ from pathlib import Path
 import subprocess
 import json
 import logging
+import queue
+import threading
 import pandas as pd
 
 # Configuración de Rutas
@@ -15,6 +17,8 @@ INPUT_DIR = Path(r"X:\Facts_Proveedor")
 LOG_FILE = BASE_DIR / "idp_processor.log"
 TEMPLATES_PATH = BASE_DIR / "templates.json"
 EXCEL_OUTPUT = BASE_DIR / "Resumen_Facturas_IDP.xlsx"
+# Llamadas a Claude en vuelo a la vez desde la GUI (despachador asíncrono; None = síncrono)
+CLAUDE_CONCURRENCY = 4
 
 class JofegIDPMenuGUI:
     def __init__(self, root):
@@ -96,51 +100,36 @@ class JofegIDPMenuGUI:
         # Eliminamos la confirmación previa para agilizar el proceso ("Hay demasiados mensajes")
         # response = messagebox.askyesno(...)
         
-        try:
+        # Si el servicio IDP está en marcha (idp_service.py) se le pide la ejecución:
+        # ya tiene maestro, plantillas y cachés cargados
+        if self._run_in_service():
+            return
+        
+        def job(progress, cancel):
             from jofeg_idp_processor import JofegIDPProcessor
-            
-            # Ventana de progreso
-            progress_window = tk.Toplevel(self.root)
-            progress_window.title("Procesando...")
-            progress_window.geometry("500x300")
-            progress_window.configure(padx=20, pady=20)
-            
-            label = tk.Label(
-                progress_window,
-                text="⏳ Procesamiento en curso...\n\nPor favor, espera mientras se procesan las facturas.",
-                font=("Arial", 10),
-                justify="center"
-            )
-            label.pack(pady=20)
-            
-            log_text = scrolledtext.ScrolledText(
-                progress_window,
-                width=60,
-                height=12,
-                font=("Consolas", 9),
-                bg="#1e1e1e",
-                fg="#00ff00"
-            )
-            log_text.pack(fill="both", expand=True)
-            
-            progress_window.update()
-            
-            # Redirigir logs a la ventana
-            handler = TextHandler(log_text)
-            handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
-            logging.getLogger().addHandler(handler)
-            
             processor = JofegIDPProcessor()
-            processor.process_all()
-            
-            logging.getLogger().removeHandler(handler)
-            progress_window.destroy()
-            
-            # Verificar si hay errores y ofrecer análisis
-            self._check_and_offer_analysis()
-            
-        except Exception as e:
-            messagebox.showerror("Error de Procesamiento", f"Ocurrió un error:\n\n{str(e)}")
+            processor.process_all(claude_concurrency=CLAUDE_CONCURRENCY, progress=progress, cancel=cancel)
+        
+        # El procesamiento corre en un hilo aparte: la ventana sigue respondiendo
+        ProcessingWindow(self.root, job, on_done=self._check_and_offer_analysis)
+    
+    def _run_in_service(self):
+        """Pide el procesamiento al servicio IDP. False si el servicio no está en marcha"""
+        from idp_service import request, is_running
+        if not is_running():
+            return False
+        
+        def job(progress, cancel):
+            summary = request("run")
+            if summary.get("error"):
+                raise RuntimeError(summary["error"])
+            if summary.get("waiting"):
+                logging.info(f"Servicio IDP: {summary['waiting']} PDFs aún copiándose, se procesarán en cuanto estén completos")
+            logging.info(f"Servicio IDP: {summary['processed']} facturas procesadas")
+        
+        ProcessingWindow(self.root, job, on_done=self._check_and_offer_analysis,
+                         title="El servicio IDP está procesando las facturas...", can_cancel=False)
+        return True
     
     def _check_and_offer_analysis(self):
         """Verifica resultados y notifica al usuario"""
@@ -567,17 +556,121 @@ ARCHIVO:
             self.root.destroy()
 
 
-class TextHandler(logging.Handler):
-    """Handler para redirigir logs a un widget de texto"""
-    def __init__(self, text_widget):
+class QueueLogHandler(logging.Handler):
+    """Handler que deja los logs en una cola; la ventana los pinta desde el hilo de Tk"""
+    def __init__(self, events):
         super().__init__()
-        self.text_widget = text_widget
+        self.events = events
     
     def emit(self, record):
-        msg = self.format(record) + '\n'
-        self.text_widget.insert(tk.END, msg)
-        self.text_widget.see(tk.END)
-        self.text_widget.update()
+        self.events.put(("log", self.format(record)))
+
+
+class ProcessingWindow:
+    """
+    Ventana de progreso de un procesamiento en segundo plano.
+    job(progress, cancel) se ejecuta en un hilo; sus eventos de progreso y los logs
+    llegan por una cola que se consulta con root.after, sin bloquear la interfaz.
+    """
+    POLL_MS = 100
+    
+    def __init__(self, root, job, on_done=None, title="Procesamiento en curso...", can_cancel=True):
+        self.root = root
+        self.on_done = on_done
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        
+        self.window = tk.Toplevel(root)
+        self.window.title("Procesando...")
+        self.window.geometry("600x380")
+        self.window.configure(padx=20, pady=20)
+        self.window.protocol("WM_DELETE_WINDOW", self.cancel if can_cancel else lambda: None)
+        
+        tk.Label(self.window, text=f"⏳ {title}", font=("Arial", 10, "bold")).pack(pady=(0, 10))
+        self.progress_bar = ttk.Progressbar(self.window, mode="determinate" if can_cancel else "indeterminate")
+        self.progress_bar.pack(fill="x")
+        if not can_cancel:
+            self.progress_bar.start(15)
+        self.status_label = tk.Label(self.window, text="Buscando facturas pendientes...", font=("Arial", 9), justify="left")
+        self.status_label.pack(fill="x", pady=5)
+        
+        self.log_text = scrolledtext.ScrolledText(
+            self.window,
+            width=70,
+            height=12,
+            font=("Consolas", 9),
+            bg="#1e1e1e",
+            fg="#00ff00"
+        )
+        self.log_text.pack(fill="both", expand=True)
+        
+        self.cancel_button = tk.Button(self.window, text="Cancelar", command=self.cancel, bg="#dc3545", fg="white",
+                                       state="normal" if can_cancel else "disabled")
+        self.cancel_button.pack(pady=(10, 0))
+        
+        # Redirigir logs a la ventana (a través de la cola)
+        self.handler = QueueLogHandler(self.events)
+        self.handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+        logging.getLogger().addHandler(self.handler)
+        
+        self.thread = threading.Thread(target=self._run, args=(job,), daemon=True)
+        self.thread.start()
+        self.window.after(self.POLL_MS, self._poll)
+    
+    def _run(self, job):
+        try:
+            job(lambda event: self.events.put(("progress", event)), self.cancel_event)
+            self.events.put(("done", None))
+        except Exception as e:
+            self.events.put(("error", e))
+    
+    def cancel(self):
+        """Pide al procesador que pare tras la factura en curso (guarda lo terminado)"""
+        self.cancel_event.set()
+        self.cancel_button.config(state="disabled", text="Cancelando...")
+        self.status_label.config(text="Cancelando: terminando la factura en curso y guardando el estado...")
+    
+    def _poll(self):
+        finished = None
+        try:
+            while True:
+                kind, payload = self.events.get_nowait()
+                if kind == "log":
+                    self.log_text.insert(tk.END, payload + "\n")
+                    self.log_text.see(tk.END)
+                elif kind == "progress":
+                    self._show_progress(payload)
+                else:
+                    finished = (kind, payload)
+        except queue.Empty:
+            pass
+        
+        if finished is None:
+            self.window.after(self.POLL_MS, self._poll)
+            return
+        
+        logging.getLogger().removeHandler(self.handler)
+        self.window.destroy()
+        kind, payload = finished
+        if kind == "error":
+            messagebox.showerror("Error de Procesamiento", f"Ocurrió un error:\n\n{str(payload)}")
+        elif self.on_done:
+            self.on_done()
+    
+    def _show_progress(self, event):
+        total = event["total"] or 1
+        self.progress_bar.config(maximum=total, value=event["done"])
+        eta = event["eta_seconds"]
+        eta_text = f"{int(eta // 60)}m {int(eta % 60):02d}s" if eta is not None else "--"
+        text = (f"{event['stage'].capitalize()}: {event['done']}/{event['total']} | "
+                f"{event['docs_per_sec']:.2f} docs/s | Restante: {eta_text}")
+        # Sin despachador (Claude síncrono) no hay llamadas en vuelo que mostrar
+        if event.get("claude_in_flight") is not None:
+            text += f" | Claude en vuelo: {event['claude_in_flight']}"
+        if event.get("file"):
+            text += f"\n{event['file']}"
+        if not self.cancel_event.is_set():
+            self.status_label.config(text=text)
 
 
 if __name__ == "__main__":
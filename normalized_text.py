@@ -0,0 +1,84 @@
+"""
+Vistas normalizadas del texto de una factura, calculadas en una sola pasada.
+Antes cada paso rehacía su propia limpieza: text.upper() varias veces, un
+re.sub para la detección de CIF, otro recorrido de tokens para el matching de
+nombres y, para el contexto de depuración, una regex nueva por factura que
+buscaba el CIF carácter a carácter en el texto original.
+
+NormalizedText calcula una vez:
+- upper:   el texto en mayúsculas (palabras clave, moneda)
+- tokens:  las palabras [A-Z0-9]+ de upper con su posición (autómata de nombres)
+- compact: sólo los caracteres [A-Z0-9] de upper (regex de CIF)
+y guarda dónde empieza cada palabra en compact, de modo que cualquier posición
+de compact se traduce a su posición en el texto original (locate/context).
+"""
+
+import re
+from bisect import bisect_right
+from supplier_index import TOKEN_PATTERN
+
+# Separadores admitidos entre los caracteres de un CIF en el texto original ("B-12.345.678")
+CIF_SEPARATORS = re.compile(r'[\s.-]*')
+# Caracteres de contexto a cada lado del CIF en match_debug
+CONTEXT_CHARS = 30
+
+
+class NormalizedText:
+    def __init__(self, text):
+        self.text = text
+        self.upper = text.upper()
+        # str.upper() puede alargar el texto ("ß" -> "SS", ligaduras): entonces hace falta
+        # la posición original de cada carácter de upper; en el caso normal coinciden
+        self._upper_to_text = None
+        if len(self.upper) != len(text):
+            self._upper_to_text = [i for i, char in enumerate(text) for _ in char.upper()]
+
+        self.tokens = []           # (palabra, inicio, fin) sobre upper, igual que NameMatcher.find_all
+        self._compact_starts = []  # posición en compact donde empieza cada token
+        position = 0
+        for m in TOKEN_PATTERN.finditer(self.upper):
+            self.tokens.append((m.group(), m.start(), m.end()))
+            self._compact_starts.append(position)
+            position += m.end() - m.start()
+        self.compact = "".join(token[0] for token in self.tokens)
+
+    def contains_any(self, words):
+        """True si alguna de las palabras (en mayúsculas) aparece en el texto"""
+        return any(word in self.upper for word in words)
+
+    def text_index(self, compact_index):
+        """Posición en el texto original del carácter compact[compact_index]"""
+        token = bisect_right(self._compact_starts, compact_index) - 1
+        index = self.tokens[token][1] + compact_index - self._compact_starts[token]
+        return self._upper_to_text[index] if self._upper_to_text else index
+
+    def locate(self, value):
+        """
+        Busca value (p.ej. un CIF) en el texto original, admitiendo espacios, puntos y guiones
+        entre sus caracteres y sin distinguir mayúsculas
+
+        Returns:
+            (inicio, fin) en el texto original de la primera aparición, o None
+        """
+        needle = "".join(TOKEN_PATTERN.findall(str(value).upper()))
+        if not needle:
+            return None
+        start = self.compact.find(needle)
+        while start != -1:
+            positions = [self.text_index(k) for k in range(start, start + len(needle))]
+            # En compact también se han quitado otros signos (":", "/", "Ñ"...): sólo valen los separadores
+            if all(after <= before + 1 or CIF_SEPARATORS.fullmatch(self.text, before + 1, after)
+                   for before, after in zip(positions, positions[1:])):
+                return positions[0], positions[-1] + 1
+            start = self.compact.find(needle, start + 1)
+        return None
+
+    def context(self, value, chars=CONTEXT_CHARS):
+        """Texto original alrededor de value ("...contexto...") o "" si no aparece"""
+        span = self.locate(value) if value else None
+        if span is None:
+            return ""
+        start = max(0, span[0] - chars)
+        end = min(len(self.text), span[1] + chars)
+        context = self.text[start:end].replace('\n', ' ')
+        return f"...{context}..."
@@ -0,0 +1,179 @@
+"""
+Recorrido incremental de la carpeta de facturas (SharePoint/SMB).
+Una sola pasada con os.scandir: nombre, mtime y tamaño salen de la misma
+entrada de directorio (en Windows sin llamada extra por fichero). Por cada
+directorio se recuerda su mtime y su listado; si el mtime no ha cambiado no
+se vuelve a listar y se reutilizan las huellas guardadas, con lo que un
+directorio sin altas, bajas ni renombrados cuesta un único stat.
+
+Escribir en un PDF ya existente no cambia el mtime del directorio. Por eso:
+- con relist_unchanged (por defecto en Windows, donde scandir trae mtime y
+  tamaño sin coste extra) los directorios sin cambios también se listan, y un
+  PDF cuyo mtime o tamaño difiere de la caché (sobrescrito en el sitio) se
+  detecta en el mismo recorrido;
+- sin él, los PDFs modificados hace menos de recent_seconds (p.ej. aún
+  copiándose) se vuelven a consultar con os.stat;
+- y cada full_rescan_hours (o con full_rescan=True) se relista todo.
+"""
+
+import os
+import json
+import time
+import logging
+from collections import Counter, namedtuple
+from pathlib import Path
+
+FULL_RESCAN_HOURS = 24
+RECENT_SECONDS = 600
+# En Windows DirEntry.stat() sale del propio listado: relistar cuesta una enumeración, no un stat por PDF
+RELIST_UNCHANGED = os.name == "nt"
+
+
+class CrawlEntry(namedtuple("CrawlEntry", "path mtime size")):
+    """PDF encontrado; path es str (crear 50k objetos Path cuesta más que el propio recorrido)"""
+    @property
+    def fingerprint(self):
+        # Mismo formato que las huellas guardadas en el estado del procesador (mtime + size)
+        return f"{self.mtime}-{self.size}"
+
+
+class PdfCrawler:
+    def __init__(self, cache_path=None, full_rescan_hours=FULL_RESCAN_HOURS, recent_seconds=RECENT_SECONDS,
+                 relist_unchanged=RELIST_UNCHANGED):
+        """
+        Args:
+            cache_path: JSON con el mtime y el listado de cada directorio (None = sin caché)
+            full_rescan_hours: Antigüedad máxima del último relistado completo
+            recent_seconds: Sin relist_unchanged, PDFs con mtime más reciente que esto se vuelven a consultar
+            relist_unchanged: Listar también los directorios sin cambios y comparar cada PDF con la caché
+        """
+        self.cache_path = cache_path
+        self.full_rescan_hours = full_rescan_hours
+        self.recent_seconds = recent_seconds
+        self.relist_unchanged = relist_unchanged
+        self.stats = Counter()
+        self._cache = self._load()
+
+    def _load(self):
+        if self.cache_path and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"No se pudo leer la caché de directorios {self.cache_path}: {e}")
+        return {}
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                # dumps usa el codificador en C; dump(f) va por la versión Python, mucho más lenta
+                f.write(json.dumps(self._cache, ensure_ascii=False))
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logging.warning(f"No se pudo guardar la caché de directorios {self.cache_path}: {e}")
+
+    def scan(self, root, full_rescan=False):
+        """
+        Produce un CrawlEntry por cada PDF bajo root, a medida que se recorren los directorios.
+        La caché sólo se actualiza si el recorrido se consume entero
+        """
+        root = str(Path(root))
+        cache = self._cache if self._cache.get("root") == root else {}
+        age_hours = (time.time() - cache.get("full_scan_at", 0)) / 3600
+        full_rescan = full_rescan or age_hours >= self.full_rescan_hours
+        old_dirs = {} if full_rescan else cache.get("dirs", {})
+        new_dirs = {}
+        changed = full_rescan
+        now = time.time()
+
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                dir_mtime = os.stat(directory).st_mtime
+            except OSError as e:
+                logging.warning(f"No se puede acceder a {directory}: {e}")
+                continue
+
+            cached = old_dirs.get(directory)
+            if cached and cached["mtime"] == dir_mtime and self.relist_unchanged:
+                # Sin altas ni bajas, pero un PDF puede haberse sobrescrito: se compara el listado con la caché
+                files, subdirs = self._list(directory)
+                self.stats["dirs_relisted"] += 1
+                differ = self._count_changed(cached["files"], files)
+                self.stats["files_restated"] += differ
+                changed = changed or differ > 0 or subdirs != cached["dirs"]
+            elif cached and cached["mtime"] == dir_mtime:
+                files, subdirs = cached["files"], cached["dirs"]
+                self.stats["dirs_skipped"] += 1
+                if any(now - mtime < self.recent_seconds for _, mtime, _ in files):
+                    refreshed = self._restat_recent(directory, files, now)
+                    changed = changed or refreshed != files
+                    files = refreshed
+            else:
+                files, subdirs = self._list(directory)
+                self.stats["dirs_scanned"] += 1
+                changed = True
+            new_dirs[directory] = {"mtime": dir_mtime, "files": files, "dirs": subdirs}
+
+            for name, mtime, size in files:
+                yield CrawlEntry(os.path.join(directory, name), mtime, size)
+            stack.extend(os.path.join(directory, name) for name in reversed(subdirs))
+
+        # Un directorio que desaparece o deja de ser accesible también obliga a guardar
+        changed = changed or len(new_dirs) != len(old_dirs)
+        if changed:
+            self._cache = {
+                "root": root,
+                "full_scan_at": time.time() if full_rescan else cache.get("full_scan_at", 0),
+                "dirs": new_dirs
+            }
+            self._save()
+
+    def _list(self, directory):
+        """([nombre, mtime, tamaño] de los PDFs, [subdirectorios]) de una pasada de scandir"""
+        files, subdirs = [], []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        elif entry.name.lower().endswith(".pdf") and entry.is_file():
+                            st = entry.stat()
+                            files.append([entry.name, st.st_mtime, st.st_size])
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.warning(f"No se puede listar {directory}: {e}")
+        subdirs.sort()
+        return files, subdirs
+
+    @staticmethod
+    def _count_changed(cached_files, files):
+        """Nº de PDFs del listado cuyo mtime o tamaño no coincide con la caché (o que no estaban)"""
+        previous = {name: (mtime, size) for name, mtime, size in cached_files}
+        changed = sum(1 for name, mtime, size in files if previous.get(name) != (mtime, size))
+        return changed + max(0, len(cached_files) - len(files))
+
+    def _restat_recent(self, directory, files, now):
+        """Listado con los PDFs recientes actualizados por os.stat (los borrados desaparecen)"""
+        refreshed = []
+        for name, mtime, size in files:
+            if now - mtime < self.recent_seconds:
+                try:
+                    st = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue
+                mtime, size = st.st_mtime, st.st_size
+                self.stats["files_restated"] += 1
+            refreshed.append([name, mtime, size])
+        return refreshed
+
+    def drain_stats(self):
+        stats, self.stats = self.stats, Counter()
+        return stats
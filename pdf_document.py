@@ -0,0 +1,66 @@
+"""
+Documento PDF de una factura abierto UNA sola vez.
+Los bytes se leen de disco (unidad de red X:) en una única lectura y el mismo
+documento PyMuPDF se comparte entre la extracción de texto, las plantillas
+zonales y el renderizado de imágenes para Claude.
+"""
+
+import hashlib
+from pathlib import Path
+import fitz  # PyMuPDF
+
+
+class InvoiceDocument:
+    def __init__(self, pdf_path):
+        self.path = Path(pdf_path)
+        # Una sola lectura completa del fichero; a partir de aquí todo es en memoria
+        self.data = self.path.read_bytes()
+        self._doc = None
+        self._text = None
+        self._content_hash = None
+
+    @property
+    def doc(self):
+        """Documento PyMuPDF (se abre desde memoria sólo cuando se necesita)"""
+        if self._doc is None:
+            self._doc = fitz.open(stream=self.data, filetype="pdf")
+        return self._doc
+
+    @property
+    def content_hash(self):
+        """SHA-256 del contenido: identifica el documento aunque se renombre o copie"""
+        if self._content_hash is None:
+            self._content_hash = hashlib.sha256(self.data).hexdigest()
+        return self._content_hash
+
+    @property
+    def metadata(self):
+        return self.doc.metadata or {}
+
+    @property
+    def text(self):
+        """Texto de todas las páginas (se extrae una vez y se reutiliza)"""
+        if self._text is None:
+            self._text = "".join(page.get_text() for page in self.doc)
+        return self._text
+
+    def close(self):
+        if self._doc is not None:
+            self._doc.close()
+            self._doc = None
+
+    # Acceso tipo fitz.Document: len(doc), doc[0], for page in doc
+    def __len__(self):
+        return len(self.doc)
+
+    def __getitem__(self, index):
+        return self.doc[index]
+
+    def __iter__(self):
+        return iter(self.doc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
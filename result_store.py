@@ -0,0 +1,118 @@
+"""
+Almacén local de resultados (SQLite), sistema de registro de las facturas procesadas.
+Una fila por PDF (clave: ruta; índices por guid y status) con la fila completa
+del procesador en JSON. Cada ejecución sólo hace upsert de las facturas nuevas o
+modificadas y borra las que ya no existen en disco, sin leer ni reescribir el
+histórico; el Excel de resumen se genera a partir de aquí sólo cuando se pide.
+"""
+
+import os
+import json
+import sqlite3
+import logging
+from datetime import datetime
+from contextlib import closing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS facturas (
+    file_path TEXT PRIMARY KEY,
+    guid TEXT,
+    status TEXT,
+    updated_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_facturas_guid ON facturas(guid);
+CREATE INDEX IF NOT EXISTS idx_facturas_status ON facturas(status);
+"""
+
+
+class ResultStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        # Conexión por operación: el procesador se copia a los procesos del pool y
+        # una conexión abierta no es serializable
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def is_empty(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT 1 FROM facturas LIMIT 1").fetchone() is None
+
+    def upsert(self, rows):
+        """Inserta o actualiza las filas (dicts con al menos file_path) en una transacción"""
+        now = datetime.now().isoformat(timespec="seconds")
+        records = [
+            (row["file_path"], row.get("guid"), row.get("status"), now,
+             json.dumps(row, ensure_ascii=False, default=str))
+            for row in rows
+        ]
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO facturas (file_path, guid, status, updated_at, data) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(file_path) DO UPDATE SET guid=excluded.guid, status=excluded.status, "
+                "updated_at=excluded.updated_at, data=excluded.data",
+                records
+            )
+        return len(records)
+
+    def statuses(self):
+        """{file_path: status} de todas las facturas (sólo lee las columnas indexadas)"""
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT file_path, status FROM facturas"))
+
+    def get(self, file_path):
+        with closing(self._connect()) as conn:
+            found = conn.execute("SELECT data FROM facturas WHERE file_path = ?", (file_path,)).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def delete_missing(self, current_paths):
+        """Borra las facturas cuya ruta no está en current_paths. Devuelve cuántas se borraron"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TEMP TABLE actuales (file_path TEXT PRIMARY KEY)")
+            conn.executemany("INSERT OR IGNORE INTO actuales VALUES (?)", ((p,) for p in current_paths))
+            deleted = conn.execute(
+                "DELETE FROM facturas WHERE file_path NOT IN (SELECT file_path FROM actuales)").rowcount
+            conn.execute("DROP TABLE actuales")
+        return deleted
+
+    def rows(self, status=None):
+        """Todas las filas (o sólo las de un status) ordenadas por ruta"""
+        query, params = "SELECT data FROM facturas", ()
+        if status is not None:
+            query, params = query + " WHERE status = ?", (status,)
+        with closing(self._connect()) as conn:
+            for (data,) in conn.execute(query + " ORDER BY file_path", params):
+                yield json.loads(data)
+
+    def import_excel(self, xlsx_path, column_map):
+        """
+        Migración única: carga un Excel de resumen existente en un almacén vacío
+
+        Args:
+            column_map: mapa nombre interno -> columna visual del Excel
+        Returns:
+            Nº de filas importadas
+        """
+        if not os.path.exists(xlsx_path) or not self.is_empty():
+            return 0
+        import pandas as pd
+        try:
+            df = pd.read_excel(xlsx_path)
+        except Exception as e:
+            logging.warning(f"No se pudo importar el Excel anterior {xlsx_path}: {e}")
+            return 0
+        df = df.rename(columns={visual: internal for internal, visual in column_map.items()})
+        if "file_path" not in df.columns:
+            return 0
+        # to_json: tipos nativos serializables (NaN -> None)
+        rows = [row for row in json.loads(df.to_json(orient="records", force_ascii=False)) if row["file_path"]]
+        imported = self.upsert(rows)
+        logging.info(f"Almacén de resultados: importadas {imported} filas de {xlsx_path}")
+        return imported
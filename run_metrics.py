@@ -0,0 +1,270 @@
+"""
+Métricas de tiempo por fase de una ejecución del procesador IDP.
+Cada fase (recorrido, lectura del PDF, get_text, regex de CIF, matching de
+proveedor, zonas de plantilla, renderizado y llamadas a Claude, export...) se
+mide con un span:
+
+    with METRICS.span("get_text"):
+        text = document.text
+
+Las muestras se acumulan en memoria (una lista de duraciones por fase) y cada
+factura, procesada dentro de METRICS.document(ruta), deja además un registro
+con el tiempo de cada fase. Igual que los contadores de Claude, los procesos
+del pool devuelven sus muestras con drain() y el padre las une con merge().
+
+Al terminar la ejecución se escriben:
+- METRICS_JSON_PATH: resumen por fase y por proveedor (n, total, p50, p95, máx.)
+  y el detalle por factura; se compara con la ejecución anterior y se avisa en
+  el log de las fases cuyo p95 ha empeorado.
+- METRICS_PROM_PATH: el mismo resumen en formato texto de Prometheus, para el
+  textfile collector de node_exporter.
+"""
+
+import os
+import json
+import math
+import time
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Una fase se considera regresión si su p95 crece más de este factor (y al menos REGRESSION_MIN_MS)
+REGRESSION_FACTOR = 1.5
+REGRESSION_MIN_MS = 50
+# Proveedores más lentos (por p95) que se publican en Prometheus
+PROM_TOP_SUPPLIERS = 10
+PROM_PREFIX = "jofeg_idp"
+
+
+def percentile(sorted_values, fraction):
+    """Percentil por rango más cercano de una lista ya ordenada"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def histogram(seconds):
+    """{count, total_ms, p50_ms, p95_ms, max_ms} de una lista de duraciones en segundos"""
+    values = sorted(seconds)
+    return {
+        "count": len(values),
+        "total_ms": round(sum(values) * 1000, 1),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+        "max_ms": round(values[-1] * 1000, 1) if values else 0.0
+    }
+
+
+class RunMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._samples = defaultdict(list)  # fase -> [segundos]
+        self._documents = []               # {"file_path", "seconds", "stages": {fase: segundos}}
+
+    @contextmanager
+    def span(self, name):
+        """Mide el bloque como una muestra de la fase name"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds):
+        """Añade una duración ya medida (p.ej. la latencia de una llamada a Claude)"""
+        with self._lock:
+            self._samples[name].append(seconds)
+        # Las fases medidas en el hilo que procesa una factura se suman a su registro
+        stages = getattr(self._local, "stages", None)
+        if stages is not None:
+            stages[name] = stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def document(self, file_path):
+        """Registro por factura: tiempo total y tiempo de cada fase medida dentro del bloque"""
+        record = {"file_path": str(file_path), "stages": {}}
+        self._local.stages = record["stages"]
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self._local.stages = None
+            record["seconds"] = time.perf_counter() - started
+            self.add("document", record["seconds"])
+            with self._lock:
+                self._documents.append(record)
+
+    def drain(self):
+        """(muestras, registros por factura) acumulados desde la última llamada"""
+        with self._lock:
+            samples, self._samples = dict(self._samples), defaultdict(list)
+            documents, self._documents = self._documents, []
+        return samples, documents
+
+    def merge(self, drained):
+        """Une lo devuelto por drain() en otro proceso"""
+        samples, documents = drained
+        with self._lock:
+            for name, values in samples.items():
+                self._samples[name].extend(values)
+            self._documents.extend(documents)
+
+    def reset(self):
+        self.drain()
+
+    def summary(self):
+        """{fase: histograma} de las muestras acumuladas"""
+        with self._lock:
+            return {name: histogram(values) for name, values in sorted(self._samples.items())}
+
+    def report(self, run_id, seconds, rows=(), usage=()):
+        """
+        Informe de la ejecución: fases, proveedores y facturas
+
+        Args:
+            rows: filas procesadas (proveedor, status y método de cada factura)
+            usage: registros de uso de Claude (latencia real de cada llamada, también las asíncronas)
+        """
+        rows_by_path = {row["file_path"]: row for row in rows}
+        claude_ms = defaultdict(int)
+        for record in usage:
+            if record.get("type") == "call" and record.get("latency_ms"):
+                claude_ms[record.get("pdf_path")] += record["latency_ms"]
+
+        with self._lock:
+            documents = list(self._documents)
+
+        per_document = []
+        by_supplier = defaultdict(list)
+        for record in documents:
+            row = rows_by_path.get(record["file_path"], {})
+            # Local + Claude: con el despachador asíncrono la llamada ocurre fuera del bloque de la factura
+            local_ms = record["seconds"] * 1000
+            remote_ms = claude_ms.get(record["file_path"], 0)
+            if "claude_call" in record["stages"]:
+                remote_ms = 0
+            total_ms = local_ms + remote_ms
+            supplier = row.get("supplier_tax_id") or "sin_cif"
+            by_supplier[supplier].append((total_ms / 1000, row.get("supplier_name_erp") or ""))
+            per_document.append({
+                "file_path": record["file_path"],
+                "supplier_cif": supplier,
+                "status": row.get("status"),
+                "extraction_method": row.get("extraction_method"),
+                "total_ms": round(total_ms, 1),
+                "stages_ms": {name: round(value * 1000, 1) for name, value in sorted(record["stages"].items())}
+            })
+
+        suppliers = {}
+        for cif, samples in by_supplier.items():
+            names = [name for _, name in samples if name]
+            suppliers[cif] = dict(histogram([value for value, _ in samples]), name=names[0] if names else "")
+
+        return {
+            "run_id": run_id,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seconds": round(seconds, 1),
+            "documents": len(per_document),
+            "docs_per_sec": round(len(per_document) / seconds, 2) if seconds > 0 else None,
+            "stages": self.summary(),
+            "suppliers": dict(sorted(suppliers.items(), key=lambda item: -item[1]["p95_ms"])),
+            "per_document": per_document
+        }
+
+    @staticmethod
+    def log_regressions(report, previous):
+        """Avisa de las fases cuyo p95 ha empeorado respecto a la ejecución anterior"""
+        if not previous:
+            return []
+        regressions = []
+        for name, current in report["stages"].items():
+            before = previous.get("stages", {}).get(name)
+            if not before or not before.get("p95_ms"):
+                continue
+            if (current["p95_ms"] > before["p95_ms"] * REGRESSION_FACTOR
+                    and current["p95_ms"] - before["p95_ms"] >= REGRESSION_MIN_MS):
+                regressions.append(name)
+                logging.warning(f"Métricas: la fase {name} ha empeorado: p95 {current['p95_ms']:.0f} ms "
+                                f"(antes {before['p95_ms']:.0f} ms en {previous.get('run_id')})")
+        return regressions
+
+    def write(self, report, json_path, prom_path=None):
+        """Escribe el informe en JSON (y en formato Prometheus) comparándolo con el anterior"""
+        previous = None
+        if os.path.exists(json_path):
+            try:
+                with open(json_path, 'r', encoding='utf-8') as f:
+                    previous = json.load(f)
+            except (OSError, ValueError):
+                previous = None
+        self.log_regressions(report, previous)
+
+        try:
+            _write_atomic(json_path, json.dumps(report, ensure_ascii=False, indent=2))
+            if prom_path:
+                _write_atomic(prom_path, prometheus_text(report))
+        except OSError as e:
+            logging.warning(f"No se pudieron guardar las métricas de la ejecución: {e}")
+            return
+
+        slowest = ", ".join(f"{name} p95 {stage['p95_ms']:.0f} ms"
+                            for name, stage in sorted(report["stages"].items(), key=lambda item: -item[1]["p95_ms"])[:4]
+                            if name != "document")
+        logging.info(f"Métricas guardadas en {json_path} | fases más lentas: {slowest}")
+
+
+def _write_atomic(path, content):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='\n') as f:
+        f.write(content)
+    # El textfile collector no debe leer nunca un fichero a medio escribir
+    os.replace(tmp_path, path)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def prometheus_text(report):
+    """Informe de la ejecución en formato de exposición de texto de Prometheus"""
+    lines = [
+        f"# HELP {PROM_PREFIX}_stage_seconds Duración de cada fase en la última ejecución",
+        f"# TYPE {PROM_PREFIX}_stage_seconds summary"
+    ]
+    for name, stage in report["stages"].items():
+        for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms"), ("1", "max_ms")):
+            lines.append(f'{PROM_PREFIX}_stage_seconds{{stage="{_label(name)}",quantile="{quantile}"}} {stage[key] / 1000:.6f}')
+        lines.append(f'{PROM_PREFIX}_stage_seconds_sum{{stage="{_label(name)}"}} {stage["total_ms"] / 1000:.6f}')
+        lines.append(f'{PROM_PREFIX}_stage_seconds_count{{stage="{_label(name)}"}} {stage["count"]}')
+
+    lines += [
+        f"# HELP {PROM_PREFIX}_supplier_document_seconds Tiempo por factura de los proveedores más lentos (local + Claude)",
+        f"# TYPE {PROM_PREFIX}_supplier_document_seconds summary"
+    ]
+    for cif, supplier in list(report["suppliers"].items())[:PROM_TOP_SUPPLIERS]:
+        labels = f'supplier="{_label(cif)}",name="{_label(supplier["name"])}"'
+        for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms"), ("1", "max_ms")):
+            lines.append(f'{PROM_PREFIX}_supplier_document_seconds{{{labels},quantile="{quantile}"}} {supplier[key] / 1000:.6f}')
+        lines.append(f'{PROM_PREFIX}_supplier_document_seconds_sum{{{labels}}} {supplier["total_ms"] / 1000:.6f}')
+        lines.append(f'{PROM_PREFIX}_supplier_document_seconds_count{{{labels}}} {supplier["count"]}')
+
+    lines += [
+        f"# HELP {PROM_PREFIX}_run_documents Facturas procesadas en la última ejecución",
+        f"# TYPE {PROM_PREFIX}_run_documents gauge",
+        f"{PROM_PREFIX}_run_documents {report['documents']}",
+        f"# HELP {PROM_PREFIX}_run_seconds Duración de la última ejecución",
+        f"# TYPE {PROM_PREFIX}_run_seconds gauge",
+        f"{PROM_PREFIX}_run_seconds {report['seconds']}",
+        f"# HELP {PROM_PREFIX}_run_timestamp_seconds Fin de la última ejecución (epoch)",
+        f"# TYPE {PROM_PREFIX}_run_timestamp_seconds gauge",
+        f"{PROM_PREFIX}_run_timestamp_seconds {int(time.time())}"
+    ]
+    return "\n".join(lines) + "\n"
+
+
+# Un acumulador por proceso: lo comparten el procesador y el extractor de Claude
+METRICS = RunMetrics()
@@ -0,0 +1,112 @@
+"""
+Estado incremental (ruta -> huella del PDF) como snapshot + diario.
+Cada factura procesada añade una línea JSON al diario (<snapshot>.journal), con
+fsync por lotes, así que el coste por factura es O(1) y una ejecución que se
+corta a mitad se reanuda en el último documento registrado. Periódicamente (y
+al final de cada ejecución) el estado completo se compacta en el snapshot
+mediante escritura a fichero temporal + os.replace, y el diario se vacía.
+Al cargar se lee el snapshot y se reaplica el diario encima.
+"""
+
+import os
+import json
+import logging
+
+
+class StateJournal:
+    def __init__(self, snapshot_path, fsync_every=50, compact_every=5000):
+        """
+        Args:
+            snapshot_path: Fichero JSON con el estado compactado (processing_state.json)
+            fsync_every: Nº de registros entre fsync del diario
+            compact_every: Nº de registros en el diario a partir del cual conviene compactar
+        """
+        self.snapshot_path = snapshot_path
+        self.journal_path = f"{snapshot_path}.journal"
+        self.fsync_every = fsync_every
+        self.compact_every = compact_every
+        self.entries = 0
+        self._unsynced = 0
+        self._file = None
+
+    def load(self):
+        """Estado del snapshot con el diario reaplicado encima"""
+        state = {}
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, 'r') as f:
+                    state = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"No se pudo leer el estado {self.snapshot_path}: {e}")
+
+        self.entries = 0
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Última línea a medias tras un corte: se descarta
+                        continue
+                    if record.get("v") is None:
+                        state.pop(record["k"], None)
+                    else:
+                        state[record["k"]] = record["v"]
+                    self.entries += 1
+        except OSError:
+            pass
+        if self.entries:
+            logging.info(f"Estado: reaplicados {self.entries} registros del diario {self.journal_path}")
+        return state
+
+    def record(self, key, value):
+        """Registra key -> value (None = borrar) al final del diario"""
+        if self._file is None:
+            self._file = open(self.journal_path, 'a', encoding='utf-8')
+        self._file.write(json.dumps({"k": key, "v": value}, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.entries += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def remove(self, key):
+        """Registra el borrado de key (p.ej. un PDF que ya no existe en disco)"""
+        self.record(key, None)
+
+    @property
+    def needs_compaction(self):
+        return self.entries >= self.compact_every
+
+    def sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def compact(self, state):
+        """Escribe el estado completo en el snapshot (atómico) y vacía el diario"""
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # Si se corta aquí, el diario se reaplica sobre un snapshot que ya lo contiene (idempotente)
+        self.close()
+        with open(self.journal_path, 'w', encoding='utf-8'):
+            pass
+        self.entries = 0
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def reset(self):
+        """Borra snapshot y diario (fuerza reprocesar todo)"""
+        self.close()
+        for path in (self.snapshot_path, self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.entries = 0
@@ -0,0 +1,203 @@
+"""
+Índice en memoria del maestro de proveedores (PROVEE.csv).
+Sustituye los filtros booleanos sobre el DataFrame (un recorrido completo de
+la columna por cada CIF candidato) por búsquedas O(1) en diccionarios, e
+incluye un autómata Aho-Corasick sobre los nombres para el fallback sin CIF.
+"""
+
+import os
+import re
+import mmap
+import pickle
+from collections import deque, namedtuple
+
+# Subir si cambia la estructura de SupplierIndex/NameMatcher (invalida las cachés existentes)
+CACHE_FORMAT = 2
+
+# Sufijos legales a ignorar para matching parcial robusto
+LEGAL_SUFFIX_PATTERN = re.compile('|'.join([
+    r'\bS\.?L\.?U?\.?\b', r'\bS\.?A\.?U?\.?\b', r'\bS\.?C\.?\b',
+    r'\bS\.?R\.?L\.?\b', r'\bLIMITADA\b', r'\bSOCIEDAD\b', r'\bANONIMA\b'
+]), re.IGNORECASE)
+TOKEN_PATTERN = re.compile(r'[A-Z0-9]+')
+
+# Coincidencia de un nombre de proveedor en el texto (posiciones sobre text.upper())
+NameHit = namedtuple('NameHit', ['start', 'end', 'name', 'cif_norm', 'cif'])
+
+
+def core_supplier_name(raw_name):
+    """Nombre 'núcleo' del proveedor: sin sufijos legales ni signos (ej. "EMPRESA S.L." -> "EMPRESA")"""
+    name = LEGAL_SUFFIX_PATTERN.sub(' ', str(raw_name).strip().upper())
+    return ' '.join(TOKEN_PATTERN.findall(name))
+
+
+class NameMatcher:
+    """
+    Autómata Aho-Corasick a nivel de palabra sobre los nombres de proveedor.
+    Encuentra TODOS los nombres presentes en el texto en una sola pasada lineal,
+    y sólo por palabras completas (evita "SOL" dentro de "SOLUCIONES").
+    """
+
+    def __init__(self, entries=()):
+        """
+        Args:
+            entries: tuplas (nombre_nucleo, cif_norm, cif) a buscar
+        """
+        self.entries = []
+        self.goto = [{}]       # nodo -> {palabra: nodo hijo}
+        self.fail = [0]        # enlace de fallo de cada nodo
+        self.output = [()]     # entradas que terminan exactamente en el nodo
+        self.dict_link = [0]   # siguiente nodo (vía fallos) con salida, 0 = ninguno
+        self.depth = [0]       # nº de palabras del camino raíz -> nodo
+
+        for entry in entries:
+            self._add(entry)
+        self._build_links()
+
+    def _add(self, entry):
+        node = 0
+        for word in entry[0].split():
+            child = self.goto[node].get(word)
+            if child is None:
+                child = len(self.goto)
+                self.goto[node][word] = child
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+                self.dict_link.append(0)
+                self.depth.append(self.depth[node] + 1)
+            node = child
+        self.output[node] += (len(self.entries),)
+        self.entries.append(entry)
+
+    def _build_links(self):
+        # Recorrido en anchura: los enlaces de fallo apuntan siempre a nodos menos profundos
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for word, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(word, 0)
+                self.fail[child] = target if target != child else 0
+                self.dict_link[child] = target if self.output[target] else self.dict_link[target]
+                queue.append(child)
+
+    def find_all(self, text, tokens=None):
+        """Devuelve todas las coincidencias (NameHit) en orden de aparición
+
+        Args:
+            tokens: palabras (palabra, inicio, fin) de text.upper() ya calculadas (NormalizedText.tokens)
+        """
+        hits = []
+        if tokens is None:
+            tokens = [(m.group(), m.start(), m.end()) for m in TOKEN_PATTERN.finditer(text.upper())]
+        node = 0
+        for i, (word, _, end) in enumerate(tokens):
+            while node and word not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(word, 0)
+
+            match = node if self.output[node] else self.dict_link[node]
+            while match:
+                start = tokens[i - self.depth[match] + 1][1]
+                for entry_id in self.output[match]:
+                    name, cif_norm, cif = self.entries[entry_id]
+                    hits.append(NameHit(start, end, name, cif_norm, cif))
+                match = self.dict_link[match]
+        hits.sort(key=lambda hit: (hit.start, -len(hit.name)))
+        return hits
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SupplierIndex:
+    COLUMNS = ['CUENTA', 'NOMBRE', 'CIF', 'CIF_NORM']
+
+    def __init__(self, records=(), version=""):
+        """
+        Args:
+            records: dicts con CUENTA, NOMBRE, CIF y CIF_NORM (en el orden del CSV)
+            version: huella del contenido de PROVEE.csv del que sale el índice
+        """
+        self.version = version
+        self.records = list(records)
+        self.by_cif = {}
+        for record in self.records:
+            # Gana la primera aparición, igual que match.iloc[0] sobre el DataFrame
+            # Los CIF vacíos no se indexan: no identifican a ningún proveedor
+            if record['CIF_NORM']:
+                self.by_cif.setdefault(record['CIF_NORM'], record)
+
+        # El autómata de nombres se construye una vez por versión del maestro
+        self.name_matcher = NameMatcher(self._name_entries())
+
+    def _name_entries(self):
+        for record in self.records:
+            # Sin CIF en el ERP el nombre no sirve para identificar al proveedor
+            if not record['CIF_NORM']:
+                continue
+            core_name = core_supplier_name(record['NOMBRE'])
+            # Solo usar si queda un nombre significativo (> 3 chars y no es solo números)
+            if len(core_name) > 3 and not core_name.replace(' ', '').isdigit():
+                yield (core_name, record['CIF_NORM'], record['CIF'])
+
+    @classmethod
+    def from_dataframe(cls, df, version=""):
+        columns = [df[col].tolist() for col in cls.COLUMNS]
+        return cls((dict(zip(cls.COLUMNS, values)) for values in zip(*columns)), version)
+
+    # --- Caché binaria local del índice compilado ---
+
+    def save(self, cache_path, source_stat):
+        """Serializa el índice (CIFs + autómata) junto a la huella (mtime, tamaño) del CSV origen"""
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        payload = {"format": CACHE_FORMAT, "source_stat": list(source_stat), "index": self}
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    @staticmethod
+    def load_cache(cache_path):
+        """Lee la caché con mmap (sin copiar el fichero a memoria). None si no existe o es de otro formato"""
+        try:
+            with open(cache_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                payload = pickle.loads(mm)
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        if not isinstance(payload, dict) or payload.get("format") != CACHE_FORMAT:
+            return None
+        return payload
+
+    def lookup_cif(self, cif_norm):
+        """Proveedor para un CIF ya normalizado (normalize_id) o None"""
+        return self.by_cif.get(cif_norm) if cif_norm else None
+
+    def find_names(self, text, tokens=None):
+        """Proveedores cuyo nombre aparece en el texto, del mejor al peor candidato
+
+        Args:
+            tokens: palabras de text.upper() ya calculadas (ver NameMatcher.find_all)
+
+        Returns:
+            lista de (cif, [NameHit, ...]) ordenada por longitud del nombre,
+            nº de apariciones y posición de la primera aparición
+        """
+        by_cif = {}
+        for hit in self.name_matcher.find_all(text, tokens):
+            by_cif.setdefault(hit.cif_norm, []).append(hit)
+
+        def score(hits):
+            return (-max(len(h.name) for h in hits), -len(hits), hits[0].start)
+
+        ranked = sorted(by_cif.values(), key=score)
+        return [(hits[0].cif, hits) for hits in ranked]
+
+    def __contains__(self, cif_norm):
+        return bool(cif_norm) and cif_norm in self.by_cif
+
+    def __len__(self):
+        return len(self.records)
@@ -0,0 +1,310 @@
+"""
+Generador de un corpus sintético de facturas de proveedor para benchmarks.
+Crea, de forma reproducible (semilla), un maestro PROVEE.csv con el mismo
+formato que el del ERP (latin1, sin cabecera, 0:CUENTA 1:NOMBRE 9:CIF), un
+templates.json para una parte de los proveedores y un árbol año/mes/proveedor
+de PDFs generados con PyMuPDF que cubre los casos que ve el procesador:
+
+- estandar:     CIF del emisor en el texto, tres maquetaciones distintas
+- plantilla:    proveedor con plantilla zonal (importes en las zonas del bbox)
+- multipagina:  líneas de detalle en 2-4 páginas, totales en la última
+- sin_cif:      sólo el nombre del proveedor (fallback por nombre)
+- escaneada:    página sólo imagen, sin capa de texto (Claude visión)
+- basura:       capa de texto ilegible (mala codificación); a veces el CIF va en el nombre del archivo
+- no_factura:   carta comercial sin palabras clave de factura
+
+Uso: python synthetic_corpus.py --dir RUTA [--invoices 2000] [--suppliers 50000] [--seed 42]
+"""
+
+import json
+import random
+import argparse
+from collections import Counter
+from pathlib import Path
+import fitz  # PyMuPDF
+
+JOFEG_CIF = "A28346245"
+CIF_LETTERS = "ABCDEFGHJNPQRSUVW"
+CIF_CONTROL_LETTERS = "JABCDEFGHI"
+
+# Peso de cada tipo de factura en el corpus
+INVOICE_KINDS = {
+    "estandar": 55,
+    "plantilla": 15,
+    "multipagina": 10,
+    "sin_cif": 8,
+    "escaneada": 5,
+    "basura": 5,
+    "no_factura": 2
+}
+TEMPLATE_SUPPLIERS = 40
+
+# Zonas de importes de las plantillas (página A4, puntos PDF)
+TEMPLATE_ZONES = {
+    "base_imponible": [400, 660, 560, 680],
+    "iva_importe": [400, 680, 560, 700],
+    "total_amount": [400, 700, 560, 720]
+}
+
+NAME_WORDS = ["SUMINISTROS", "INDUSTRIALES", "TRANSPORTES", "HIERROS", "MADERAS", "FERRETERIA",
+              "DISTRIBUCIONES", "MONTAJES", "ELECTRICIDAD", "FONTANERIA", "ALUMINIOS", "RECAMBIOS",
+              "LOGISTICA", "TALLERES", "PINTURAS", "EMBALAJES", "COMERCIAL", "INGENIERIA", "QUIMICAS",
+              "PAPELERIA", "CONSTRUCCIONES", "AUTOMATISMOS", "HIDRAULICA", "NEUMATICOS", "SERVICIOS"]
+SURNAMES = ["GARCIA", "MARTINEZ", "LOPEZ", "SANCHEZ", "PEREZ", "GOMEZ", "MARTIN", "JIMENEZ", "RUIZ",
+            "HERNANDEZ", "DIAZ", "MORENO", "ALVAREZ", "MUÑOZ", "ROMERO", "ALONSO", "GUTIERREZ",
+            "NAVARRO", "TORRES", "DOMINGUEZ", "VAZQUEZ", "RAMOS", "GIL", "SERRANO", "BLANCO"]
+CITIES = ["MADRID", "BARCELONA", "VALENCIA", "SEVILLA", "ZARAGOZA", "BILBAO", "MURCIA", "VALLADOLID"]
+LEGAL_SUFFIXES = ["S.L.", "S.A.", "S.L.U.", "S.A.U.", "SOCIEDAD LIMITADA"]
+ITEMS = ["Tornillería inox M8", "Perfil aluminio 40x40", "Portes", "Mano de obra", "Cable 2,5 mm",
+         "Válvula esfera 1/2\"", "Palet europeo", "Pintura epoxi 20 L", "Rodamiento 6204", "Servicio técnico"]
+
+
+def cif_from_index(index, letter):
+    """CIF de sociedad (letra + 7 dígitos + control) con dígito de control válido"""
+    digits = f"{index % 10**7:07d}"
+    odd = sum(sum(divmod(int(d) * 2, 10)) for d in digits[0::2])
+    even = sum(int(d) for d in digits[1::2])
+    control = (10 - (odd + even) % 10) % 10
+    # Las letras P, Q, R, S, N, W llevan letra de control; el resto dígito
+    check = CIF_CONTROL_LETTERS[control] if letter in "PQRSNW" else str(control)
+    return f"{letter}{digits}{check}"
+
+
+def spanish_amount(value):
+    """1234.5 -> '1.234,50'"""
+    return f"{value:,.2f}".replace(",", "_").replace(".", ",").replace("_", ".")
+
+
+def build_suppliers(num_suppliers, seed=42):
+    """Lista de proveedores {cuenta, nombre, cif}; nombres únicos y CIFs únicos"""
+    rng = random.Random(seed)
+    suppliers = []
+    for i in range(num_suppliers):
+        name = (f"{rng.choice(NAME_WORDS)} {rng.choice(SURNAMES)} {rng.choice(SURNAMES)} "
+                f"{i} {rng.choice(LEGAL_SUFFIXES)}")
+        suppliers.append({
+            "cuenta": f"400{i:07d}",
+            "nombre": name,
+            "cif": cif_from_index(i, CIF_LETTERS[i % len(CIF_LETTERS)])
+        })
+    return suppliers
+
+
+def write_provee_csv(path, suppliers):
+    """PROVEE.csv como lo exporta el ERP: latin1, sin cabecera, 10 columnas"""
+    with open(path, "w", encoding="latin1", newline="") as f:
+        for supplier in suppliers:
+            row = [supplier["cuenta"], supplier["nombre"], "", "", "", "", "", "", "", supplier["cif"]]
+            f.write(",".join(value.replace(",", " ") for value in row) + "\n")
+
+
+def write_templates(path, template_suppliers):
+    templates = {
+        supplier["cif"]: {"cif": supplier["cif"], "name": supplier["nombre"],
+                          "fields": {field: {"bbox": bbox} for field, bbox in TEMPLATE_ZONES.items()}}
+        for supplier in template_suppliers
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(templates, f, ensure_ascii=False, indent=2)
+
+
+class _InvoiceWriter:
+    """Escribe una factura en páginas A4 con texto posicionado (un único Shape por página)"""
+    def __init__(self):
+        self.doc = fitz.open()
+        self.page = None
+        self.shape = None
+        self.new_page()
+
+    def text(self, x, y, value, size=10):
+        self.shape.insert_text((x, y), value, fontsize=size, fontname="helv")
+
+    def new_page(self):
+        # page.insert_text crea y confirma un Shape por llamada: con cientos de líneas es lo más lento
+        self.flush()
+        self.page = self.doc.new_page(width=595, height=842)
+        self.shape = self.page.new_shape()
+
+    def flush(self):
+        if self.shape is not None:
+            self.shape.commit()
+            self.shape = None
+
+    def save(self, path):
+        self.flush()
+        self.doc.save(path, garbage=3, deflate=True)
+        self.doc.close()
+
+
+def _invoice_data(rng, supplier):
+    lines = [(rng.choice(ITEMS), rng.randint(1, 20), rng.uniform(3, 400)) for _ in range(rng.randint(2, 8))]
+    base = round(sum(qty * price for _, qty, price in lines), 2)
+    iva = round(base * 0.21, 2)
+    return {
+        "supplier": supplier,
+        "number": f"{rng.choice(['F', 'FV', 'FAC', 'A'])}{rng.randint(20, 26)}-{rng.randint(1, 99999):05d}",
+        "date": f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/20{rng.randint(24, 26)}",
+        "city": rng.choice(CITIES),
+        "lines": lines,
+        "base": base,
+        "iva": iva,
+        "total": round(base + iva, 2)
+    }
+
+
+def _draw_header(writer, data, layout, with_cif=True):
+    supplier = data["supplier"]
+    left, right = (72, 330) if layout != 1 else (330, 72)
+    writer.text(left, 70, supplier["nombre"], size=12)
+    writer.text(left, 86, f"C/ Mayor {len(supplier['nombre']) % 90 + 1}, {data['city']}")
+    if with_cif:
+        writer.text(left, 102, f"CIF: {supplier['cif']}" if layout != 2 else f"N.I.F. ES{supplier['cif']}")
+    writer.text(right, 70, "FACTURA" if layout != 2 else "FACTURA ORIGINAL", size=14)
+    writer.text(right, 90, f"Nº Factura: {data['number']}")
+    writer.text(right, 106, f"Fecha: {data['date']}")
+    writer.text(right, 140, "Cliente: JOFEG S.A.")
+    writer.text(right, 156, f"CIF: {JOFEG_CIF}")
+
+
+def _draw_lines(writer, lines, top=200):
+    writer.text(72, top, "Concepto")
+    writer.text(330, top, "Uds.")
+    writer.text(400, top, "Precio")
+    writer.text(480, top, "Importe")
+    y = top + 18
+    for item, qty, price in lines:
+        writer.text(72, y, item)
+        writer.text(330, y, str(qty))
+        writer.text(400, y, spanish_amount(price))
+        writer.text(480, y, spanish_amount(qty * price))
+        y += 14
+    return y
+
+
+def _draw_totals(writer, data, zones=False):
+    if zones:
+        # Exactamente dentro de las zonas de la plantilla
+        for field, key in (("base_imponible", "base"), ("iva_importe", "iva"), ("total_amount", "total")):
+            x0, y0, _, y1 = TEMPLATE_ZONES[field]
+            writer.text(x0 - 110, y1 - 5, {"base": "Base imponible", "iva": "IVA 21%", "total": "TOTAL"}[key])
+            writer.text(x0 + 10, y1 - 5, f"{spanish_amount(data[key])} €")
+        return
+    writer.text(330, 700, f"BASE IMPONIBLE: {spanish_amount(data['base'])}")
+    writer.text(330, 716, f"IVA 21%: {spanish_amount(data['iva'])}")
+    writer.text(330, 732, f"TOTAL FACTURA: {spanish_amount(data['total'])} EUR", size=11)
+
+
+def make_invoice(path, kind, rng, supplier):
+    """Genera una factura del tipo indicado en path"""
+    data = _invoice_data(rng, supplier)
+    layout = rng.randrange(3)
+    writer = _InvoiceWriter()
+
+    if kind == "no_factura":
+        writer.text(72, 70, supplier["nombre"], size=12)
+        writer.text(72, 120, f"{data['city']}, {data['date']}")
+        writer.text(72, 160, "Estimado cliente:")
+        writer.text(72, 180, "Le comunicamos nuestro nuevo catálogo de productos para la temporada.")
+        writer.save(path)
+        return
+
+    if kind == "basura":
+        # Fuente mal incrustada: la capa de texto sale con caracteres sin sentido
+        garbage = "".join(rng.choice("ÃÂ¢¤¦§¨©ª«¬®¯°±²³µ¶·¸¹º»¼½¾¿ÐÞßðþ#$%&@") for _ in range(600))
+        writer.text(72, 70, "FACTURA", size=14)
+        for i in range(0, len(garbage), 80):
+            writer.text(72, 100 + i // 80 * 14, garbage[i:i + 80])
+        writer.save(path)
+        return
+
+    _draw_header(writer, data, layout, with_cif=kind != "sin_cif")
+    if kind == "multipagina":
+        pages = rng.randint(2, 4)
+        for page in range(pages):
+            items = [(rng.choice(ITEMS), rng.randint(1, 20), rng.uniform(3, 400)) for _ in range(30)]
+            _draw_lines(writer, items, top=200 if page == 0 else 80)
+            writer.text(480, 820, f"Página {page + 1} de {pages}", size=8)
+            if page < pages - 1:
+                writer.new_page()
+        _draw_totals(writer, data)
+    else:
+        _draw_lines(writer, data["lines"])
+        _draw_totals(writer, data, zones=kind == "plantilla")
+
+    if kind == "escaneada":
+        # Sólo imagen: la página renderizada en gris a 110 DPI, como un escáner sin OCR
+        writer.flush()
+        pix = writer.page.get_pixmap(dpi=110, colorspace=fitz.csGRAY)
+        writer.doc.close()
+        scanned = fitz.open()
+        page = scanned.new_page(width=595, height=842)
+        page.insert_image(page.rect, stream=pix.tobytes("jpeg", jpg_quality=70))
+        scanned.save(path, garbage=3, deflate=True)
+        scanned.close()
+        return
+    writer.save(path)
+
+
+def build_corpus(root, num_invoices=2000, num_suppliers=50000, seed=42, active_suppliers=800):
+    """
+    Genera maestro, plantillas y facturas bajo root
+
+    Args:
+        active_suppliers: nº de proveedores del maestro que emiten facturas (como en la realidad,
+            una pequeña parte del maestro concentra casi todas las facturas)
+    Returns:
+        dict con las rutas generadas y el nº de facturas por tipo
+    """
+    rng = random.Random(seed)
+    root = Path(root)
+    pdf_root = root / "pdfs"
+    pdf_root.mkdir(parents=True, exist_ok=True)
+
+    suppliers = build_suppliers(num_suppliers, seed)
+    write_provee_csv(root / "PROVEE.csv", suppliers)
+    active = rng.sample(suppliers, min(active_suppliers, len(suppliers)))
+    with_template = active[:TEMPLATE_SUPPLIERS]
+    write_templates(root / "templates.json", with_template)
+
+    kinds = list(INVOICE_KINDS)
+    weights = [INVOICE_KINDS[kind] for kind in kinds]
+    counts = Counter()
+    for i in range(num_invoices):
+        kind = rng.choices(kinds, weights)[0]
+        supplier = rng.choice(with_template if kind == "plantilla" else active)
+        directory = pdf_root / f"20{24 + i % 3}" / f"{i % 12 + 1:02d}" / supplier["cuenta"]
+        directory.mkdir(parents=True, exist_ok=True)
+        name = f"Factura_{i:06d}.pdf"
+        if kind == "basura" and rng.random() < 0.5:
+            # Texto ilegible pero CIF con plantilla en el nombre del archivo (fallback por nombre)
+            supplier = rng.choice(with_template)
+            name = f"{supplier['cif']}_{i:06d}.pdf"
+        make_invoice(str(directory / name), kind, rng, supplier)
+        counts[kind] += 1
+
+    return {
+        "pdf_dir": str(pdf_root),
+        "provee_csv": str(root / "PROVEE.csv"),
+        "templates": str(root / "templates.json"),
+        "invoices": num_invoices,
+        "suppliers": num_suppliers,
+        "kinds": dict(counts)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dir", required=True, help="Directorio donde generar el corpus")
+    parser.add_argument("--invoices", type=int, default=2000)
+    parser.add_argument("--suppliers", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.dir, args.invoices, args.suppliers, args.seed)
+    kinds = ", ".join(f"{kind} {count}" for kind, count in sorted(corpus["kinds"].items()))
+    print(f"Corpus sintético en {args.dir}: {corpus['invoices']} facturas ({kinds}), "
+          f"{corpus['suppliers']} proveedores en PROVEE.csv")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,14 @@ logging.basicConfig(level=logging.INFO)
 jofeg_idp_processor.INPUT_PDF_DIR = r"X:\Facts_Proveedor"
 jofeg_idp_processor.OUTPUT_XLSX = r"c:\Proyectos\Proveedores\Resumen_Facturas_IDP_Local.xlsx"
 # Ensure state path is consistent or separate so we don't ignore files "already processed" in production state
-jofeg_idp_processor.STATE_PATH = r"c:\Proyectos\Proveedores\processing_state_local.json"
+jofeg_idp_processor.STATE_PATH = r"c:\Proyectos\Proveedores\processing_state_local.json"  # its .journal follows it
+# The SQLite store is the system of record (the Excel is exported from it): never touch the production one
+jofeg_idp_processor.RESULTS_DB_PATH = r"c:\Proyectos\Proveedores\resultados_idp_local.sqlite"
+jofeg_idp_processor.EXTRACTION_CACHE_DIR = r"c:\Proyectos\Proveedores\cache_local\extraction"
+jofeg_idp_processor.CRAWL_CACHE_PATH = r"c:\Proyectos\Proveedores\cache_local\crawl_dirs.json"
+jofeg_idp_processor.USAGE_LOG_PATH = r"c:\Proyectos\Proveedores\claude_usage_local.jsonl"
+jofeg_idp_processor.METRICS_JSON_PATH = r"c:\Proyectos\Proveedores\metricas_idp_local.json"
+jofeg_idp_processor.METRICS_PROM_PATH = None  # a local run must not be scraped as production
 
 print(f"Processing files in {jofeg_idp_processor.INPUT_PDF_DIR}")
 
@@ -18,8 +25,8 @@ processor = jofeg_idp_processor.JofegIDPProcessor(use_claude_api=True, claude_as
 
 # Forzar reprocesamiento borrando estado local si existe (opcional)
 import os
-if os.path.exists(jofeg_idp_processor.STATE_PATH):
-    os.remove(jofeg_idp_processor.STATE_PATH)
+processor.state_journal.reset()
+processor.state = {}
 
 processor.process_all()
 